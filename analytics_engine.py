@@ -0,0 +1,366 @@
+# analytics_engine.py - محرك التحليلات الزمنية
+"""
+📊 محرك التحليلات الزمنية - FC 26 Analytics Engine
+==================================================
+سلاسل زمنية للوحة التحكم من مصفوفات NumPy عمودية
+- التسجيلات لكل ساعة/يوم حسب المنصة
+- طلبات البيع وحجمها بالجنيه لكل يوم حسب نوع التحويل
+- نسبة ربط التليجرام إلى التسجيلات
+- الأعمدة (وقت + رمز الفئة) تُبنى مرة وتُعاد فقط عند تغير المخزن
+- العد بـ bincount على مصفوفة مرتبة بالوقت بدون حلقات بايثون لكل سجل
+"""
+
+import os
+import threading
+import time
+import warnings
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# استيراد الوزارات الأخرى كمصادر للبيانات
+from profile_handler import profile_handler
+from telegram_manager import telegram_manager
+
+try:
+    from sell_handler import sell_handler
+except ImportError:
+    sell_handler = None
+
+
+# مدة الـ bucket بالثواني
+BUCKET_SECONDS = {
+    "hour": 60 * 60,
+    "day": 24 * 60 * 60,
+}
+
+# أقصى مدة يمكن طلبها بالأيام
+MAX_DAYS = 366
+
+# حالة الطلب التي لا تُحسب في حجم المبيعات
+EXCLUDED_VOLUME_STATUS = "cancelled"
+
+
+def local_utc_offset() -> float:
+    """فرق التوقيت المحلي - الأوقات المحفوظة نصوص محلية بدون منطقة زمنية"""
+    return datetime.now().astimezone().utcoffset().total_seconds()
+
+
+def parse_timestamps(values) -> "np.ndarray":
+    """تحويل أوقات ISO إلى ثوانٍ (int64) دفعة واحدة - القيم غير الصالحة تصبح NaT"""
+    values = [value if value else "NaT" for value in values]
+    try:
+        with warnings.catch_warnings():
+            # numpy يحول الأوقات ذات المنطقة الزمنية إلى UTC - نريد الوقت المحلي كما كُتب
+            warnings.simplefilter("error", DeprecationWarning)
+            parsed = np.array(values, dtype="datetime64[s]")
+    except (ValueError, DeprecationWarning):
+        # بيانات مستوردة بصيغ غير قياسية: تحويل كل قيمة على حدة
+        parsed = np.array([parse_timestamp(value) for value in values], dtype="datetime64[s]")
+    seconds = parsed.astype(np.int64)
+    seconds[np.isnat(parsed)] = -1
+    return seconds
+
+
+def parse_timestamp(value):
+    try:
+        return np.datetime64(datetime.fromisoformat(value).replace(tzinfo=None), "s")
+    except (TypeError, ValueError):
+        return np.datetime64("NaT")
+
+
+class ColumnSet:
+    """أعمدة مصدر واحد مرتبة بالوقت: ts (ثوانٍ محلية) + أعمدة رموز/قيم + أسماء الفئات"""
+
+    def __init__(self, ts, columns=None, labels=None):
+        valid = ts >= 0
+        order = np.argsort(ts[valid], kind="stable")
+        self.ts = ts[valid][order]
+        self.columns = {name: column[valid][order] for name, column in (columns or {}).items()}
+        self.labels = labels or {}
+        self.rows = len(self.ts)
+        self.skipped = int((~valid).sum())
+
+    def window(self, start, end):
+        """حدود الصفوف داخل [start, end) - بحث ثنائي لأن الأعمدة مرتبة"""
+        return np.searchsorted(self.ts, [start, end])
+
+
+def clamp_days(days):
+    return max(1, min(int(days), MAX_DAYS))
+
+
+def encode_category(value, index):
+    """رمز رقمي ثابت لكل فئة نصية (يُبنى أثناء القراءة)"""
+    return index.setdefault(value or "unknown", len(index))
+
+
+class TimeSeriesAnalytics:
+    """محرك السلاسل الزمنية - أعمدة في الذاكرة لكل مصدر مع إعادة بناء عند تغير النسخة"""
+
+    # المصادر التي يُبنى منها كل مقياس (تحدد رقم نسخته)
+    METRIC_SOURCES = {
+        "signups": ("profiles",),
+        "sell_volume": ("orders",),
+        "telegram_conversion": ("profiles", "telegram"),
+    }
+
+    def __init__(self):
+        # أقل مدة بين إعادة بناء أعمدة مصدر تغيرت نسخته
+        self.refresh_seconds = float(os.environ.get("ANALYTICS_REFRESH_SECONDS", "60"))
+        self.page_size = int(os.environ.get("ANALYTICS_PAGE_SIZE", "5000"))
+
+        # name -> (ColumnSet, version, built_at)
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.stats = {"builds": 0, "last_build_ms": {}}
+
+    @property
+    def available(self):
+        return np is not None
+
+    # ------------------------------------------------------------------
+    # بناء الأعمدة
+    # ------------------------------------------------------------------
+
+    def build_signups(self) -> ColumnSet:
+        created_at, platforms, index = [], [], {}
+        for page in profile_handler.store.iter_signup_pages(self.page_size):
+            for created, platform in page:
+                created_at.append(created)
+                platforms.append(encode_category(platform, index))
+        return ColumnSet(
+            parse_timestamps(created_at),
+            {"platform": np.array(platforms, dtype=np.int32)},
+            {"platform": list(index)},
+        )
+
+    def build_orders(self) -> ColumnSet:
+        created_at, transfer_types, statuses, prices = [], [], [], []
+        type_index, status_index = {}, {}
+        for page in sell_handler.store.iter_volume_pages(self.page_size):
+            for created, transfer_type, status, final_price in page:
+                created_at.append(created)
+                transfer_types.append(encode_category(transfer_type, type_index))
+                statuses.append(encode_category(status, status_index))
+                prices.append(final_price or 0)
+        return ColumnSet(
+            parse_timestamps(created_at),
+            {
+                "transfer_type": np.array(transfer_types, dtype=np.int32),
+                "status": np.array(statuses, dtype=np.int32),
+                "price": np.array(prices, dtype=np.float64),
+            },
+            {"transfer_type": list(type_index), "status": list(status_index)},
+        )
+
+    def build_links(self) -> ColumnSet:
+        # أوقات التليجرام epoch - تحويلها لنفس محور الأوقات المحلية
+        times = np.fromiter(
+            (created for page in telegram_manager.code_store.iter_link_times(self.page_size) for created in page),
+            dtype=np.float64,
+        )
+        return ColumnSet((times + local_utc_offset()).astype(np.int64))
+
+    def get_source_versions(self):
+        return {
+            "profiles": profile_handler.store.get_version(),
+            "orders": sell_handler.store.get_version() if sell_handler else None,
+            "telegram": telegram_manager.code_store.get_version(),
+        }
+
+    def get_columns(self, name, version) -> ColumnSet:
+        """أعمدة المصدر - إعادة البناء فقط إذا تغيرت النسخة ومضت مدة التحديث"""
+        builders = {"profiles": self.build_signups, "orders": self.build_orders, "telegram": self.build_links}
+        with self.lock:
+            entry = self.sources.get(name)
+            if entry is not None:
+                columns, built_version, built_at = entry
+                if built_version == version or time.time() - built_at < self.refresh_seconds:
+                    return columns
+
+            started = time.perf_counter()
+            columns = builders[name]()
+            self.sources[name] = (columns, version, time.time())
+            self.stats["builds"] += 1
+            self.stats["last_build_ms"][name] = round((time.perf_counter() - started) * 1000, 2)
+            return columns
+
+    # ------------------------------------------------------------------
+    # العد
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def bucket_counts(columns, start, bucket_seconds, buckets, codes=None, categories=1, weights=None):
+        """مصفوفة (buckets × categories) بعملية bincount واحدة"""
+        low, high = columns.window(start, start + bucket_seconds * buckets)
+        slots = (columns.ts[low:high] - start) // bucket_seconds
+        if codes is not None:
+            slots = slots * categories + codes[low:high]
+        counts = np.bincount(
+            slots,
+            weights=weights[low:high] if weights is not None else None,
+            minlength=buckets * categories,
+        )
+        return counts.reshape(buckets, categories)
+
+    @staticmethod
+    def by_category(matrix, labels, cast=int):
+        """{الفئة: قائمة القيم لكل bucket} للفئات الموجودة في النافذة فقط"""
+        totals = matrix.sum(axis=0)
+        return {
+            label: [cast(value) for value in matrix[:, index].tolist()]
+            for index, label in enumerate(labels)
+            if totals[index]
+        }
+
+    def get_window(self, bucket, days):
+        """بداية النافذة وعدد الـ buckets - آخر bucket هو الحالي (جزئي)"""
+        bucket_seconds = BUCKET_SECONDS[bucket]
+        now = int(time.time() + local_utc_offset())
+        end = (now // bucket_seconds + 1) * bucket_seconds
+        buckets = days * BUCKET_SECONDS["day"] // bucket_seconds
+        return end - buckets * bucket_seconds, bucket_seconds, buckets
+
+    @staticmethod
+    def bucket_labels(start, bucket_seconds, buckets):
+        stamps = np.arange(start, start + bucket_seconds * buckets, bucket_seconds).astype("datetime64[s]")
+        return np.datetime_as_string(stamps).tolist()
+
+    def signups_series(self, versions, start, bucket_seconds, buckets):
+        columns = self.get_columns("profiles", versions["profiles"])
+        labels = columns.labels["platform"]
+        matrix = self.bucket_counts(
+            columns, start, bucket_seconds, buckets, columns.columns["platform"], len(labels) or 1
+        )
+        series = self.by_category(matrix, labels)
+        return {
+            "series": series,
+            "totals": {label: sum(values) for label, values in series.items()},
+            "total": int(matrix.sum()),
+        }
+
+    def sell_volume_series(self, versions, start, bucket_seconds, buckets):
+        columns = self.get_columns("orders", versions["orders"])
+        labels = columns.labels["transfer_type"]
+        codes = columns.columns["transfer_type"]
+        categories = len(labels) or 1
+
+        statuses = columns.labels["status"]
+        volume_weights = columns.columns["price"]
+        if EXCLUDED_VOLUME_STATUS in statuses:
+            excluded = columns.columns["status"] == statuses.index(EXCLUDED_VOLUME_STATUS)
+            volume_weights = np.where(excluded, 0.0, volume_weights)
+
+        orders = self.bucket_counts(columns, start, bucket_seconds, buckets, codes, categories)
+        volume = self.bucket_counts(columns, start, bucket_seconds, buckets, codes, categories, volume_weights)
+        orders_series = self.by_category(orders, labels)
+        return {
+            "series": {
+                "orders": orders_series,
+                "volume_egp": {
+                    label: [round(value, 2) for value in volume[:, labels.index(label)].tolist()]
+                    for label in orders_series
+                },
+            },
+            "totals": {
+                "orders": int(orders.sum()),
+                "volume_egp": round(float(volume.sum()), 2),
+            },
+        }
+
+    def telegram_conversion_series(self, versions, start, bucket_seconds, buckets):
+        signups = self.get_columns("profiles", versions["profiles"])
+        links = self.get_columns("telegram", versions["telegram"])
+        signup_counts = self.bucket_counts(signups, start, bucket_seconds, buckets)[:, 0]
+        link_counts = self.bucket_counts(links, start, bucket_seconds, buckets)[:, 0]
+        rates = np.divide(
+            link_counts, signup_counts,
+            out=np.zeros(buckets, dtype=np.float64), where=signup_counts > 0
+        )
+        total_signups = int(signup_counts.sum())
+        total_links = int(link_counts.sum())
+        return {
+            "series": {
+                "signups": signup_counts.tolist(),
+                "telegram_links": link_counts.tolist(),
+                "conversion_rate": np.round(rates, 4).tolist(),
+            },
+            "totals": {
+                "signups": total_signups,
+                "telegram_links": total_links,
+                "conversion_rate": round(total_links / total_signups, 4) if total_signups else 0,
+            },
+        }
+
+    # ------------------------------------------------------------------
+    # الواجهة
+    # ------------------------------------------------------------------
+
+    def get_time_series(self, metric, bucket="day", days=30):
+        """سلسلة زمنية لمقياس واحد - النتيجة جاهزة للرسم"""
+        if not self.available:
+            return {"success": False, "error": "التحليلات الزمنية تحتاج مكتبة numpy"}
+        if metric not in self.METRIC_SOURCES:
+            return {"success": False, "error": f"مقياس غير معروف: {metric}"}
+        if bucket not in BUCKET_SECONDS:
+            return {"success": False, "error": f"فترة غير مدعومة: {bucket}"}
+        if metric == "sell_volume" and not sell_handler:
+            return {"success": False, "error": "وزارة البيع غير متاحة"}
+
+        try:
+            started = time.perf_counter()
+            days = clamp_days(days)
+            start, bucket_seconds, buckets = self.get_window(bucket, days)
+            versions = self.get_source_versions()
+            compute = {
+                "signups": self.signups_series,
+                "sell_volume": self.sell_volume_series,
+                "telegram_conversion": self.telegram_conversion_series,
+            }[metric]
+            result = compute(versions, start, bucket_seconds, buckets)
+
+            return {
+                "success": True,
+                "metric": metric,
+                "bucket": bucket,
+                "days": days,
+                "labels": self.bucket_labels(start, bucket_seconds, buckets),
+                **result,
+                "version": self.format_version(metric, bucket, days, start),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+            }
+
+        except Exception as e:
+            print(f"خطأ في التحليلات الزمنية: {str(e)}")
+            return {"success": False, "error": str(e)}
+
+    def format_version(self, metric, bucket, days, start):
+        """رقم نسخة السلسلة (ETag): النافذة + نسخ المخازن التي بُنيت منها الأعمدة فعلاً"""
+        with self.lock:
+            built = [str(self.sources[name][1]) for name in self.METRIC_SOURCES[metric]]
+        return ".".join([metric, bucket, str(days), str(start), *built])
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "available": self.available,
+                "builds": self.stats["builds"],
+                "last_build_ms": dict(self.stats["last_build_ms"]),
+                "rows": {name: entry[0].rows for name, entry in self.sources.items()},
+                "skipped_rows": {name: entry[0].skipped for name, entry in self.sources.items()},
+            }
+
+
+# إنشاء instance عام
+analytics_engine = TimeSeriesAnalytics()
+
+
+# تصدير الدوال للاستخدام الخارجي
+def get_time_series(metric, bucket="day", days=30):
+    """دالة سريعة لسلسلة زمنية من محرك التحليلات"""
+    return analytics_engine.get_time_series(metric, bucket, days)
+
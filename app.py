@@ -15,10 +15,12 @@
 import json
 import os  # 🔥 إضافة import os المطلوب لـ os.urandom()
 import re  # 🔥 إضافة هذا الاستيراد المفقود
+import threading
+import time
 from datetime import datetime
 
 from dotenv import load_dotenv  # <--- ✅✅ السطر الأول المطلوب هنا ✅✅
-from flask import jsonify, render_template, request, session
+from flask import Response, jsonify, render_template, request, session, stream_with_context
 
 load_dotenv()  # <--- ✅✅ السطر الثاني المطلوب هنا ✅✅
 
@@ -30,6 +32,7 @@ load_dotenv()  # <--- ✅✅ السطر الثاني المطلوب هنا ✅
 # استيراد الوزارات المتخصصة
 from app_config import app_config, create_flask_app, generate_csrf_token
 from profile_handler import create_user_profile, profile_handler
+from system_metrics import install_request_timing
 from telegram_manager import (
     create_telegram_code,
     get_payment_display_text,
@@ -52,21 +55,22 @@ from validators import (
 # إنشاء التطبيق مع الإعدادات المحسنة
 app = create_flask_app()
 
+# ⏱️ قياس زمن كل طلب حسب المسار (يظهر في صحة النظام بلوحة التحكم)
+install_request_timing(app)
+
 
 print("🚀 FC 26 Profile System بدأ التشغيل مع البنية المعاد تنظيمها")
 print(f"📊 ملخص الإعدادات: {app_config.get_config_summary()}")
 
-# تعيين webhook للتليجرام تلقائياً عند بدء التشغيل
-if telegram_manager.bot_token:
-    print("🔄 محاولة تعيين Telegram Webhook...")
-    webhook_result = telegram_manager.set_webhook()
-    if webhook_result.get("success"):
-        print("✅ تم تعيين Telegram Webhook بنجاح")
-    else:
-        print(f"⚠️ فشل تعيين Webhook: {webhook_result.get('error')}")
-else:
+# تسجيل webhook التليجرام يتم مرة واحدة لكل نشر في gunicorn master (gunicorn.conf.py)
+# أو يدوياً: python telegram_manager.py setup - وليس عند تشغيل كل worker
+if not telegram_manager.bot_token:
     print("⚠️ لا يمكن تعيين Webhook - TELEGRAM_BOT_TOKEN غير موجود")
 
+# 📮 تشغيل workers طابور التليجرام لتوصيل أي رسائل متبقية من تشغيل سابق
+if telegram_manager.bot_token:
+    telegram_manager.outbox.start()
+
 # ============================================================================
 # 🛡️ الخطوة 3: التحقق من الإعدادات (حارس البوابة)
 # ============================================================================
@@ -102,9 +106,13 @@ def before_request():
 try:
     from dashboard_ministry import (
         dashboard_ministry,
-        export_data,
+        get_activity_page,
         get_analytics,
+        get_analytics_version,
         get_dashboard_data,
+        get_dashboard_version,
+        get_system_metrics,
+        stream_export_data,
     )
 
     print("🏰 وزارة لوحة التحكم محملة بنجاح")
@@ -112,11 +120,17 @@ except ImportError:
     print("⚠️ تحذير: لم يتم العثور على وزارة لوحة التحكم")
     dashboard_ministry = None
 
+# 📊 محرك التحليلات الزمنية (يحتاج numpy)
+try:
+    from analytics_engine import analytics_engine, get_time_series
+except ImportError:
+    analytics_engine = None
+
 # 🏰 استيراد وزارة الهوية الصامتة - Identity Ministry
 try:
-    from identity_ministry import IdentityMinistry
-    identity_ministry = IdentityMinistry()
-    if identity_ministry.initialize():
+    from identity_ministry import get_identity_ministry
+    identity_ministry = get_identity_ministry()
+    if identity_ministry.initialized:
         print("🕵️ وزارة الهوية الصامتة محملة ومُهيأة بنجاح")
     else:
         print("⚠️ فشل في تهيئة وزارة الهوية الصامتة")
@@ -132,15 +146,35 @@ def dashboard_page():
     return render_template("dashboard.html")
 
 
+def versioned_json(result, version):
+    """رد JSON مع ETag - المتصفح يعيد التحقق في كل مرة (no-cache) بطلب شرطي"""
+    response = jsonify(result)
+    response.set_etag(version)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def not_modified(version):
+    """رد 304 بدون body - البيانات لم تتغير منذ آخر طلب"""
+    response = Response(status=304)
+    response.set_etag(version)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
 @app.route("/api/dashboard-data")
 def dashboard_data_api():
-    """API لجلب بيانات لوحة التحكم"""
+    """API لجلب بيانات لوحة التحكم (ETag / 304، و since=<version> للأقسام المتغيرة فقط)"""
     if not dashboard_ministry:
         return jsonify({"success": False, "error": "وزارة لوحة التحكم غير متاحة"}), 503
 
     try:
-        result = get_dashboard_data()
-        return jsonify(result)
+        version = get_dashboard_version()
+        if request.if_none_match.contains(version):
+            return not_modified(version)
+
+        result = get_dashboard_data(request.args.get("since"))
+        return versioned_json(result, result.get("version", version))
     except Exception as e:
         print(f"خطأ في API لوحة التحكم: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
@@ -148,36 +182,101 @@ def dashboard_data_api():
 
 @app.route("/api/dashboard-analytics")
 def dashboard_analytics_api():
-    """API لجلب التحليلات فقط"""
+    """API لجلب التحليلات فقط (ETag / 304)"""
     if not dashboard_ministry:
         return jsonify({"success": False, "error": "وزارة لوحة التحكم غير متاحة"}), 503
 
     try:
-        result = get_analytics()
-        return jsonify(result)
+        version = get_analytics_version()
+        if request.if_none_match.contains(version):
+            return not_modified(version)
+
+        return versioned_json(get_analytics(), version)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route("/api/dashboard-timeseries")
+def dashboard_timeseries_api():
+    """API للسلاسل الزمنية: metric=signups|sell_volume|telegram_conversion، bucket=hour|day، days (ETag / 304)"""
+    if not analytics_engine or not analytics_engine.available:
+        return jsonify({"success": False, "error": "محرك التحليلات الزمنية غير متاح"}), 503
+
+    try:
+        result = get_time_series(
+            request.args.get("metric", "signups"),
+            request.args.get("bucket", "day"),
+            request.args.get("days", 30, type=int),
+        )
+        if not result["success"]:
+            return jsonify(result), 400
+
+        version = result["version"]
+        if request.if_none_match.contains(version):
+            return not_modified(version)
+        return versioned_json(result, version)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route("/api/dashboard-activity")
+def dashboard_activity_api():
+    """API لسجل النشاطات على صفحات (before من next_before، shared=1 لنشاطات كل الـ workers)"""
+    if not dashboard_ministry:
+        return jsonify({"success": False, "error": "وزارة لوحة التحكم غير متاحة"}), 503
+
+    try:
+        limit = max(1, min(request.args.get("limit", 50, type=int), 200))
+        before = request.args.get("before", type=int)
+        shared = request.args.get("shared") == "1"
+        return jsonify(get_activity_page(limit, before, shared))
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route("/api/system-metrics")
+def system_metrics_api():
+    """API للقياسات الحية لهذا الـ worker (بدون لقطة أو ETag - كل طلب يقرأ القيم الحالية)"""
+    if not dashboard_ministry:
+        return jsonify({"success": False, "error": "وزارة لوحة التحكم غير متاحة"}), 503
+
+    try:
+        response = jsonify({"success": True, "metrics": get_system_metrics()})
+        response.headers["Cache-Control"] = "no-store"
+        return response
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
 @app.route("/api/dashboard-export")
 def dashboard_export_api():
-    """API لتصدير بيانات لوحة التحكم"""
+    """API لتصدير بيانات لوحة التحكم (متدفق - NDJSON افتراضياً، format=json لمصفوفة، compress=gzip للضغط)"""
     if not dashboard_ministry:
         return jsonify({"success": False, "error": "وزارة لوحة التحكم غير متاحة"}), 503
 
-    try:
-        result = export_data()
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in ("ndjson", "json"):
+        return jsonify({"success": False, "error": "صيغة غير مدعومة"}), 400
+    compress = request.args.get("compress") == "gzip"
 
-        if result["success"]:
-            # إرجاع البيانات كـ JSON file للتحميل
-            response = jsonify(result["export_data"])
-            response.headers["Content-Disposition"] = (
-                f'attachment; filename=fc26_dashboard_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-            )
-            response.headers["Content-Type"] = "application/json"
-            return response
+    try:
+        # الملف يُبنى ويُرسل على دفعات - الذاكرة ثابتة مهما كان عدد المستخدمين
+        chunks = stream_export_data(export_format, compress)
+
+        filename = f'fc26_dashboard_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{export_format}'
+        if compress:
+            filename += ".gz"
+            mimetype = "application/gzip"
+        elif export_format == "ndjson":
+            mimetype = "application/x-ndjson"
         else:
-            return jsonify(result), 500
+            mimetype = "application/json"
+
+        return Response(
+            stream_with_context(chunks),
+            mimetype=mimetype,
+            headers={"Content-Disposition": f"attachment; filename={filename}"},
+        )
 
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -202,6 +301,9 @@ def identity_request_api():
         device_fingerprint = data.get('device_fingerprint', '')
         metadata = data.get('metadata', {})
         
+        if not device_fingerprint:
+            return jsonify({"success": False, "error": "بصمة الجهاز مطلوبة"}), 400
+        
         # معالجة الطلب عبر وزارة الهوية
         result = identity_ministry.process_identity_request(device_fingerprint, metadata)
         
@@ -260,12 +362,40 @@ def identity_track_event_api():
         # تسجيل الحدث
         result = identity_ministry.track_user_event(session_id, event_type, event_data)
         
+        if result.get('retry_after'):
+            # الذاكرة المؤقتة ممتلئة - العميل يعيد المحاولة
+            response = jsonify(result)
+            response.headers["Retry-After"] = str(result['retry_after'])
+            return response, 429
+        
+        if result.get('error_code') == 'unknown_session':
+            return jsonify(result), 404
+        
         return jsonify(result)
     
     except Exception as e:
         return jsonify({"success": False, "error": f"خطأ في تتبع الحدث: {str(e)}"}), 500
 
 
+@app.route("/api/identity/summary/<identity_id>", methods=["GET"])
+def identity_summary_api(identity_id):
+    """API لملخص تحليلات الهوية الصامتة"""
+    if not identity_ministry:
+        return jsonify({"success": False, "error": "وزارة الهوية غير متاحة"}), 503
+    
+    try:
+        result = identity_ministry.get_identity_summary(identity_id)
+        if result.get('not_found'):
+            return jsonify(result), 404
+        if not result.get('success'):
+            return jsonify(result), 500
+        
+        return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({"success": False, "error": f"خطأ في ملخص الهوية: {str(e)}"}), 500
+
+
 # ============================================================================
 # 🗺️ الخطوة 5: تعريف مسارات التطبيق (Routes)
 # ============================================================================
@@ -303,7 +433,7 @@ def handle_sell_coins_request():
 
         result = create_sell_request(data)
 
-        # 4. إرسال إشعار تليجرام (إذا كانت الوزارة متاحة)
+        # 4. إرسال إشعار تليجرام عبر الطابور (لا ينتظر رد التليجرام)
         if (
             result.get("success")
             and "telegram_manager" in globals()
@@ -472,9 +602,14 @@ def update_profile():
             form_data["payment_details"] = extracted_link
 
         # إنشاء الملف الشخصي باستخدام وزارة البيانات
-        result = create_user_profile(form_data, client_ip, user_agent)
+        # الملف الذي أنشأته هذه الجلسة فقط يمكن تحديثه بنفس الرقم
+        result = create_user_profile(
+            form_data, client_ip, user_agent, owner_user_id=session.get("profile_user_id")
+        )
 
         if result["success"]:
+            session["profile_user_id"] = result["user_id"]
+
             # إضافة معلومات الواتساب للاستجابة
             user_data = result["user_data"]
             user_data["whatsapp_info"] = {
@@ -498,6 +633,17 @@ def update_profile():
             }
 
             return jsonify(response_data)
+        elif result.get("error") == "whatsapp_registered":
+            return (
+                jsonify(
+                    {
+                        "success": False,
+                        "message": result["message"],
+                        "error_code": "whatsapp_registered",
+                    }
+                ),
+                409,
+            )
         else:
             return (
                 jsonify(
@@ -560,6 +706,10 @@ def telegram_webhook():
         # استخدام وزارة التليجرام لمعالجة الـ webhook
         result = process_telegram_webhook(update)
 
+        if result.get("retry"):
+            # فشل المعالجة - رد غير 200 حتى يعيد التليجرام إرسال التحديث
+            return jsonify({"ok": False, "result": result}), 500
+
         return jsonify({"ok": True, "result": result})
 
     except Exception as e:
@@ -574,9 +724,9 @@ def get_bot_username():
         # 🔥 إصلاح: إرجاع username البوت بشكل مضمون
         username = telegram_manager.bot_username or "ea_fc_fifa_bot"
 
-        # محاولة الحصول على معلومات البوت الحقيقية
+        # معلومات البوت من الذاكرة المؤقتة (التحديث في الخلفية بدون انتظار)
         if telegram_manager.bot_token:
-            bot_info = telegram_manager.get_bot_info()
+            bot_info = telegram_manager.get_cached_bot_info()
             if bot_info and bot_info.get("username"):
                 username = bot_info.get("username")
 
@@ -609,7 +759,6 @@ def admin_data():
     try:
         # جمع البيانات من جميع الوزارات
         telegram_data = telegram_manager.get_admin_data()
-        profile_data = profile_handler.get_all_users()
         config_summary = app_config.get_config_summary()
 
         admin_data = {
@@ -618,7 +767,7 @@ def admin_data():
                 "codes_count": telegram_data["telegram_codes_count"],
                 "bot_username": telegram_data["bot_username"],
             },
-            "profiles": {"users_count": profile_data["users_count"]},
+            "profiles": {"users_count": profile_handler.get_users_count()},
             "system_info": {
                 "timestamp": datetime.now().isoformat(),
                 "version": "2.0.0 - Modular Architecture",
@@ -644,6 +793,92 @@ def check_telegram_status(code):
         return jsonify({"error": str(e)}), 500
 
 
+# ⏱️ مدد انتظار ربط التليجرام (بالثواني)
+TELEGRAM_LONG_POLL_MAX = 30
+TELEGRAM_STREAM_MAX = 120
+TELEGRAM_STREAM_HEARTBEAT = 15
+
+# 🚦 كل انتظار (SSE / long-poll) يحجز خيطاً من خيوط الـ worker (gthread) طوال مدته
+# الحد يُبقي باقي الخيوط للـ webhook الذي يكمل الربط وللطلبات العادية
+TELEGRAM_MAX_WAITERS = int(os.environ.get("TELEGRAM_MAX_WAITERS", "8"))
+TELEGRAM_WAITERS_RETRY_AFTER = 5
+telegram_waiter_slots = threading.BoundedSemaphore(TELEGRAM_MAX_WAITERS)
+
+
+def waiters_busy():
+    """رد 503 عند امتلاء خانات الانتظار - العميل يعيد المحاولة بعد Retry-After"""
+    response = jsonify({
+        "success": False,
+        "error": "الخادم مشغول - أعد المحاولة بعد قليل",
+        "retry_after": TELEGRAM_WAITERS_RETRY_AFTER,
+    })
+    response.headers["Retry-After"] = str(TELEGRAM_WAITERS_RETRY_AFTER)
+    return response, 503
+
+
+@app.route("/wait-telegram-status/<code>")
+def wait_telegram_status(code):
+    """انتظار ربط كود التليجرام (long-poll) - يرد فور الربط أو عند انتهاء المهلة"""
+    if not telegram_waiter_slots.acquire(blocking=False):
+        return waiters_busy()
+
+    try:
+        timeout = min(max(request.args.get("timeout", 25, type=float), 0), TELEGRAM_LONG_POLL_MAX)
+        status = telegram_manager.wait_for_telegram_link(code, timeout)
+        return jsonify(status)
+
+    except Exception as e:
+        print(f"خطأ في انتظار حالة التليجرام: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+    finally:
+        telegram_waiter_slots.release()
+
+
+@app.route("/telegram-status-stream/<code>")
+def telegram_status_stream(code):
+    """بث حالة ربط التليجرام عبر Server-Sent Events - اتصال واحد لكل متصفح منتظر"""
+
+    def sse_event(event, data):
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def generate():
+        deadline = time.monotonic() + TELEGRAM_STREAM_MAX
+        try:
+            status = telegram_manager.check_telegram_status(code)
+            yield "retry: 3000\n" + sse_event("status", status)
+
+            while status.get("exists") and not status.get("linked"):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                status = telegram_manager.wait_for_telegram_link(
+                    code, min(TELEGRAM_STREAM_HEARTBEAT, remaining)
+                )
+                if status.get("linked") or not status.get("exists"):
+                    yield sse_event("status", status)
+                else:
+                    yield ": keep-alive\n\n"
+
+        except Exception as e:
+            print(f"خطأ في بث حالة التليجرام: {str(e)}")
+
+        # العميل يغلق الاتصال عند end ويكمل بالـ long-poll إذا لم يتم الربط
+        yield sse_event("end", {})
+
+    if not telegram_waiter_slots.acquire(blocking=False):
+        # EventSource يفشل مع 503 والعميل ينتقل للـ long-poll (الذي يحترم Retry-After)
+        return waiters_busy()
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # منع التخزين المؤقت في nginx
+    # التحرير عند إغلاق الرد (حتى لو أغلق العميل قبل أول حدث)
+    response.call_on_close(telegram_waiter_slots.release)
+    return response
+
+
 @app.route("/set-telegram-webhook", methods=["POST"])
 def set_telegram_webhook():
     """تعيين webhook للتليجرام - محدثة مع الوزارة الجديدة"""
@@ -757,6 +992,10 @@ if __name__ == "__main__":
     port = app_config.PORT or 10000
     debug = app_config.DEBUG or False
 
+    # خادم التطوير عملية واحدة - تسجيل webhook هنا بدلاً من gunicorn master
+    if telegram_manager.bot_token:
+        telegram_manager.ensure_webhook()
+
     print(f"\n🌐 Server starting on {host}:{port} (debug={debug})")
 
     app.run(host=host, port=port, debug=debug)
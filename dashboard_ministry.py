@@ -7,22 +7,56 @@
 - إحصائيات المستخدمين
 - معلومات النظام
 - تصدير البيانات
+- لقطة (snapshot) جاهزة في الذاكرة تُعاد بناؤها فقط عند تغير البيانات
+- رقم نسخة (ETag) وردود جزئية بالأقسام المتغيرة فقط منذ نسخة سابقة
+- سجل نشاطات حلقي بسعة ثابتة مع ملف إلحاق اختياري مشترك بين الـ workers
+- صحة النظام من قياسات حية (زمن الطلبات، الذاكرة، SQLite، الاتصالات الخارجية)
 """
 
-import hashlib
+import itertools
 import json
 import os
+import threading
+import time
+from collections import deque
 from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional
 
 # استيراد الوزارات الأخرى للتكامل
-from profile_handler import profile_handler
+from profile_handler import encode_export_records, gzip_chunks, profile_handler
+from system_metrics import get_process_stats, get_sqlite_stats, metrics
 from telegram_manager import telegram_manager
 
+try:
+    from sell_handler import sell_handler
+except ImportError:
+    sell_handler = None
+
+try:
+    from validators import get_validation_cache_path, get_validation_cache_stats
+except ImportError:
+    get_validation_cache_path = get_validation_cache_stats = None
+
+try:
+    import identity_ministry as identity_module
+except ImportError:
+    identity_module = None
+
 
 class DashboardMinistry:
     """وزارة لوحة التحكم المعزولة - نمط القلعة المطلق"""
 
+    # المخزن الذي يغير كل قسم (None = يتغير مع أي إعادة بناء)
+    SECTION_SOURCES = {
+        "users_analytics": "profiles",
+        "telegram_analytics": "telegram",
+        "sell_analytics": "orders",
+        "system_health": None,
+    }
+
+    # حجم القطعة عند قراءة ملف النشاطات المشترك من النهاية
+    ACTIVITY_READ_BLOCK = 64 * 1024
+
     def __init__(self):
         """تهيئة وزارة لوحة التحكم"""
         self.ministry_name = "Dashboard Ministry"
@@ -34,45 +68,81 @@ class DashboardMinistry:
             "last_updated": None,
             "performance_metrics": {},
             "error_logs": [],
-            "activity_logs": [],
         }
 
+        # 📜 سجل النشاطات: حلقة بسعة ثابتة - الإضافة O(1) والأقدم يخرج تلقائياً
+        self.activity_capacity = int(os.environ.get("DASHBOARD_ACTIVITY_CAPACITY", "100"))
+        self.activity_log = deque(maxlen=self.activity_capacity)
+        # رقم تسلسلي لكل نشاط = معرفه (للصفحات والردود الجزئية)
+        self.activity_ids = itertools.count(1)
+        self.activity_seq = 0
+        # طباعة كل نشاط في السجلات (التحذيرات والأخطاء تُطبع دائماً)
+        self.activity_echo = os.environ.get("DASHBOARD_ACTIVITY_ECHO", "false").lower() == "true"
+
+        # ملف NDJSON اختياري يلحق به كل worker نشاطاته (فارغ = معطل)
+        self.activity_log_path = os.environ.get("DASHBOARD_ACTIVITY_LOG_PATH", "")
+        self.activity_file = None
+        self.activity_file_pid = None
+        self.activity_file_lock = threading.Lock()
+
+        # 📸 لقطة لوحة التحكم: تُبنى مرة وتُخدم من الذاكرة حتى تتغير عدادات المخازن
+        self.snapshot_max_age = float(os.environ.get("DASHBOARD_SNAPSHOT_MAX_AGE", "300"))
+        self.snapshot = None
+        self.snapshot_versions = None
+        # رقم البناء: يتغير عند إعادة البناء بانتهاء العمر (بدون تغير عدادات المخازن)
+        self.snapshot_generation = 0
+        # معرف العملية في رقم النسخة: رقم البناء ومعرفات النشاط محلية لكل worker
+        self.instance_pid = None
+        self.instance_nonce = None
+        self.snapshot_built_at = 0.0
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_stats = {"hits": 0, "rebuilds": 0, "last_build_ms": 0.0}
+
         self.log_activity("Ministry", "تم تهيئة وزارة لوحة التحكم")
 
     def log_activity(self, source: str, activity: str, level: str = "INFO"):
-        """تسجيل النشاطات"""
-        activity_entry = {
-            "timestamp": datetime.now().isoformat(),
+        """تسجيل النشاطات - O(1): رقم تسلسلي + إضافة للحلقة (التنسيق عند القراءة فقط)"""
+        activity_id = next(self.activity_ids)
+        entry = (activity_id, time.time(), source, activity, level)
+        self.activity_log.append(entry)
+        if activity_id > self.activity_seq:
+            self.activity_seq = activity_id
+
+        if self.activity_log_path:
+            self.append_activity_file(entry)
+
+        if self.activity_echo or level != "INFO":
+            print(f"🏰 [{source}] {activity}")
+
+    @staticmethod
+    def format_activity(entry) -> Dict[str, Any]:
+        activity_id, timestamp, source, activity, level = entry
+        return {
+            "id": activity_id,
+            "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
             "source": source,
             "activity": activity,
             "level": level,
-            "id": hashlib.md5(
-                f"{datetime.now().isoformat()}{source}{activity}".encode()
-            ).hexdigest()[:8],
         }
 
-        self.system_stats["activity_logs"].append(activity_entry)
-
-        # الحفاظ على آخر 100 نشاط فقط
-        if len(self.system_stats["activity_logs"]) > 100:
-            self.system_stats["activity_logs"] = self.system_stats["activity_logs"][
-                -100:
-            ]
-
-        print(f"🏰 [{source}] {activity}")
+    def append_activity_file(self, entry):
+        """إلحاق سطر بالملف المشترك - وضع الإلحاق يمنع تداخل أسطر الـ workers"""
+        try:
+            with self.activity_file_lock:
+                if self.activity_file is None or self.activity_file_pid != os.getpid():
+                    # line buffering: كل سطر يُكتب بعملية write واحدة
+                    self.activity_file = open(self.activity_log_path, "a", encoding="utf-8", buffering=1)
+                    self.activity_file_pid = os.getpid()
+                record = {**self.format_activity(entry), "pid": self.activity_file_pid}
+                self.activity_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"⚠️ تعذر الكتابة في ملف النشاطات: {str(e)}")
 
     def get_users_analytics(self) -> Dict[str, Any]:
         """تحليل بيانات المستخدمين"""
         try:
-            users_data = profile_handler.get_all_users()
-
-            if not users_data["success"]:
-                return {"error": "فشل في الحصول على بيانات المستخدمين"}
-
-            users = users_data["users_data"]
-
             # إحصائيات أساسية
-            total_users = len(users)
+            total_users = 0
 
             # تحليل المنصات
             platforms = {}
@@ -80,7 +150,10 @@ class DashboardMinistry:
             email_stats = {"with_email": 0, "without_email": 0, "total_emails": 0}
             telegram_stats = {"linked": 0, "not_linked": 0}
 
-            for user_id, user_data in users.items():
+            # المرور على المستخدمين صفحة بصفحة بدلاً من تحميلهم جميعاً
+            for user_data in profile_handler.iter_users():
+                total_users += 1
+
                 # المنصات
                 platform = user_data.get("platform", "غير محدد")
                 platforms[platform] = platforms.get(platform, 0) + 1
@@ -154,7 +227,7 @@ class DashboardMinistry:
             return {"success": False, "error": str(e)}
 
     def get_system_health(self) -> Dict[str, Any]:
-        """فحص صحة النظام"""
+        """فحص صحة النظام من القياسات الحية لهذا الـ worker"""
         try:
             health_data = {
                 "ministry_status": "online",
@@ -163,12 +236,9 @@ class DashboardMinistry:
                 "components": {
                     "profile_handler": "online" if profile_handler else "offline",
                     "telegram_manager": "online" if telegram_manager else "offline",
+                    "sell_handler": "online" if sell_handler else "offline",
                 },
-                "performance": {
-                    "response_time": "< 100ms",
-                    "memory_usage": "normal",
-                    "database_status": "connected",
-                },
+                **self.get_live_metrics(),
             }
 
             self.log_activity("System", "فحص صحة النظام")
@@ -179,71 +249,304 @@ class DashboardMinistry:
             self.log_activity("System", f"خطأ في فحص النظام: {str(e)}", "ERROR")
             return {"success": False, "error": str(e)}
 
-    def get_recent_activity(self, limit: int = 50) -> Dict[str, Any]:
-        """الحصول على النشاطات الأخيرة"""
+    @staticmethod
+    def get_identity_db_path() -> Optional[str]:
+        """ملف قاعدة بيانات وزارة الهوية (إذا كانت مُحملة في هذه العملية)"""
+        identity = identity_module.identity_ministry if identity_module else None
+        return identity.db_manager.db_path if identity else None
+
+    def get_live_metrics(self) -> Dict[str, Any]:
+        """قياسات حية بدون تخزين في اللقطة: الطلبات، العملية، SQLite، الاتصالات الخارجية"""
+        db_paths = [
+            getattr(profile_handler.store, "db_path", None),
+            getattr(telegram_manager.code_store, "db_path", None),
+            getattr(telegram_manager.outbox, "db_path", None),
+            getattr(sell_handler.store, "db_path", None) if sell_handler else None,
+            self.get_identity_db_path(),
+            get_validation_cache_path() if get_validation_cache_path else None,
+        ]
+        return {
+            "measured_at": datetime.now().isoformat(),
+            "performance": {
+                "requests": metrics.get_group("requests"),
+            },
+            "process": get_process_stats(),
+            "sqlite": get_sqlite_stats(db_paths),
+            "outbound": metrics.get_group("outbound"),
+            "memory_stores": self.get_memory_store_stats(),
+        }
+
+    def get_memory_store_stats(self) -> Dict[str, Any]:
+        """أحجام الهياكل المحفوظة في ذاكرة هذا الـ worker"""
+        stats = {
+            "activity_log": {
+                "size": len(self.activity_log),
+                "capacity": self.activity_capacity,
+                "total_logged": self.activity_seq,
+            },
+            "snapshot": {
+                "rebuilds": self.snapshot_stats.get("rebuilds", 0),
+                "hits": self.snapshot_stats.get("hits", 0),
+                "age_seconds": round(time.time() - self.snapshot_built_at, 1) if self.snapshot else None,
+            },
+            "telegram_waiters": len(telegram_manager.code_store.waiters),
+            "telegram_update_dedup": telegram_manager.update_dedup.get_stats(),
+        }
+        if get_validation_cache_stats:
+            stats["validation_cache"] = get_validation_cache_stats()
+        return stats
+
+    def get_recent_activity(self, limit: int = 50, since_seq: int = 0,
+                            before_id: Optional[int] = None) -> Dict[str, Any]:
+        """النشاطات الأحدث أولاً على صفحات - before_id من next_before، since_seq للأحدث منه فقط"""
         try:
-            recent_activities = self.system_stats["activity_logs"][-limit:]
-            recent_activities.reverse()  # الأحدث أولاً
+            entries = list(self.activity_log)
+            page = []
+            for entry in reversed(entries):
+                if entry[0] <= since_seq:
+                    break
+                if before_id is not None and entry[0] >= before_id:
+                    continue
+                page.append(entry)
+                if len(page) > limit:
+                    break
+
+            has_more = len(page) > limit
+            page = page[:limit]
 
             return {
                 "success": True,
-                "activities": recent_activities,
-                "total_count": len(self.system_stats["activity_logs"]),
+                "activities": [self.format_activity(entry) for entry in page],
+                "total_count": len(entries),
+                "total_logged": self.activity_seq,
+                "next_before": page[-1][0] if has_more else None,
             }
 
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    def export_dashboard_data(self) -> Dict[str, Any]:
-        """تصدير بيانات لوحة التحكم"""
+    def get_shared_activity(self, limit: int = 50, before_offset: Optional[int] = None) -> Dict[str, Any]:
+        """نشاطات جميع الـ workers من الملف المشترك - قراءة من النهاية للخلف على صفحات"""
+        if not self.activity_log_path or not os.path.exists(self.activity_log_path):
+            return {"success": False, "error": "ملف النشاطات المشترك غير مفعل"}
+
         try:
-            export_data = {
-                "export_info": {
-                    "generated_at": datetime.now().isoformat(),
-                    "ministry_version": self.ministry_version,
-                    "export_type": "dashboard_complete",
-                },
-                "users_analytics": self.get_users_analytics(),
-                "telegram_analytics": self.get_telegram_analytics(),
-                "system_health": self.get_system_health(),
-                "recent_activity": self.get_recent_activity(),
-                "raw_data": {
-                    "users": profile_handler.export_data(),
-                    "telegram": (
-                        telegram_manager.export_data()
-                        if hasattr(telegram_manager, "export_data")
-                        else {}
-                    ),
-                },
+            entries = []
+            with open(self.activity_log_path, "rb") as f:
+                end = f.seek(0, os.SEEK_END)
+                if before_offset is not None:
+                    end = min(before_offset, end)
+
+                position = end
+                head = b""  # بداية سطر لم تكتمل بعد (بقيته في القطعة الأقدم)
+                while position > 0 and len(entries) < limit:
+                    read_size = min(self.ACTIVITY_READ_BLOCK, position)
+                    position -= read_size
+                    f.seek(position)
+                    lines = (f.read(read_size) + head).split(b"\n")
+                    head = lines[0]
+
+                    offset = position + len(head) + 1
+                    complete = []
+                    for line in lines[1:]:
+                        complete.append((offset, line))
+                        offset += len(line) + 1
+
+                    for line_offset, line in reversed(complete):
+                        if line and len(entries) < limit:
+                            entries.append((line_offset, line))
+
+                if position == 0 and head and len(entries) < limit:
+                    entries.append((0, head))
+
+            activities = []
+            for _, line in entries:
+                try:
+                    activities.append(json.loads(line))
+                except ValueError:
+                    continue  # سطر يُكتب الآن أو تالف
+
+            oldest_offset = entries[-1][0] if entries else 0
+            return {
+                "success": True,
+                "activities": activities,
+                "next_before": oldest_offset if oldest_offset > 0 else None,
             }
 
-            self.log_activity("Export", "تم تصدير بيانات لوحة التحكم")
+        except OSError as e:
+            return {"success": False, "error": str(e)}
+
+    def iter_export_records(self):
+        """سجلات التصدير المتدفق: الملخصات أولاً ثم بيانات المستخدمين الخام"""
+        yield {
+            "type": "export_info",
+            "generated_at": datetime.now().isoformat(),
+            "ministry_version": self.ministry_version,
+            "export_type": "dashboard_stream",
+            "users_count": profile_handler.get_users_count(),
+        }
+        yield {"type": "users_analytics", "data": self.get_users_analytics()}
+        yield {"type": "telegram_analytics", "data": self.get_telegram_analytics()}
+        yield {"type": "system_health", "data": self.get_system_health()}
+        yield {"type": "recent_activity", "data": self.get_recent_activity()}
+        yield from profile_handler.iter_data_records()
+
+        self.log_activity("Export", "تم تصدير بيانات لوحة التحكم (متدفق)")
 
-            return {"success": True, "export_data": export_data}
+    def stream_export(self, export_format: str = "ndjson", compress: bool = False):
+        """تصدير متدفق بذاكرة ثابتة مهما كان عدد المستخدمين"""
+        chunks = encode_export_records(self.iter_export_records(), export_format)
+        return gzip_chunks(chunks) if compress else chunks
 
+    def get_sell_analytics(self) -> Dict[str, Any]:
+        """إحصائيات طلبات البيع (عدادات جاهزة - بدون المرور على الطلبات)"""
+        if not sell_handler:
+            return {"success": False, "error": "وزارة بيع الكوينز غير متاحة"}
+
+        try:
+            return {"success": True, "sell_analytics": sell_handler.get_statistics()}
         except Exception as e:
-            self.log_activity("Export", f"خطأ في التصدير: {str(e)}", "ERROR")
+            self.log_activity("Sell", f"خطأ في إحصائيات البيع: {str(e)}", "ERROR")
             return {"success": False, "error": str(e)}
 
-    def get_complete_dashboard_data(self) -> Dict[str, Any]:
-        """الحصول على جميع بيانات لوحة التحكم"""
+    def get_data_versions(self) -> Dict[str, Any]:
+        """عدادات النسخ لكل مخزن - تتغير مع أي كتابة من أي worker"""
+        return {
+            "profiles": profile_handler.store.get_version(),
+            "telegram": telegram_manager.code_store.get_version(),
+            "orders": sell_handler.store.get_version() if sell_handler else None,
+        }
+
+    def build_snapshot(self) -> Dict[str, Any]:
+        """حساب كل أقسام لوحة التحكم (المكلف - يُستدعى فقط عند تغير البيانات)"""
+        return {
+            "users_analytics": self.get_users_analytics(),
+            "telegram_analytics": self.get_telegram_analytics(),
+            "sell_analytics": self.get_sell_analytics(),
+            "system_health": self.get_system_health(),
+        }
+
+    def get_snapshot(self) -> Dict[str, Any]:
+        """اللقطة الحالية - إعادة البناء فقط إذا تغيرت العدادات أو انتهى عمرها"""
+        return self.get_snapshot_entry()[0]
+
+    def get_snapshot_entry(self):
+        """(اللقطة، العدادات التي بُنيت منها، وقت البناء) معاً من نفس البناء"""
+        versions = self.get_data_versions()
+
+        with self.snapshot_lock:
+            expired = time.time() - self.snapshot_built_at >= self.snapshot_max_age
+            if self.snapshot is None or versions != self.snapshot_versions or expired:
+                started = time.perf_counter()
+                if self.snapshot is not None and versions == self.snapshot_versions:
+                    # العدادات لا تفسر الاختلاف: العميل يحتاج كل الأقسام
+                    self.snapshot_generation += 1
+                self.snapshot = self.build_snapshot()
+                # العدادات المقروءة قبل البناء: أي كتابة أثناءه تسبب إعادة بناء في الطلب التالي
+                self.snapshot_versions = versions
+                self.snapshot_built_at = time.time()
+                self.snapshot_stats["rebuilds"] += 1
+                self.snapshot_stats["last_build_ms"] = round((time.perf_counter() - started) * 1000, 2)
+                self.log_activity("Dashboard", "تم تحديث لقطة لوحة التحكم")
+            else:
+                self.snapshot_stats["hits"] += 1
+
+            return (self.snapshot, {**self.snapshot_versions, "generation": self.snapshot_generation},
+                    self.snapshot_built_at)
+
+    def get_snapshot_stats(self) -> Dict[str, Any]:
+        """إحصائيات اللقطة (عدد مرات الخدمة من الذاكرة وإعادة البناء)"""
+        with self.snapshot_lock:
+            return {
+                **self.snapshot_stats,
+                "versions": self.snapshot_versions,
+                "generation": self.snapshot_generation,
+                "built_at": datetime.fromtimestamp(self.snapshot_built_at).isoformat() if self.snapshot else None,
+                "max_age": self.snapshot_max_age,
+            }
+
+    def get_instance_nonce(self) -> str:
+        """معرف هذه العملية (pid + وقت أول استخدام) - يتجدد بعد fork لأن الوزارة تُنشأ قبله"""
+        if self.instance_pid != os.getpid():
+            self.instance_pid = os.getpid()
+            self.instance_nonce = f"{self.instance_pid:x}{time.time_ns() // 1000:x}"
+        return self.instance_nonce
+
+    def get_dashboard_version(self) -> str:
+        """رقم نسخة لوحة التحكم: العملية + رقم البناء + عدادات المخازن التي بُنيت منها اللقطة + آخر نشاط"""
+        return self.format_version(self.get_snapshot_entry()[1])
+
+    def format_version(self, versions: Dict[str, Any]) -> str:
+        return ".".join(
+            [self.get_instance_nonce()] + [
+                str(value or 0)
+                for value in (versions["generation"], versions["profiles"], versions["telegram"],
+                              versions["orders"], self.activity_seq)
+            ]
+        )
+
+    def get_analytics_version(self) -> str:
+        """رقم نسخة تحليلات المستخدمين (يتغير فقط مع الملفات الشخصية)"""
+        return f"profiles.{self.get_snapshot_entry()[1]['profiles']}"
+
+    @staticmethod
+    def parse_dashboard_version(version: Optional[str]) -> Optional[Dict[str, Any]]:
+        """تحليل رقم نسخة من العميل - None إذا كان غير صالح"""
+        try:
+            instance, *counters = version.split(".")
+            generation, profiles, telegram, orders, activity = (int(part) for part in counters)
+        except (AttributeError, ValueError):
+            return None
+        return {"instance": instance, "generation": generation, "profiles": profiles,
+                "telegram": telegram, "orders": orders, "activity": activity}
+
+    def get_complete_dashboard_data(self, since: Optional[str] = None) -> Dict[str, Any]:
+        """الحصول على جميع بيانات لوحة التحكم (من اللقطة) - أو المتغير فقط منذ نسخة since"""
         try:
+            snapshot, versions, built_at = self.get_snapshot_entry()
+            version = self.format_version(versions)
+            previous = self.parse_dashboard_version(since)
+            if previous is not None and previous["instance"] != self.get_instance_nonce():
+                # نسخة من worker آخر: عداداته المحلية لا تقارن بعداداتنا - رد كامل
+                previous = None
+
+            if previous is None:
+                sections = snapshot
+                recent_activity = self.get_recent_activity(30)
+            else:
+                current = self.parse_dashboard_version(version)
+                if current["generation"] != previous["generation"]:
+                    # لقطة أعيد بناؤها بانتهاء عمرها (أو من worker آخر): كل الأقسام قد تغيرت
+                    sections = snapshot
+                else:
+                    changed = {
+                        source for source in ("profiles", "telegram", "orders")
+                        if current[source] != previous[source]
+                    }
+                    sections = {
+                        name: value for name, value in snapshot.items()
+                        if (self.SECTION_SOURCES.get(name) in changed) or
+                        (self.SECTION_SOURCES.get(name) is None and changed)
+                    }
+                recent_activity = self.get_recent_activity(30, since_seq=previous["activity"])
+
             dashboard_data = {
                 "ministry_info": {
                     "name": self.ministry_name,
                     "version": self.ministry_version,
                     "initialized_at": self.initialized_at.isoformat(),
-                    "last_updated": datetime.now().isoformat(),
+                    "last_updated": datetime.fromtimestamp(built_at).isoformat(),
                 },
-                "users_analytics": self.get_users_analytics(),
-                "telegram_analytics": self.get_telegram_analytics(),
-                "system_health": self.get_system_health(),
-                "recent_activity": self.get_recent_activity(30),
+                **sections,
+                "recent_activity": recent_activity,
             }
 
-            self.log_activity("Dashboard", "تم جلب البيانات الكاملة للوحة التحكم")
-
-            return {"success": True, "dashboard_data": dashboard_data}
+            return {
+                "success": True,
+                "version": version,
+                "delta": previous is not None,
+                "dashboard_data": dashboard_data,
+            }
 
         except Exception as e:
             self.log_activity("Dashboard", f"خطأ في جلب البيانات: {str(e)}", "ERROR")
@@ -255,16 +558,38 @@ dashboard_ministry = DashboardMinistry()
 
 
 # تصدير الدوال للاستخدام الخارجي
-def get_dashboard_data():
+def get_dashboard_data(since=None):
     """دالة سريعة للحصول على بيانات لوحة التحكم"""
-    return dashboard_ministry.get_complete_dashboard_data()
+    return dashboard_ministry.get_complete_dashboard_data(since)
+
+
+def get_activity_page(limit=50, before=None, shared=False):
+    """دالة سريعة لصفحة من سجل النشاطات (الحلقة المحلية أو الملف المشترك)"""
+    if shared:
+        return dashboard_ministry.get_shared_activity(limit, before)
+    return dashboard_ministry.get_recent_activity(limit, before_id=before)
+
+
+def get_dashboard_version():
+    """دالة سريعة لرقم نسخة لوحة التحكم (ETag)"""
+    return dashboard_ministry.get_dashboard_version()
+
+
+def get_analytics_version():
+    """دالة سريعة لرقم نسخة التحليلات (ETag)"""
+    return dashboard_ministry.get_analytics_version()
+
+
+def get_system_metrics():
+    """دالة سريعة للقياسات الحية (خارج اللقطة)"""
+    return dashboard_ministry.get_live_metrics()
 
 
 def get_analytics():
     """دالة سريعة للحصول على التحليلات"""
-    return dashboard_ministry.get_users_analytics()
+    return dashboard_ministry.get_snapshot()["users_analytics"]
 
 
-def export_data():
-    """دالة سريعة لتصدير البيانات"""
-    return dashboard_ministry.export_dashboard_data()
+def stream_export_data(export_format="ndjson", compress=False):
+    """دالة سريعة للتصدير المتدفق"""
+    return dashboard_ministry.stream_export(export_format, compress)
@@ -0,0 +1,38 @@
+# gunicorn.conf.py - إعدادات gunicorn
+"""
+🦄 إعدادات gunicorn - FC 26 Profile System
+==========================================
+الأعمال التي تتم مرة واحدة لكل نشر يطلقها الـ master في عملية خلفية (بدون انتظار)
+- تحديث معلومات البوت في الملف المؤقت (الـ workers تقرأه بدون شبكة)
+- تسجيل webhook التليجرام إذا تغير عنوانه
+- عدة workers بخيوط (gthread) مع حد لاتصالات الانتظار الطويلة في كل worker
+"""
+
+import os
+import subprocess
+import sys
+
+# 🧵 workers متعددة × خيوط: انتظار ربط التليجرام (SSE / long-poll) يحجز خيطاً
+# وعددها محدود لكل worker (TELEGRAM_MAX_WAITERS) حتى يبقى خيط للـ webhook دائماً
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', '3'))
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+
+def when_ready(server):
+    """إعداد التليجرام في عملية منفصلة بدون انتظارها - تشغيل الـ workers لا يعتمد على التليجرام
+
+    الـ workers تستخدم معلومات البوت المحفوظة (أو تحدثها في الخلفية) حتى ينتهي الإعداد
+    """
+    if not os.environ.get('TELEGRAM_BOT_TOKEN'):
+        return
+
+    try:
+        process = subprocess.Popen(
+            [sys.executable, 'telegram_manager.py', 'setup'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdin=subprocess.DEVNULL
+        )
+        server.log.info(f"🤖 إعداد التليجرام يعمل في الخلفية (pid {process.pid})")
+    except Exception as e:
+        server.log.warning(f"⚠️ تعذر تشغيل إعداد التليجرام: {str(e)}")
@@ -0,0 +1,136 @@
+# http_client.py - عميل HTTP الخارجي المشترك
+"""
+🌐 عميل HTTP المشترك - FC 26 Profile System
+===========================================
+نقطة واحدة لجميع الاتصالات الخارجية (واتساب، تليجرام)
+- مجمع اتصالات لكل host مع keep-alive
+- أحجام المجمعات والمهلات قابلة للضبط من متغيرات البيئة
+- إحصائيات إعادة استخدام الاتصالات لقياس توفير الـ handshakes
+- توزيع زمن الاستجابة لكل host (system_metrics)
+"""
+
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from system_metrics import metrics
+
+
+class OutboundHTTPClient:
+    """عميل HTTP مشترك بمجمعات اتصالات دائمة لكل host"""
+
+    def __init__(self, pool_connections=None, pool_maxsize=None,
+                 connect_timeout=None, read_timeout=None):
+        # عدد الـ hosts التي نحتفظ لها بمجمع اتصالات
+        self.pool_connections = int(pool_connections or os.environ.get('HTTP_POOL_CONNECTIONS', '10'))
+        # أقصى عدد اتصالات مفتوحة لكل host
+        self.pool_maxsize = int(pool_maxsize or os.environ.get('HTTP_POOL_MAXSIZE', '20'))
+
+        # ⏱️ المهلات الافتراضية (تُستخدم إذا لم يحدد المستدعي مهلة)
+        self.connect_timeout = float(connect_timeout or os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05'))
+        self.read_timeout = float(read_timeout or os.environ.get('HTTP_READ_TIMEOUT', '30'))
+
+        self.adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        # 📊 إحصائيات لكل host
+        self.lock = threading.Lock()
+        self.host_stats = {}
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """تنفيذ طلب عبر المجمع المشترك مع تسجيل الإحصائيات"""
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+
+        host = urlparse(url).netloc
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+        except Exception:
+            self._record(host, time.perf_counter() - started, error=True)
+            raise
+
+        self._record(host, time.perf_counter() - started, error=False)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def _record(self, host, elapsed, error):
+        metrics.observe('outbound', host, elapsed * 1000, error)
+        with self.lock:
+            stats = self.host_stats.setdefault(host, {
+                'requests': 0,
+                'errors': 0,
+                'total_time_ms': 0.0
+            })
+            stats['requests'] += 1
+            stats['total_time_ms'] += elapsed * 1000
+            if error:
+                stats['errors'] += 1
+
+    def get_stats(self):
+        """إحصائيات الاتصالات وإعادة الاستخدام لكل host"""
+        pools = {}
+        pool_manager = self.adapter.poolmanager
+        for key in list(pool_manager.pools.keys()):
+            pool = pool_manager.pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.host}:{pool.port}" if pool.port else pool.host
+            pools[host] = {
+                'connections_opened': pool.num_connections,
+                'requests_sent': pool.num_requests,
+                # كل طلب لم يحتج اتصالاً جديداً = handshake تم توفيره
+                'connections_reused': max(0, pool.num_requests - pool.num_connections),
+                'idle_connections': pool.pool.qsize() if pool.pool else 0
+            }
+
+        with self.lock:
+            hosts = {}
+            for host, stats in self.host_stats.items():
+                hosts[host] = {
+                    **stats,
+                    'total_time_ms': round(stats['total_time_ms'], 2),
+                    'avg_time_ms': round(stats['total_time_ms'] / stats['requests'], 2) if stats['requests'] else 0
+                }
+
+        total_connections = sum(p['connections_opened'] for p in pools.values())
+        total_requests = sum(p['requests_sent'] for p in pools.values())
+
+        return {
+            'pool_connections': self.pool_connections,
+            'pool_maxsize': self.pool_maxsize,
+            'connections_opened': total_connections,
+            'requests_sent': total_requests,
+            'connections_reused': max(0, total_requests - total_connections),
+            'reuse_ratio': round(1 - total_connections / total_requests, 3) if total_requests else 0,
+            'pools': pools,
+            'hosts': hosts
+        }
+
+    def close(self):
+        self.session.close()
+
+
+# إنشاء instance عام مشترك بين جميع الوزارات
+http_client = OutboundHTTPClient()
+
+
+def get_http_client_stats():
+    return http_client.get_stats()
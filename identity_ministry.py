@@ -8,12 +8,24 @@
 - حفظ وإدارة الهويات بأمان
 - تتبع الجلسات والأنشطة
 - عزل كامل عن الوزارات الأخرى
+- مجمع اتصالات SQLite (WAL) بدلاً من اتصال جديد لكل استعلام
+- تخزين أحداث الجلسات على دفعات من ذاكرة مؤقتة محدودة
+- تنظيف دوري للجلسات المنتهية مع أرشفة مضغوطة
+- جداول تجميع (rollups) تُحدث مع كل جلسة/دفعة أحداث لملخصات فورية
 """
 
+import atexit
+import gzip
 import json
+import os
+import queue
+import random
+import shutil
 import sqlite3
 import threading
 import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
@@ -22,6 +34,9 @@ import hashlib
 import secrets
 from flask import request
 
+from config_env import DATABASE_POOL_SIZE, DATABASE_TIMEOUT
+from system_metrics import timed_write
+
 
 # ============================================================================
 # 🏛️ إعدادات الوزارة الأساسية
@@ -34,69 +49,180 @@ MINISTRY_CONFIG = {
     'TABLE_IDENTITIES': 'silent_identities',
     'TABLE_SESSIONS': 'identity_sessions',
     'TABLE_EVENTS': 'session_events',
+    'TABLE_ROLLUPS': 'identity_rollups',
+    'TABLE_EVENT_ROLLUPS': 'identity_event_rollups',
+    'PAGE_VIEW_EVENTS': ('page_view', 'pageview'),  # أنواع الأحداث التي تُحسب كمشاهدة صفحة
+    'MAX_EVENT_TYPE_LENGTH': 64,
     'MAX_SESSIONS_PER_IDENTITY': 10,
     'SESSION_TIMEOUT': 24 * 60 * 60,  # 24 ساعة
     'CLEANUP_INTERVAL': 6 * 60 * 60,  # 6 ساعات
+    'POOL_SIZE': DATABASE_POOL_SIZE,
+    'DATABASE_TIMEOUT': DATABASE_TIMEOUT,  # ثواني انتظار القفل أو اتصال متاح
+    'STATEMENT_CACHE_SIZE': 256,  # عدد الاستعلامات المحضرة لكل اتصال
+    'EVENT_BATCH_SIZE': int(os.environ.get('IDENTITY_EVENT_BATCH_SIZE', '200')),  # تفريغ فوري عند هذا العدد
+    'EVENT_FLUSH_INTERVAL': float(os.environ.get('IDENTITY_EVENT_FLUSH_INTERVAL', '2')),  # ثواني بين التفريغات
+    'EVENT_BUFFER_MAX': int(os.environ.get('IDENTITY_EVENT_BUFFER_MAX', '10000')),  # حد الذاكرة المؤقتة
+    'EVENT_BACKPRESSURE_WAIT': 0.5,  # ثواني انتظار مساحة قبل رفض الحدث
+    'EVENT_BATCH_MAX_RETRIES': int(os.environ.get('IDENTITY_EVENT_MAX_RETRIES', '5')),  # محاولات الدفعة قبل عزل أحداثها
+    'EVENT_DEAD_LETTER_FILE': 'dead_letter_events.ndjson',  # الأحداث التي تعذرت كتابتها (داخل ARCHIVE_DIR)
+    'EVENT_LOCK_BACKOFF': 0.1,  # ثواني انتظار أول إعادة بعد "database is locked" (تتضاعف)
+    'EVENT_LOCK_BACKOFF_MAX': 5.0,  # أقصى انتظار بين محاولتين بسبب القفل
+    'KNOWN_SESSION_CACHE_SIZE': 10000,  # جلسات تم التأكد من وجودها (لقبول أحداثها بدون استعلام)
+    'KNOWN_SESSION_TTL': 5 * 60,  # إعادة التأكد بعدها - أقل بكثير من SESSION_TIMEOUT
+    'IDENTITY_CACHE_SIZE': int(os.environ.get('IDENTITY_CACHE_SIZE', '10000')),  # بصمة -> هوية في الذاكرة
+    'IDENTITY_TOUCH_INTERVAL': 60 * 60,  # أقل مدة بين تحديثين لـ last_active لنفس الهوية
+    'IDENTITY_RETENTION': int(os.environ.get('IDENTITY_RETENTION', 180 * 24 * 60 * 60)),  # حذف الهويات الخاملة بعدها
+    'CLEANUP_BATCH_SIZE': 500,  # صفوف كل معاملة حذف (أقفال كتابة قصيرة)
+    'CLEANUP_INITIAL_DELAY': 60,  # ثواني قبل أول فحص بعد تشغيل الـ worker
+    'VACUUM_PAGES': 2000,  # صفحات تُعاد للنظام في كل تشغيل
+    # ملف قديم بدون auto_vacuum: VACUUM لمرة واحدة عند التشغيل حتى يعمل incremental_vacuum
+    'VACUUM_MIGRATION': os.environ.get('IDENTITY_VACUUM_MIGRATION', 'true').lower() == 'true',
+    'ARCHIVE_FETCH_SIZE': 1000,  # صفوف الأحداث المقروءة في كل مرة أثناء الأرشفة
+    'ARCHIVE_DIR': os.environ.get('IDENTITY_ARCHIVE_DIR', 'identity_archive'),
     'DEBUG': False
 }
 
 
+# ============================================================================
+# 🔧 ترحيلات المخطط (مرقمة - تُطبق بالترتيب مرة واحدة لكل قاعدة بيانات)
+# ============================================================================
+# الإصدار الحالي محفوظ في PRAGMA user_version
+# ترحيل جديد = إضافة عنصر جديد في نهاية القائمة (لا تعدل ترحيلاً مطبقاً)
+
+SCHEMA_MIGRATIONS = [
+    (1, 'الجداول الأساسية', [
+        f'''
+        CREATE TABLE IF NOT EXISTS {MINISTRY_CONFIG['TABLE_IDENTITIES']} (
+            id TEXT PRIMARY KEY,
+            device_fingerprint TEXT UNIQUE,
+            created_at INTEGER NOT NULL,
+            last_active INTEGER NOT NULL,
+            version TEXT DEFAULT '1.0.0',
+            metadata TEXT,
+            total_sessions INTEGER DEFAULT 0,
+            total_events INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS {MINISTRY_CONFIG['TABLE_SESSIONS']} (
+            id TEXT PRIMARY KEY,
+            identity_id TEXT NOT NULL,
+            start_time INTEGER NOT NULL,
+            last_activity INTEGER NOT NULL,
+            page_views INTEGER DEFAULT 0,
+            events_count INTEGER DEFAULT 0,
+            session_data TEXT,
+            ip_address TEXT,
+            user_agent TEXT,
+            is_active INTEGER DEFAULT 1,
+            FOREIGN KEY (identity_id) REFERENCES {MINISTRY_CONFIG['TABLE_IDENTITIES']} (id)
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS {MINISTRY_CONFIG['TABLE_EVENTS']} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            event_data TEXT,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY (session_id) REFERENCES {MINISTRY_CONFIG['TABLE_SESSIONS']} (id)
+        )
+        ''',
+    ]),
+    (2, 'فهارس البحث بالهوية والتنظيف حسب النشاط', [
+        # جلسات هوية معينة مرتبة بآخر نشاط
+        f'''CREATE INDEX IF NOT EXISTS idx_sessions_identity_activity
+            ON {MINISTRY_CONFIG['TABLE_SESSIONS']} (identity_id, last_activity)''',
+        # تنظيف الجلسات المنتهية
+        f'''CREATE INDEX IF NOT EXISTS idx_sessions_last_activity
+            ON {MINISTRY_CONFIG['TABLE_SESSIONS']} (last_activity)''',
+        # تنظيف الهويات الخاملة
+        f'''CREATE INDEX IF NOT EXISTS idx_identities_last_active
+            ON {MINISTRY_CONFIG['TABLE_IDENTITIES']} (last_active)''',
+        # أحداث جلسة معينة بالترتيب الزمني
+        f'''CREATE INDEX IF NOT EXISTS idx_events_session_created
+            ON {MINISTRY_CONFIG['TABLE_EVENTS']} (session_id, created_at)''',
+        # حذف/أرشفة الأحداث القديمة
+        f'''CREATE INDEX IF NOT EXISTS idx_events_created_at
+            ON {MINISTRY_CONFIG['TABLE_EVENTS']} (created_at)''',
+    ]),
+    (3, 'سجل مهام الصيانة (تشغيل واحد لكل فترة بين جميع الـ workers)', [
+        '''
+        CREATE TABLE IF NOT EXISTS identity_maintenance (
+            task TEXT PRIMARY KEY,
+            last_run_at REAL NOT NULL,
+            last_result TEXT
+        )
+        ''',
+    ]),
+    (4, 'جداول تجميع تحليلات الهوية مع ملئها من البيانات الحالية', [
+        f'''
+        CREATE TABLE IF NOT EXISTS {MINISTRY_CONFIG['TABLE_ROLLUPS']} (
+            identity_id TEXT PRIMARY KEY,
+            sessions_total INTEGER NOT NULL DEFAULT 0,
+            page_views INTEGER NOT NULL DEFAULT 0,
+            events_total INTEGER NOT NULL DEFAULT 0,
+            first_seen INTEGER,
+            last_seen INTEGER
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS {MINISTRY_CONFIG['TABLE_EVENT_ROLLUPS']} (
+            identity_id TEXT NOT NULL,
+            event_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (identity_id, event_type)
+        ) WITHOUT ROWID
+        ''',
+        f'''
+        INSERT OR IGNORE INTO {MINISTRY_CONFIG['TABLE_ROLLUPS']}
+        SELECT identity_id, COUNT(*), SUM(page_views), SUM(events_count), MIN(start_time), MAX(last_activity)
+        FROM {MINISTRY_CONFIG['TABLE_SESSIONS']} GROUP BY identity_id
+        ''',
+        f'''
+        INSERT OR IGNORE INTO {MINISTRY_CONFIG['TABLE_EVENT_ROLLUPS']}
+        SELECT s.identity_id, e.event_type, COUNT(*)
+        FROM {MINISTRY_CONFIG['TABLE_EVENTS']} e
+        JOIN {MINISTRY_CONFIG['TABLE_SESSIONS']} s ON s.id = e.session_id
+        GROUP BY s.identity_id, e.event_type
+        ''',
+    ]),
+]
+
+
 # ============================================================================
 # 🗄️ مدير قاعدة البيانات المتخصص
 # ============================================================================
 
 class IdentityDatabaseManager:
-    """مدير قاعدة بيانات الهويات مع thread safety"""
+    """مدير قاعدة بيانات الهويات مع مجمع اتصالات آمن بين الخيوط"""
     
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, pool_size: int = None, timeout: int = None):
         self.db_path = db_path or MINISTRY_CONFIG['DATABASE']
+        self.pool_size = pool_size or MINISTRY_CONFIG['POOL_SIZE']
+        self.timeout = timeout or MINISTRY_CONFIG['DATABASE_TIMEOUT']
         self.lock = threading.RLock()
         self.initialized = False
         
+        # 🏊 مجمع الاتصالات (LIFO لإعادة استخدام أحدث اتصال مع ذاكرته المؤقتة)
+        self.pool = queue.LifoQueue(maxsize=self.pool_size)
+        self.pool_pid = os.getpid()
+        self.connections_created = 0
+        self.checkouts = 0
+        self.waits = 0
+        
     def init_database(self) -> bool:
         """تهيئة قاعدة البيانات وإنشاء الجداول المطلوبة"""
         if self.initialized:
             return True
             
         try:
-            with self.lock:
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-                
-                # جدول الهويات الصامتة
-                cursor.execute(f'''
-                    CREATE TABLE IF NOT EXISTS {MINISTRY_CONFIG['TABLE_IDENTITIES']} (
-                        id TEXT PRIMARY KEY,
-                        device_fingerprint TEXT UNIQUE,
-                        created_at INTEGER NOT NULL,
-                        last_active INTEGER NOT NULL,
-                        version TEXT DEFAULT '1.0.0',
-                        metadata TEXT,
-                        total_sessions INTEGER DEFAULT 0,
-                        total_events INTEGER DEFAULT 0,
-                        is_active INTEGER DEFAULT 1
-                    )
-                ''')
-                
-                # جدول الجلسات
-                cursor.execute(f'''
-                    CREATE TABLE IF NOT EXISTS {MINISTRY_CONFIG['TABLE_SESSIONS']} (
-                        id TEXT PRIMARY KEY,
-                        identity_id TEXT NOT NULL,
-                        start_time INTEGER NOT NULL,
-                        last_activity INTEGER NOT NULL,
-                        page_views INTEGER DEFAULT 0,
-                        events_count INTEGER DEFAULT 0,
-                        session_data TEXT,
-                        ip_address TEXT,
-                        user_agent TEXT,
-                        is_active INTEGER DEFAULT 1,
-                        FOREIGN KEY (identity_id) REFERENCES {MINISTRY_CONFIG['TABLE_IDENTITIES']} (id)
-                    )
-                ''')
-                
-                conn.commit()
-                conn.close()
+            with self.lock, self.connection() as conn:
+                applied = self.run_migrations(conn)
+                if applied:
+                    self.log(f"🔧 تم تطبيق {len(applied)} ترحيل: {applied}")
+                self.enable_incremental_vacuum(conn)
                 
                 self.initialized = True
                 self.log("✅ قاعدة بيانات الهويات جاهزة")
@@ -106,19 +232,142 @@ class IdentityDatabaseManager:
             self.log(f"❌ خطأ في تهيئة قاعدة البيانات: {error}")
             return False
     
+    def get_schema_version(self, conn: sqlite3.Connection) -> int:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    
+    def run_migrations(self, conn: sqlite3.Connection) -> List[int]:
+        """تطبيق الترحيلات الناقصة بالترتيب - كل ترحيل في معاملة مستقلة"""
+        applied = []
+        for version, description, statements in SCHEMA_MIGRATIONS:
+            if self.get_schema_version(conn) >= version:
+                continue
+            
+            # BEGIN IMMEDIATE يمنع workerين من تطبيق نفس الترحيل معاً
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.get_schema_version(conn) < version:
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute(f'PRAGMA user_version = {int(version)}')
+                    applied.append(version)
+                    self.log(f"🔧 ترحيل {version}: {description}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        
+        if applied:
+            # تحديث إحصائيات المُخطِط بعد إضافة الفهارس
+            conn.execute('PRAGMA optimize')
+        return applied
+    
+    def enable_incremental_vacuum(self, conn: sqlite3.Connection) -> bool:
+        """تحويل ملف قديم (auto_vacuum = NONE) مرة واحدة - بدونه incremental_vacuum لا يفعل شيئاً"""
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 0:
+            return False
+        if not MINISTRY_CONFIG['VACUUM_MIGRATION']:
+            self.log("⚠️ auto_vacuum غير مفعل - الصفحات المحذوفة لن تُعاد للنظام (IDENTITY_VACUUM_MIGRATION=false)")
+            return False
+        
+        # VACUUM يعيد كتابة الملف بالكامل (قفل حصري) - مرة واحدة فقط لكل قاعدة بيانات
+        self.log("🔧 تحويل قاعدة الهويات إلى auto_vacuum=INCREMENTAL (VACUUM لمرة واحدة)")
+        started = time.perf_counter()
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        self.log(f"✅ تم التحويل في {time.perf_counter() - started:.1f} ثانية")
+        return True
+    
+    def explain_query_plan(self, query: str, params: tuple = ()) -> List[str]:
+        """خطة تنفيذ الاستعلام (للتحقق من استخدام الفهارس)"""
+        with self.connection() as conn:
+            return [row['detail'] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+    
     def get_connection(self) -> sqlite3.Connection:
-        """الحصول على اتصال آمن بقاعدة البيانات"""
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        """إنشاء اتصال جديد مُعد للعمل المتزامن (WAL + busy timeout + استعلامات محضرة)"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=MINISTRY_CONFIG['STATEMENT_CACHE_SIZE']
+        )
         conn.row_factory = sqlite3.Row
+        # يؤثر فقط على ملف جديد (قبل كتابة أول صفحة) - الملفات القديمة تُحول في enable_incremental_vacuum
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
         return conn
     
+    def _reset_pool_after_fork(self):
+        """اتصالات SQLite لا تُشارك بعد fork - كل worker يبدأ مجمعاً جديداً"""
+        if self.pool_pid != os.getpid():
+            with self.lock:
+                if self.pool_pid != os.getpid():
+                    self.pool = queue.LifoQueue(maxsize=self.pool_size)
+                    self.connections_created = 0
+                    self.pool_pid = os.getpid()
+    
+    def acquire_connection(self) -> sqlite3.Connection:
+        """استعارة اتصال من المجمع (أو إنشاء اتصال إذا لم يكتمل المجمع)"""
+        self._reset_pool_after_fork()
+        self.checkouts += 1
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self.lock:
+            if self.connections_created < self.pool_size:
+                self.connections_created += 1
+                create = True
+            else:
+                create = False
+        
+        if create:
+            try:
+                return self.get_connection()
+            except Exception:
+                with self.lock:
+                    self.connections_created -= 1
+                raise
+        
+        # المجمع ممتلئ - انتظار إعادة اتصال
+        self.waits += 1
+        try:
+            return self.pool.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"لا يوجد اتصال متاح في المجمع بعد {self.timeout} ثانية")
+    
+    def release_connection(self, conn: sqlite3.Connection):
+        """إرجاع الاتصال للمجمع بعد إلغاء أي معاملة مفتوحة"""
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+    
+    @contextmanager
+    def connection(self):
+        """استخدام اتصال من المجمع داخل with"""
+        conn = self.acquire_connection()
+        try:
+            yield conn
+        finally:
+            self.release_connection(conn)
+    
+    @contextmanager
+    def write_connection(self):
+        """اتصال من المجمع لمعاملة كتابة - زمنها يُسجل في مقاييس SQLite"""
+        with timed_write(self.db_path):
+            with self.connection() as conn:
+                yield conn
+    
     def execute_query(self, query: str, params: tuple = (), fetch_one: bool = False, fetch_all: bool = False) -> any:
         """تنفيذ استعلام مع حماية من SQL injection"""
         try:
-            with self.lock:
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                cursor.execute(query, params)
+            with (self.connection() if fetch_one or fetch_all else self.write_connection()) as conn:
+                cursor = conn.execute(query, params)
                 
                 if fetch_one:
                     result = cursor.fetchone()
@@ -128,19 +377,569 @@ class IdentityDatabaseManager:
                     result = cursor.rowcount
                 
                 conn.commit()
-                conn.close()
                 return result
                 
         except Exception as error:
             self.log(f"❌ خطأ في تنفيذ الاستعلام: {error}")
             return None
     
+    def get_pool_stats(self) -> dict:
+        """إحصائيات مجمع الاتصالات"""
+        return {
+            'pool_size': self.pool_size,
+            'connections_created': self.connections_created,
+            'idle_connections': self.pool.qsize(),
+            'checkouts': self.checkouts,
+            'waits': self.waits
+        }
+    
+    def close_all(self):
+        """إغلاق جميع الاتصالات الخاملة في المجمع"""
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.connections_created -= 1
+    
     def log(self, message: str):
         """سجل الأحداث"""
         if MINISTRY_CONFIG['DEBUG']:
             print(f"🏛️ {MINISTRY_CONFIG['NAME']}: {message}")
 
 
+# ============================================================================
+# 📥 ذاكرة الأحداث المؤقتة (تخزين على دفعات)
+# ============================================================================
+
+class SessionEventBuffer:
+    """تجميع أحداث الجلسات في الذاكرة وكتابتها على دفعات في معاملة واحدة"""
+    
+    def __init__(self, db_manager: IdentityDatabaseManager, batch_size: int = None,
+                 flush_interval: float = None, max_buffered: int = None):
+        self.db_manager = db_manager
+        self.batch_size = batch_size or MINISTRY_CONFIG['EVENT_BATCH_SIZE']
+        self.flush_interval = flush_interval or MINISTRY_CONFIG['EVENT_FLUSH_INTERVAL']
+        self.max_buffered = max_buffered or MINISTRY_CONFIG['EVENT_BUFFER_MAX']
+        self.max_retries = MINISTRY_CONFIG['EVENT_BATCH_MAX_RETRIES']
+        self.dead_letter_path = os.path.join(MINISTRY_CONFIG['ARCHIVE_DIR'], MINISTRY_CONFIG['EVENT_DEAD_LETTER_FILE'])
+        
+        self.events = deque()
+        # دفعة فشلت كتابتها تنتظر إعادة المحاولة (خارج الذاكرة المؤقتة - دفعة واحدة بحد أقصى)
+        self.retry_batch = None
+        self.retry_attempts = 0
+        # القفل المؤقت لا يُحسب من المحاولات - انتظار متزايد قبل المحاولة التالية
+        self.lock_failures = 0
+        self.retry_not_before = 0.0
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.flusher_pid = None
+        
+        # 📊 إحصائيات
+        self.accepted = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.dead_lettered = 0
+        self.lock_retries = 0
+        self.last_flush_ms = 0.0
+    
+    @staticmethod
+    def is_lock_error(error: Exception) -> bool:
+        """خطأ مؤقت بسبب كتابة أخرى (database is locked / busy) - ليس حدثاً سيئاً"""
+        message = str(error).lower()
+        return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+    
+    def _defer_for_lock(self, batch: list, error: Exception):
+        """إبقاء الدفعة بدون زيادة المحاولات وتأجيلها (0.1، 0.2، 0.4... حتى EVENT_LOCK_BACKOFF_MAX)"""
+        delay = min(MINISTRY_CONFIG['EVENT_LOCK_BACKOFF'] * 2 ** self.lock_failures,
+                    MINISTRY_CONFIG['EVENT_LOCK_BACKOFF_MAX'])
+        self.lock_failures += 1
+        self.lock_retries += 1
+        self.retry_batch = batch
+        self.retry_not_before = time.monotonic() + delay
+        self.db_manager.log(f"⏳ قاعدة الأحداث مقفلة - إعادة المحاولة بعد {delay:.1f} ثانية: {error}")
+    
+    def add(self, session_id: str, event_type: str, event_data: dict = None) -> bool:
+        """إضافة حدث - يرجع False إذا بقيت الذاكرة ممتلئة (backpressure)"""
+        event = (session_id, event_type, json.dumps(event_data or {}), int(time.time()))
+        self._ensure_flusher()
+        
+        with self.condition:
+            if len(self.events) >= self.max_buffered:
+                # إيقاظ خيط التفريغ ثم انتظار مساحة لفترة قصيرة
+                self.condition.notify_all()
+                self.condition.wait_for(
+                    lambda: len(self.events) < self.max_buffered,
+                    timeout=MINISTRY_CONFIG['EVENT_BACKPRESSURE_WAIT']
+                )
+                if len(self.events) >= self.max_buffered:
+                    self.rejected += 1
+                    return False
+            
+            self.events.append(event)
+            self.accepted += 1
+            if len(self.events) >= self.batch_size:
+                self.condition.notify_all()
+        return True
+    
+    def flush(self, force: bool = False) -> int:
+        """كتابة الأحداث المتراكمة (دفعة تلو الأخرى) - يرجع عدد الأحداث المكتوبة
+
+        force يتجاهل انتظار القفل (عند إيقاف العملية)
+        """
+        written = 0
+        with self.flush_lock:
+            while True:
+                batch = self.retry_batch
+                if batch is not None and not force and time.monotonic() < self.retry_not_before:
+                    break
+                if batch is None:
+                    with self.condition:
+                        batch = [self.events.popleft() for _ in range(min(self.batch_size, len(self.events)))]
+                if not batch:
+                    break
+                
+                try:
+                    self._write_batch(batch)
+                except Exception as error:
+                    if self.is_lock_error(error):
+                        self._defer_for_lock(batch, error)
+                        if force:
+                            break
+                        continue
+                    self.failed_batches += 1
+                    attempts = self.retry_attempts + 1 if self.retry_batch is not None else 1
+                    self.db_manager.log(f"❌ خطأ في كتابة دفعة الأحداث (محاولة {attempts}): {error}")
+                    if attempts < self.max_retries:
+                        # محاولة لاحقة في التفريغ التالي
+                        self.retry_batch, self.retry_attempts = batch, attempts
+                        break
+                    
+                    # الدفعة فشلت كل المحاولات: كتابة كل حدث وحده وعزل الأحداث الفاشلة فقط
+                    self.retry_batch, self.retry_attempts = None, 0
+                    written += self._write_individually(batch)
+                    continue
+                
+                self.retry_batch, self.retry_attempts = None, 0
+                self.lock_failures = 0
+                written += len(batch)
+                with self.condition:
+                    # إبلاغ المنتظرين بتوفر مساحة
+                    self.condition.notify_all()
+        return written
+    
+    def pending_session_ids(self) -> set:
+        """الجلسات التي لها أحداث لم تُكتب بعد (في الذاكرة أو في دفعة تنتظر إعادة المحاولة)"""
+        with self.condition:
+            pending = {event[0] for event in self.events}
+        pending.update(event[0] for event in self.retry_batch or ())
+        return pending
+    
+    def _write_individually(self, batch: list) -> int:
+        """كتابة أحداث دفعة فاشلة واحداً واحداً - الحدث الذي يفشل يُنقل لملف الأحداث المعزولة"""
+        written = 0
+        for index, event in enumerate(batch):
+            try:
+                self._write_batch([event])
+                written += 1
+            except Exception as error:
+                if self.is_lock_error(error):
+                    # بقية الدفعة تنتظر - وفشلها التالي يعيدها لهذه الكتابة الفردية مباشرة
+                    self.retry_attempts = self.max_retries - 1
+                    self._defer_for_lock(batch[index:], error)
+                    return written
+                self._dead_letter(event, error)
+        return written
+    
+    def _dead_letter(self, event: tuple, error: Exception):
+        """حفظ حدث تعذرت كتابته في ملف NDJSON (لإعادة إدخاله يدوياً) بدلاً من حجز الذاكرة"""
+        self.dead_lettered += 1
+        session_id, event_type, event_data, created_at = event
+        try:
+            os.makedirs(os.path.dirname(self.dead_letter_path) or '.', exist_ok=True)
+            with open(self.dead_letter_path, 'a', encoding='utf-8') as dead_letter:
+                dead_letter.write(json.dumps({
+                    'session_id': session_id,
+                    'event_type': event_type,
+                    'event_data': event_data,
+                    'created_at': created_at,
+                    'error': str(error)
+                }, ensure_ascii=False) + '\n')
+        except OSError as write_error:
+            self.db_manager.log(f"❌ تعذر حفظ الحدث المعزول ({write_error}) - تم إسقاطه: {event}")
+    
+    def _write_batch(self, batch: list):
+        """إدراج الدفعة وتحديث العدادات في معاملة واحدة"""
+        started = time.perf_counter()
+        
+        # تجميع العدادات لكل جلسة ولكل نوع حدث: استعلام واحد لكل مجموعة بدلاً من كل حدث
+        per_session = {}
+        per_type = {}
+        for session_id, event_type, _, created_at in batch:
+            count, page_views, last_time = per_session.get(session_id, (0, 0, 0))
+            is_page_view = event_type in MINISTRY_CONFIG['PAGE_VIEW_EVENTS']
+            per_session[session_id] = (count + 1, page_views + is_page_view, max(last_time, created_at))
+            per_type[(session_id, event_type)] = per_type.get((session_id, event_type), 0) + 1
+        
+        session_rows = [
+            (count, page_views, last_time, session_id)
+            for session_id, (count, page_views, last_time) in per_session.items()
+        ]
+        sessions_table = MINISTRY_CONFIG['TABLE_SESSIONS']
+        
+        with self.db_manager.write_connection() as conn:
+            with conn:
+                conn.executemany(
+                    f'''INSERT INTO {MINISTRY_CONFIG['TABLE_EVENTS']}
+                       (session_id, event_type, event_data, created_at)
+                       VALUES (?, ?, ?, ?)''',
+                    batch
+                )
+                conn.executemany(
+                    f'''UPDATE {sessions_table}
+                       SET events_count = events_count + ?, page_views = page_views + ?,
+                           last_activity = MAX(last_activity, ?)
+                       WHERE id = ?''',
+                    session_rows
+                )
+                conn.executemany(
+                    f'''UPDATE {MINISTRY_CONFIG['TABLE_IDENTITIES']}
+                       SET total_events = total_events + ?, last_active = MAX(last_active, ?)
+                       WHERE id = (SELECT identity_id FROM {sessions_table} WHERE id = ?)''',
+                    [(count, last_time, session_id) for count, _, last_time, session_id in session_rows]
+                )
+                # 📈 جداول التجميع
+                conn.executemany(
+                    f'''INSERT INTO {MINISTRY_CONFIG['TABLE_ROLLUPS']}
+                       (identity_id, events_total, page_views, first_seen, last_seen)
+                       SELECT identity_id, ?, ?, ?, ? FROM {sessions_table} WHERE id = ?
+                       ON CONFLICT(identity_id) DO UPDATE SET
+                           events_total = events_total + excluded.events_total,
+                           page_views = page_views + excluded.page_views,
+                           last_seen = MAX(last_seen, excluded.last_seen)''',
+                    [(count, page_views, last_time, last_time, session_id)
+                     for count, page_views, last_time, session_id in session_rows]
+                )
+                conn.executemany(
+                    f'''INSERT INTO {MINISTRY_CONFIG['TABLE_EVENT_ROLLUPS']} (identity_id, event_type, count)
+                       SELECT identity_id, ?, ? FROM {sessions_table} WHERE id = ?
+                       ON CONFLICT(identity_id, event_type) DO UPDATE SET count = count + excluded.count''',
+                    [(event_type, count, session_id) for (session_id, event_type), count in per_type.items()]
+                )
+        
+        self.flushed += len(batch)
+        self.batches += 1
+        self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+    
+    def _ensure_flusher(self):
+        """تشغيل خيط التفريغ مرة واحدة لكل عملية (آمن بعد fork)"""
+        if self.flusher_pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.flusher_pid == os.getpid():
+                return
+            self.flusher_pid = os.getpid()
+            threading.Thread(target=self._flusher_loop, name='identity-event-flusher', daemon=True).start()
+            # عدم فقدان الأحداث المتبقية عند إيقاف الـ worker
+            atexit.register(self.flush, True)
+    
+    def _flusher_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: len(self.events) >= self.batch_size,
+                    timeout=self.flush_interval
+                )
+            try:
+                self.flush()
+            except Exception as error:
+                self.db_manager.log(f"❌ خطأ في خيط تفريغ الأحداث: {error}")
+    
+    def get_stats(self) -> dict:
+        return {
+            'buffered': len(self.events) + len(self.retry_batch or ()),
+            'max_buffered': self.max_buffered,
+            'batch_size': self.batch_size,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'flushed': self.flushed,
+            'batches': self.batches,
+            'failed_batches': self.failed_batches,
+            'dead_lettered': self.dead_lettered,
+            'lock_retries': self.lock_retries,
+            'last_flush_ms': self.last_flush_ms
+        }
+
+
+# ============================================================================
+# 🧹 التنظيف الدوري للجلسات والهويات
+# ============================================================================
+
+class CleanupArchive:
+    """أرشيف NDJSON مضغوط لتشغيل تنظيف واحد
+
+    كل دفعة تُكتب أثناء معاملتها في ملف مؤقت ثم تُضم لنهاية الأرشيف بعد نجاح الحذف
+    (gzip متعدد الأجزاء) - المعاملة الفاشلة لا تترك شيئاً في الأرشيف
+    """
+    
+    def __init__(self, archive_dir: str, started_at: int):
+        self.archive_dir = archive_dir
+        self.path = os.path.join(
+            archive_dir, f"identity_archive_{datetime.fromtimestamp(started_at):%Y%m%d_%H%M%S}.ndjson.gz"
+        )
+        self.rows = 0
+    
+    @contextmanager
+    def batch(self):
+        """يعطي write(table, rows) - الدفعة تُضم للأرشيف فقط إذا خرج الـ with بدون خطأ"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        pending_path = f"{self.path}.{os.getpid()}.pending"
+        pending = gzip.open(pending_path, 'wt', encoding='utf-8')
+        written = 0
+        
+        def write(table, rows):
+            nonlocal written
+            for row in rows:
+                pending.write(json.dumps({'table': table, 'row': dict(row)}, ensure_ascii=False) + '\n')
+                written += 1
+        
+        try:
+            yield write
+            pending.close()
+            if written:
+                with open(pending_path, 'rb') as source, open(self.path, 'ab') as target:
+                    shutil.copyfileobj(source, target)
+                self.rows += written
+        finally:
+            pending.close()
+            os.remove(pending_path)
+    
+    @property
+    def file(self) -> Optional[str]:
+        return self.path if self.rows else None
+
+
+class IdentityCleanupScheduler:
+    """حذف الجلسات المنتهية والزائدة والهويات الخاملة على دفعات مع أرشفة مضغوطة"""
+    
+    TASK_NAME = 'identity_cleanup'
+    
+    def __init__(self, db_manager: IdentityDatabaseManager, interval: int = None,
+                 batch_size: int = None, archive_dir: str = None,
+                 event_buffer: Optional[SessionEventBuffer] = None):
+        self.db_manager = db_manager
+        self.event_buffer = event_buffer
+        self.interval = interval or MINISTRY_CONFIG['CLEANUP_INTERVAL']
+        self.batch_size = batch_size or MINISTRY_CONFIG['CLEANUP_BATCH_SIZE']
+        self.archive_dir = archive_dir or MINISTRY_CONFIG['ARCHIVE_DIR']
+        
+        self.start_lock = threading.Lock()
+        self.started_pid = None
+        
+        # 📊 إحصائيات
+        self.runs = 0
+        self.rows_reclaimed_total = 0
+        self.sessions_skipped_pending = 0
+        self.last_result = None
+    
+    def start(self):
+        """تشغيل خيط الجدولة مرة واحدة لكل عملية"""
+        if self.started_pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.started_pid == os.getpid():
+                return
+            self.started_pid = os.getpid()
+            threading.Thread(target=self._scheduler_loop, name='identity-cleanup', daemon=True).start()
+    
+    def _scheduler_loop(self):
+        # تأخير عشوائي حتى لا تتسابق الـ workers عند التشغيل
+        time.sleep(MINISTRY_CONFIG['CLEANUP_INITIAL_DELAY'] * random.uniform(1, 2))
+        while True:
+            try:
+                self.run_if_due()
+            except Exception as error:
+                self.db_manager.log(f"❌ خطأ في التنظيف الدوري: {error}")
+            time.sleep(min(self.interval, 15 * 60) * random.uniform(0.8, 1.2))
+    
+    def claim_run(self) -> bool:
+        """حجز التشغيل لهذه الفترة - worker واحد فقط ينجح"""
+        now = time.time()
+        with self.db_manager.write_connection() as conn:
+            with conn:
+                conn.execute(
+                    'INSERT OR IGNORE INTO identity_maintenance (task, last_run_at) VALUES (?, 0)',
+                    (self.TASK_NAME,)
+                )
+                return conn.execute(
+                    'UPDATE identity_maintenance SET last_run_at = ? WHERE task = ? AND last_run_at <= ?',
+                    (now, self.TASK_NAME, now - self.interval)
+                ).rowcount == 1
+    
+    def run_if_due(self) -> Optional[dict]:
+        if not self.claim_run():
+            return None
+        return self.run_cleanup()
+    
+    def run_cleanup(self, now: int = None) -> dict:
+        """تشغيل كامل: الجلسات المنتهية، حد الجلسات لكل هوية، الهويات الخاملة، ثم الصيانة"""
+        started = time.perf_counter()
+        now = int(now or time.time())
+        sessions_table = MINISTRY_CONFIG['TABLE_SESSIONS']
+        identities_table = MINISTRY_CONFIG['TABLE_IDENTITIES']
+        
+        archive = CleanupArchive(self.archive_dir, now)
+        result = {
+            'sessions_expired': 0,
+            'sessions_over_cap': 0,
+            'identities_removed': 0,
+            'events_removed': 0,
+            'sessions_skipped_pending': 0
+        }
+        
+        # كتابة أحداث الذاكرة أولاً حتى لا تُكتب بعد حذف جلستها (أحداث يتيمة)
+        if self.event_buffer is not None:
+            self.event_buffer.flush()
+        
+        # 1️⃣ الجلسات الخاملة أكثر من SESSION_TIMEOUT
+        session_cutoff = now - MINISTRY_CONFIG['SESSION_TIMEOUT']
+        while True:
+            removed, events, skipped = self._remove_sessions(
+                f'SELECT * FROM {sessions_table} WHERE last_activity < ? ORDER BY last_activity LIMIT ? OFFSET ?',
+                (session_cutoff, self.batch_size, result['sessions_skipped_pending']),
+                archive
+            )
+            result['sessions_expired'] += removed
+            result['events_removed'] += events
+            result['sessions_skipped_pending'] += skipped
+            if removed + skipped < self.batch_size:
+                break
+        
+        # 2️⃣ الجلسات الزائدة عن MAX_SESSIONS_PER_IDENTITY (الاحتفاظ بالأحدث)
+        cap = MINISTRY_CONFIG['MAX_SESSIONS_PER_IDENTITY']
+        over_cap = [row[0] for row in self.db_manager.execute_query(
+            f'SELECT identity_id FROM {sessions_table} GROUP BY identity_id HAVING COUNT(*) > ?',
+            (cap,), fetch_all=True
+        ) or []]
+        for identity_id in over_cap:
+            removed, events, skipped = self._remove_sessions(
+                f'''SELECT * FROM {sessions_table} WHERE identity_id = ?
+                   ORDER BY last_activity DESC LIMIT -1 OFFSET ?''',
+                (identity_id, cap),
+                archive
+            )
+            result['sessions_over_cap'] += removed
+            result['events_removed'] += events
+            result['sessions_skipped_pending'] += skipped
+        
+        # 3️⃣ الهويات الخاملة بدون جلسات متبقية
+        identity_cutoff = now - MINISTRY_CONFIG['IDENTITY_RETENTION']
+        while True:
+            with archive.batch() as archive_rows, self.db_manager.write_connection() as conn:
+                with conn:
+                    rows = conn.execute(
+                        f'''SELECT * FROM {identities_table} i WHERE last_active < ?
+                           AND NOT EXISTS (SELECT 1 FROM {sessions_table} s WHERE s.identity_id = i.id)
+                           LIMIT ?''',
+                        (identity_cutoff, self.batch_size)
+                    ).fetchall()
+                    if rows:
+                        identity_ids = [(row['id'],) for row in rows]
+                        conn.executemany(f'DELETE FROM {identities_table} WHERE id = ?', identity_ids)
+                        # التجميعات تبقى بعد حذف الجلسات (إجماليات تاريخية) وتُحذف مع الهوية
+                        conn.executemany(
+                            f"DELETE FROM {MINISTRY_CONFIG['TABLE_ROLLUPS']} WHERE identity_id = ?",
+                            identity_ids
+                        )
+                        conn.executemany(
+                            f"DELETE FROM {MINISTRY_CONFIG['TABLE_EVENT_ROLLUPS']} WHERE identity_id = ?",
+                            identity_ids
+                        )
+                        archive_rows(identities_table, rows)
+            result['identities_removed'] += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        
+        result.update(self._run_maintenance())
+        result['rows_reclaimed'] = (result['sessions_expired'] + result['sessions_over_cap'] +
+                                    result['identities_removed'] + result['events_removed'])
+        result['archive_file'] = archive.file
+        result['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        result['finished_at'] = now
+        
+        self.runs += 1
+        self.rows_reclaimed_total += result['rows_reclaimed']
+        self.sessions_skipped_pending += result['sessions_skipped_pending']
+        self.last_result = result
+        self.db_manager.execute_query(
+            'UPDATE identity_maintenance SET last_result = ? WHERE task = ?',
+            (json.dumps(result), self.TASK_NAME)
+        )
+        self.db_manager.log(f"🧹 التنظيف الدوري: {result}")
+        return result
+    
+    def _remove_sessions(self, select_query: str, params: tuple, archive: CleanupArchive) -> Tuple[int, int, int]:
+        """حذف دفعة جلسات مع أحداثها في معاملة قصيرة - يرجع (الجلسات, الأحداث, المتخطاة)
+
+        الأحداث تُقرأ بـ fetchmany إلى ملف الدفعة المؤقت - لا تُحمّل كلها في الذاكرة
+        """
+        sessions_table = MINISTRY_CONFIG['TABLE_SESSIONS']
+        events_table = MINISTRY_CONFIG['TABLE_EVENTS']
+        pending = self.event_buffer.pending_session_ids() if self.event_buffer is not None else set()
+        
+        with archive.batch() as archive_rows, self.db_manager.write_connection() as conn:
+            with conn:
+                selected = conn.execute(select_query, params).fetchall()
+                # الجلسات التي لها أحداث لم تُكتب بعد تنتظر التشغيل القادم
+                sessions = [row for row in selected if row['id'] not in pending]
+                skipped = len(selected) - len(sessions)
+                if not sessions:
+                    return 0, 0, skipped
+                
+                archive_rows(sessions_table, sessions)
+                session_ids = [(row['id'],) for row in sessions]
+                placeholders = ','.join('?' * len(session_ids))
+                cursor = conn.execute(
+                    f'SELECT * FROM {events_table} WHERE session_id IN ({placeholders})',
+                    [sid for (sid,) in session_ids]
+                )
+                events = 0
+                while True:
+                    rows = cursor.fetchmany(MINISTRY_CONFIG['ARCHIVE_FETCH_SIZE'])
+                    if not rows:
+                        break
+                    archive_rows(events_table, rows)
+                    events += len(rows)
+                
+                conn.executemany(f'DELETE FROM {events_table} WHERE session_id = ?', session_ids)
+                conn.executemany(f'DELETE FROM {sessions_table} WHERE id = ?', session_ids)
+        
+        return len(sessions), events, skipped
+    
+    def _run_maintenance(self) -> dict:
+        """تحديث إحصائيات المُخطِط وإعادة جزء من الصفحات الفارغة للنظام"""
+        with self.db_manager.write_connection() as conn:
+            free_before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            conn.execute(f"PRAGMA incremental_vacuum({MINISTRY_CONFIG['VACUUM_PAGES']})").fetchall()
+            free_after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            conn.execute('PRAGMA optimize')
+        return {'pages_freed': max(0, free_before - free_after)}
+    
+    def get_stats(self) -> dict:
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'rows_reclaimed_total': self.rows_reclaimed_total,
+            'sessions_skipped_pending': self.sessions_skipped_pending,
+            'last_result': self.last_result,
+            'running': self.started_pid == os.getpid()
+        }
+
+
 # ============================================================================
 # 🏛️ وزارة الهوية الرئيسية
 # ============================================================================
@@ -150,8 +949,20 @@ class IdentityMinistry:
     
     def __init__(self, db_path: str = None):
         self.db_manager = IdentityDatabaseManager(db_path)
+        self.event_buffer = SessionEventBuffer(self.db_manager)
+        self.cleanup_scheduler = IdentityCleanupScheduler(self.db_manager, event_buffer=self.event_buffer)
         self.initialized = False
         
+        # 🧠 LRU: بصمة الجهاز -> {id, created_at, last_active} لتجنب الكتابة للزوار العائدين
+        self.identity_cache = OrderedDict()
+        self.identity_cache_lock = threading.Lock()
+        self.identity_cache_hits = 0
+        self.identity_cache_misses = 0
+        
+        # 🧠 LRU: جلسة -> وقت التأكد من وجودها (أحداث الجلسات غير الموجودة تُرفض قبل الذاكرة المؤقتة)
+        self.known_sessions = OrderedDict()
+        self.known_sessions_lock = threading.Lock()
+        
     def initialize(self) -> bool:
         """تهيئة الوزارة"""
         if self.initialized:
@@ -162,6 +973,9 @@ class IdentityMinistry:
             if not self.db_manager.init_database():
                 return False
             
+            # 🧹 تطبيق SESSION_TIMEOUT و MAX_SESSIONS_PER_IDENTITY في الخلفية
+            self.cleanup_scheduler.start()
+            
             self.initialized = True
             self.db_manager.log("🏛️ وزارة الهوية جاهزة للعمل")
             return True
@@ -171,43 +985,39 @@ class IdentityMinistry:
             return False
     
     def process_identity_request(self, device_fingerprint: str, metadata: dict = None) -> dict:
-        """معالجة طلب هوية (إنشاء أو استرجاع)"""
+        """معالجة طلب هوية (إنشاء أو استرجاع حسب بصمة الجهاز)"""
         try:
-            # إنشاء هوية جديدة دائماً للتبسيط
-            identity_id = self.generate_unique_id()
-            current_time = int(time.time())
-            
-            # تحضير البيانات
-            metadata_json = json.dumps(metadata or {})
-            
-            # حفظ في قاعدة البيانات
-            query = f'''
-                INSERT INTO {MINISTRY_CONFIG['TABLE_IDENTITIES']} 
-                (id, device_fingerprint, created_at, last_active, metadata, version)
-                VALUES (?, ?, ?, ?, ?, ?)
-            '''
+            if not device_fingerprint:
+                return {
+                    'success': False,
+                    'error': 'بصمة الجهاز مطلوبة'
+                }
             
-            result = self.db_manager.execute_query(
-                query, 
-                (identity_id, device_fingerprint, current_time, current_time, metadata_json, MINISTRY_CONFIG['VERSION'])
-            )
+            current_time = int(time.time())
             
-            if result is not None:
+            # الزائر العائد: من الذاكرة بدون أي كتابة (إلا إذا حان تحديث last_active)
+            cached = self.get_cached_identity(device_fingerprint)
+            if cached and current_time - cached['last_active'] < MINISTRY_CONFIG['IDENTITY_TOUCH_INTERVAL']:
                 return {
                     'success': True,
-                    'action': 'created',
-                    'identity': {
-                        'id': identity_id,
-                        'created_at': current_time,
-                        'last_active': current_time
-                    }
+                    'action': 'restored',
+                    'identity': dict(cached)
                 }
-            else:
+            
+            identity, created = self.upsert_identity(device_fingerprint, metadata, current_time)
+            if identity is None:
                 return {
                     'success': False,
                     'error': 'فشل في إنشاء الهوية'
                 }
             
+            self.cache_identity(device_fingerprint, identity)
+            return {
+                'success': True,
+                'action': 'created' if created else 'restored',
+                'identity': dict(identity)
+            }
+            
         except Exception as error:
             self.db_manager.log(f"❌ خطأ في معالجة طلب الهوية: {error}")
             return {
@@ -215,6 +1025,56 @@ class IdentityMinistry:
                 'error': str(error)
             }
     
+    def upsert_identity(self, device_fingerprint: str, metadata: dict, current_time: int) -> Tuple[Optional[dict], bool]:
+        """إنشاء الهوية أو تحديث last_active لها في كتابة واحدة (ON CONFLICT) - يرجع (الهوية, أُنشئت؟)"""
+        identity_id = self.generate_unique_id()
+        query = f'''
+            INSERT INTO {MINISTRY_CONFIG['TABLE_IDENTITIES']}
+            (id, device_fingerprint, created_at, last_active, metadata, version)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(device_fingerprint) DO UPDATE SET last_active = excluded.last_active
+        '''
+        with self.db_manager.write_connection() as conn:
+            with conn:
+                conn.execute(query, (
+                    identity_id, device_fingerprint, current_time, current_time,
+                    json.dumps(metadata or {}), MINISTRY_CONFIG['VERSION']
+                ))
+                row = conn.execute(
+                    f"SELECT id, created_at, last_active FROM {MINISTRY_CONFIG['TABLE_IDENTITIES']} "
+                    "WHERE device_fingerprint = ?",
+                    (device_fingerprint,)
+                ).fetchone()
+        if row is None:
+            return None, False
+        return dict(row), row['id'] == identity_id
+    
+    def get_cached_identity(self, device_fingerprint: str) -> Optional[dict]:
+        with self.identity_cache_lock:
+            identity = self.identity_cache.get(device_fingerprint)
+            if identity is None:
+                self.identity_cache_misses += 1
+                return None
+            self.identity_cache.move_to_end(device_fingerprint)
+            self.identity_cache_hits += 1
+            return identity
+    
+    def cache_identity(self, device_fingerprint: str, identity: dict):
+        with self.identity_cache_lock:
+            self.identity_cache[device_fingerprint] = identity
+            self.identity_cache.move_to_end(device_fingerprint)
+            while len(self.identity_cache) > MINISTRY_CONFIG['IDENTITY_CACHE_SIZE']:
+                self.identity_cache.popitem(last=False)
+    
+    def get_identity_cache_stats(self) -> dict:
+        total = self.identity_cache_hits + self.identity_cache_misses
+        return {
+            'size': len(self.identity_cache),
+            'hits': self.identity_cache_hits,
+            'misses': self.identity_cache_misses,
+            'hit_rate': round(self.identity_cache_hits / total, 3) if total else 0
+        }
+    
     def create_session_for_identity(self, identity_id: str, session_data: dict = None) -> dict:
         """إنشاء جلسة جديدة لهوية"""
         try:
@@ -235,25 +1095,32 @@ class IdentityMinistry:
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             '''
             
-            result = self.db_manager.execute_query(
-                query,
-                (session_id, identity_id, current_time, current_time, session_data_json, ip_address, user_agent)
-            )
+            # الجلسة وتحديث جدول التجميع في معاملة واحدة
+            with self.db_manager.write_connection() as conn:
+                with conn:
+                    conn.execute(
+                        query,
+                        (session_id, identity_id, current_time, current_time, session_data_json, ip_address, user_agent)
+                    )
+                    conn.execute(
+                        f'''INSERT INTO {MINISTRY_CONFIG['TABLE_ROLLUPS']}
+                           (identity_id, sessions_total, first_seen, last_seen) VALUES (?, 1, ?, ?)
+                           ON CONFLICT(identity_id) DO UPDATE SET
+                               sessions_total = sessions_total + 1,
+                               first_seen = MIN(COALESCE(first_seen, excluded.first_seen), excluded.first_seen),
+                               last_seen = MAX(COALESCE(last_seen, 0), excluded.last_seen)''',
+                        (identity_id, current_time, current_time)
+                    )
             
-            if result is not None:
-                return {
-                    'success': True,
-                    'session': {
-                        'id': session_id,
-                        'identity_id': identity_id,
-                        'created_at': current_time
-                    }
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': 'فشل في إنشاء الجلسة'
+            self._remember_session(session_id)
+            return {
+                'success': True,
+                'session': {
+                    'id': session_id,
+                    'identity_id': identity_id,
+                    'created_at': current_time
                 }
+            }
             
         except Exception as error:
             self.db_manager.log(f"❌ خطأ في إنشاء الجلسة: {error}")
@@ -265,8 +1132,21 @@ class IdentityMinistry:
     def track_user_event(self, session_id: str, event_type: str, event_data: dict = None) -> dict:
         """تتبع حدث مستخدم"""
         try:
-            # للتبسيط، نقبل أي حدث
-            return {'success': True}
+            # الحدث يُضاف للذاكرة المؤقتة ويُكتب مع دفعته في الخلفية
+            event_type = event_type[:MINISTRY_CONFIG['MAX_EVENT_TYPE_LENGTH']]
+            if not self.session_exists(session_id):
+                return {
+                    'success': False,
+                    'error': 'الجلسة غير موجودة',
+                    'error_code': 'unknown_session'
+                }
+            if not self.event_buffer.add(session_id, event_type, event_data):
+                return {
+                    'success': False,
+                    'error': 'الخادم مشغول - أعد المحاولة لاحقاً',
+                    'retry_after': 1
+                }
+            return {'success': True, 'queued': True}
             
         except Exception as error:
             self.db_manager.log(f"❌ خطأ في تتبع الحدث: {error}")
@@ -275,13 +1155,76 @@ class IdentityMinistry:
                 'error': str(error)
             }
     
+    def session_exists(self, session_id: str) -> bool:
+        """هل الجلسة موجودة - من الذاكرة إذا تم التأكد خلال KNOWN_SESSION_TTL، وإلا استعلام بالمفتاح"""
+        now = time.monotonic()
+        with self.known_sessions_lock:
+            checked_at = self.known_sessions.get(session_id)
+            if checked_at is not None and now - checked_at < MINISTRY_CONFIG['KNOWN_SESSION_TTL']:
+                self.known_sessions.move_to_end(session_id)
+                return True
+        
+        row = self.db_manager.execute_query(
+            f"SELECT 1 FROM {MINISTRY_CONFIG['TABLE_SESSIONS']} WHERE id = ?",
+            (session_id,), fetch_one=True
+        )
+        if row is None:
+            with self.known_sessions_lock:
+                self.known_sessions.pop(session_id, None)
+            return False
+        self._remember_session(session_id)
+        return True
+    
+    def _remember_session(self, session_id: str):
+        with self.known_sessions_lock:
+            self.known_sessions[session_id] = time.monotonic()
+            self.known_sessions.move_to_end(session_id)
+            while len(self.known_sessions) > MINISTRY_CONFIG['KNOWN_SESSION_CACHE_SIZE']:
+                self.known_sessions.popitem(last=False)
+    
     def get_identity_summary(self, identity_id: str) -> dict:
-        """الحصول على ملخص هوية"""
+        """الحصول على ملخص هوية - قراءات بالمفتاح من جداول التجميع بدون تجميع الجداول الخام"""
         try:
+            identity = self.db_manager.execute_query(
+                f'''SELECT id, created_at, last_active, version, total_events
+                   FROM {MINISTRY_CONFIG['TABLE_IDENTITIES']} WHERE id = ?''',
+                (identity_id,), fetch_one=True
+            )
+            if identity is None:
+                return {
+                    'success': False,
+                    'not_found': True,
+                    'error': 'الهوية غير موجودة'
+                }
+            
+            rollup = self.db_manager.execute_query(
+                f"SELECT * FROM {MINISTRY_CONFIG['TABLE_ROLLUPS']} WHERE identity_id = ?",
+                (identity_id,), fetch_one=True
+            )
+            event_types = self.db_manager.execute_query(
+                f"SELECT event_type, count FROM {MINISTRY_CONFIG['TABLE_EVENT_ROLLUPS']} WHERE identity_id = ?",
+                (identity_id,), fetch_all=True
+            ) or []
+            rollup = dict(rollup) if rollup else {}
+            
             return {
                 'success': True,
-                'identity': {'id': identity_id},
-                'analytics': {'sessions': {'total': 0}}
+                'identity': {
+                    'id': identity['id'],
+                    'created_at': identity['created_at'],
+                    'last_active': identity['last_active'],
+                    'version': identity['version']
+                },
+                'analytics': {
+                    'sessions': {'total': rollup.get('sessions_total', 0)},
+                    'page_views': rollup.get('page_views', 0),
+                    'events': {
+                        'total': rollup.get('events_total', 0),
+                        'by_type': {row['event_type']: row['count'] for row in event_types}
+                    },
+                    'first_seen': rollup.get('first_seen') or identity['created_at'],
+                    'last_seen': max(rollup.get('last_seen') or 0, identity['last_active'])
+                }
             }
             
         except Exception as error:
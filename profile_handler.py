@@ -6,29 +6,40 @@
 - حفظ وتحديث الملفات الشخصية
 - معالجة البيانات والتخزين
 - إدارة جلسات المستخدمين
-- تصدير واستيراد البيانات
+- تصدير واستيراد البيانات (متدفق، واستيراد جماعي على دفعات)
+- التخزين عبر profile_store (SQLite مشترك أو ذاكرة العملية)
 """
 
+import gzip
 import json
 import hashlib
 from datetime import datetime
 import os
 import re
+import time
+import zlib
+
+from profile_store import DuplicateWhatsAppError, create_profile_store, normalize_whatsapp
+
+# رقم واتساب مصري منسق: 11 رقم يبدأ بـ 01
+WHATSAPP_KEY_PATTERN = re.compile(r'^01\d{9}$')
+# وسوم HTML تُزال من المدخلات (sanitize_input)
+TAG_PATTERN = re.compile(r'<[^>]+>')
 
 
 class ProfileHandler:
     """الكلاس الأساسي لإدارة الملفات الشخصية"""
     
-    def __init__(self):
-        # قاعدة بيانات في الذاكرة (يمكن تحويلها لقاعدة بيانات لاحقاً)
-        self.users_data = {}
+    def __init__(self, store=None):
+        # 🗄️ مخزن الملفات الشخصية (SQLite من DATABASE_URL أو الذاكرة)
+        self.store = store or create_profile_store()
         self.session_data = {}
     
     def sanitize_input(self, text):
         """تنظيف المدخلات من الأكواد الضارة"""
         if not text:
             return ""
-        text = re.sub(r'<[^>]+>', '', text)
+        text = TAG_PATTERN.sub('', text)
         return text.strip()
     
     def generate_user_id(self, whatsapp_number, additional_data=None):
@@ -62,6 +73,15 @@ class ProfileHandler:
             print(f"خطأ في معالجة الإيميلات: {str(e)}")
             return []
     
+    def build_email_details(self, email_addresses):
+        """ملخص الإيميلات المحفوظ مع الملف الشخصي"""
+        return {
+            'primary_email': email_addresses[0] if email_addresses else None,
+            'secondary_emails': email_addresses[1:] if len(email_addresses) > 1 else [],
+            'total_count': len(email_addresses),
+            'domains': list(set([email.split('@')[1] for email in email_addresses])) if email_addresses else []
+        }
+    
     def process_payment_details(self, payment_method, payment_details):
         """معالجة تفاصيل الدفع"""
         processed_payment_details = ""
@@ -80,8 +100,11 @@ class ProfileHandler:
         
         return processed_payment_details
     
-    def create_user_profile(self, form_data, client_ip, user_agent):
-        """إنشاء ملف شخصي جديد"""
+    def create_user_profile(self, form_data, client_ip, user_agent, owner_user_id=None):
+        """إنشاء ملف شخصي جديد
+
+        الرقم المسجل من قبل لا يُحدث إلا لصاحب الملف (owner_user_id من جلسته) - غير ذلك يُرفض
+        """
         try:
             # استخراج البيانات الأساسية
             platform = self.sanitize_input(form_data.get('platform'))
@@ -110,12 +133,7 @@ class ProfileHandler:
                 'telegram_username': telegram_username,
                 'email_addresses': email_addresses,
                 'email_count': len(email_addresses),
-                'email_details': {
-                    'primary_email': email_addresses[0] if email_addresses else None,
-                    'secondary_emails': email_addresses[1:] if len(email_addresses) > 1 else [],
-                    'total_count': len(email_addresses),
-                    'domains': list(set([email.split('@')[1] for email in email_addresses])) if email_addresses else []
-                },
+                'email_details': self.build_email_details(email_addresses),
                 'created_at': datetime.now().isoformat(),
                 'updated_at': datetime.now().isoformat(),
                 'ip_address': hashlib.sha256(client_ip.encode()).hexdigest()[:10],
@@ -124,8 +142,23 @@ class ProfileHandler:
                 'telegram_linked': False
             }
             
-            # حفظ في الذاكرة المؤقتة
-            self.users_data[user_id] = user_data
+            # رقم مسجل من قبل: صاحبه فقط يحدث نفس الملف - لا استيلاء ولا إرجاع لبياناته المحفوظة
+            existing = self.store.get_by_whatsapp(whatsapp_number)
+            if existing and existing['user_id'] != owner_user_id:
+                return self.whatsapp_registered_error()
+            
+            if existing:
+                user_id = existing['user_id']
+                user_data['user_id'] = user_id
+                self.store.save({
+                    **existing,
+                    **user_data,
+                    'created_at': existing.get('created_at', user_data['created_at']),
+                    'telegram_linked': existing.get('telegram_linked', False)
+                })
+            else:
+                # حفظ في المخزن
+                self.store.save(user_data)
             
             print(f"🔥 New Profile Created (ID: {user_id}):")
             print(f"   📱 WhatsApp: {whatsapp_number}")
@@ -140,6 +173,10 @@ class ProfileHandler:
                 'message': 'تم إنشاء الملف الشخصي بنجاح'
             }
             
+        except DuplicateWhatsAppError:
+            # تسجيل متزامن لنفس الرقم من طلب آخر
+            return self.whatsapp_registered_error()
+            
         except Exception as e:
             print(f"خطأ في إنشاء الملف الشخصي: {str(e)}")
             return {
@@ -148,21 +185,28 @@ class ProfileHandler:
                 'message': 'فشل في إنشاء الملف الشخصي'
             }
     
+    @staticmethod
+    def whatsapp_registered_error():
+        return {
+            'success': False,
+            'error': 'whatsapp_registered',
+            'message': 'رقم الواتساب مسجل بالفعل لملف شخصي آخر - استخدم نفس المتصفح الذي سجلت منه أو تواصل مع الدعم'
+        }
+    
     def update_user_profile(self, user_id, update_data):
         """تحديث ملف شخصي موجود"""
-        if user_id not in self.users_data:
-            return {
-                'success': False,
-                'message': 'الملف الشخصي غير موجود'
-            }
-        
         try:
             # تحديث البيانات
-            current_data = self.users_data[user_id]
-            current_data.update(update_data)
-            current_data['updated_at'] = datetime.now().isoformat()
+            current_data = self.store.update(user_id, {
+                **update_data,
+                'updated_at': datetime.now().isoformat()
+            })
             
-            self.users_data[user_id] = current_data
+            if current_data is None:
+                return {
+                    'success': False,
+                    'message': 'الملف الشخصي غير موجود'
+                }
             
             print(f"📝 Profile Updated (ID: {user_id})")
             
@@ -172,6 +216,12 @@ class ProfileHandler:
                 'message': 'تم تحديث الملف الشخصي بنجاح'
             }
             
+        except DuplicateWhatsAppError:
+            return {
+                'success': False,
+                'message': 'رقم الواتساب مسجل لملف شخصي آخر'
+            }
+            
         except Exception as e:
             print(f"خطأ في تحديث الملف الشخصي: {str(e)}")
             return {
@@ -182,10 +232,11 @@ class ProfileHandler:
     
     def get_user_profile(self, user_id):
         """الحصول على ملف شخصي"""
-        if user_id in self.users_data:
+        user_data = self.store.get(user_id)
+        if user_data is not None:
             return {
                 'success': True,
-                'user_data': self.users_data[user_id]
+                'user_data': user_data
             }
         else:
             return {
@@ -194,14 +245,14 @@ class ProfileHandler:
             }
     
     def search_user_by_whatsapp(self, whatsapp_number):
-        """البحث عن مستخدم برقم الواتساب"""
-        for user_id, user_data in self.users_data.items():
-            if user_data.get('whatsapp_number') == whatsapp_number:
-                return {
-                    'success': True,
-                    'user_id': user_id,
-                    'user_data': user_data
-                }
+        """البحث عن مستخدم برقم الواتساب (عبر الفهرس الفريد)"""
+        user_data = self.store.get_by_whatsapp(whatsapp_number)
+        if user_data is not None:
+            return {
+                'success': True,
+                'user_id': user_data['user_id'],
+                'user_data': user_data
+            }
         
         return {
             'success': False,
@@ -210,12 +261,6 @@ class ProfileHandler:
     
     def link_telegram_account(self, user_id, telegram_data):
         """ربط حساب التليجرام بالملف الشخصي"""
-        if user_id not in self.users_data:
-            return {
-                'success': False,
-                'message': 'الملف الشخصي غير موجود'
-            }
-        
         try:
             # تحديث بيانات التليجرام
             telegram_update = {
@@ -241,40 +286,203 @@ class ProfileHandler:
                 'message': 'فشل في ربط حساب التليجرام'
             }
     
+    def iter_users(self, page_size=500):
+        """المرور على المستخدمين صفحة بصفحة (ذاكرة ثابتة)"""
+        for page in self.store.iter_pages(page_size):
+            yield from page
+    
     def get_all_users(self):
         """الحصول على جميع المستخدمين"""
+        users_data = {profile['user_id']: profile for profile in self.iter_users()}
         return {
             'success': True,
-            'users_count': len(self.users_data),
-            'users_data': self.users_data
+            'users_count': len(users_data),
+            'users_data': users_data
         }
     
-    def export_data(self):
-        """تصدير البيانات للنسخ الاحتياطي"""
-        export_data = {
+    def get_users_count(self):
+        """عدد المستخدمين بدون تحميل بياناتهم"""
+        return self.store.count()
+    
+    def iter_export_records(self, page_size=500):
+        """سجلات التصدير واحداً تلو الآخر: معلومات التصدير ثم المستخدمين ثم الجلسات"""
+        yield {
+            'type': 'export_info',
             'export_date': datetime.now().isoformat(),
-            'users_count': len(self.users_data),
-            'users_data': self.users_data,
-            'session_data': self.session_data
+            'users_count': self.store.count()
         }
+        yield from self.iter_data_records(page_size)
+    
+    def iter_data_records(self, page_size=500):
+        """سجلات المستخدمين والجلسات بدون سجل معلومات التصدير (لتضمينها في تصدير أكبر)"""
+        for profile in self.iter_users(page_size):
+            yield {'type': 'user', 'user_id': profile['user_id'], 'data': profile}
+        for session_id, session in list(self.session_data.items()):
+            yield {'type': 'session', 'session_id': session_id, 'data': session}
+    
+    def stream_export(self, export_format='ndjson', compress=False, page_size=500):
+        """تصدير متدفق للنسخ الاحتياطي (NDJSON أو مصفوفة JSON، مع gzip اختياري)"""
+        chunks = encode_export_records(self.iter_export_records(page_size), export_format)
+        return gzip_chunks(chunks) if compress else chunks
+    
+    def sanitize_column(self, values):
+        """sanitize_input لعمود كامل من الدفعة - التعبير النمطي فقط للقيم التي فيها وسوم"""
+        column = [str(value or '') for value in values]
+        return [TAG_PATTERN.sub('', text).strip() if '<' in text else text.strip() for text in column]
+    
+    def process_email_column(self, values):
+        """process_email_addresses لعمود كامل - القوائم المتطابقة (غالباً الفارغة) تُعالج مرة واحدة"""
+        processed = {}
+        column = []
+        for value in values:
+            raw = value if isinstance(value, str) else json.dumps(value or [])
+            if raw not in processed:
+                processed[raw] = self.process_email_addresses(raw)
+            column.append(list(processed[raw]))
+        return column
+    
+    def normalize_import_batch(self, profiles):
+        """نفس تنظيف الإنشاء العادي لدفعة مستوردة، عموداً عموداً
+
+        يرجع ([(الرقم المنسق, السجل)] للسجلات الصالحة، عدد السجلات ذات الواتساب غير الصالح)
+        """
+        whatsapp_numbers = self.sanitize_column(profile.get('whatsapp_number') for profile in profiles)
+        whatsapp_keys = [normalize_whatsapp(number) for number in whatsapp_numbers]
+        valid = [index for index, key in enumerate(whatsapp_keys) if key and WHATSAPP_KEY_PATTERN.match(key)]
+        rows = [profiles[index] for index in valid]
+        keys = [whatsapp_keys[index] for index in valid]
+        
+        user_ids = self.sanitize_column(profile.get('user_id') for profile in rows)
+        platforms = self.sanitize_column(profile.get('platform') for profile in rows)
+        payment_methods = self.sanitize_column(profile.get('payment_method') for profile in rows)
+        payment_details = [
+            self.process_payment_details(method, details)
+            for method, details in zip(payment_methods, self.sanitize_column(profile.get('payment_details') for profile in rows))
+        ]
+        telegram_usernames = self.sanitize_column(profile.get('telegram_username') for profile in rows)
+        email_addresses = self.process_email_column(profile.get('email_addresses') for profile in rows)
+        now = datetime.now().isoformat()
         
-        return export_data
+        normalized = []
+        for index, profile in enumerate(rows):
+            emails = email_addresses[index]
+            normalized.append((keys[index], {
+                **profile,
+                'user_id': user_ids[index] or self.generate_user_id(keys[index]),
+                'platform': platforms[index],
+                'whatsapp_number': whatsapp_numbers[valid[index]],
+                'payment_method': payment_methods[index],
+                'payment_details': payment_details[index],
+                'telegram_username': telegram_usernames[index],
+                'email_addresses': emails,
+                'email_count': len(emails),
+                'email_details': self.build_email_details(emails),
+                'created_at': profile.get('created_at') or now,
+                'updated_at': profile.get('updated_at') or now
+            }))
+        return normalized, len(profiles) - len(valid)
     
-    def import_data(self, import_data):
-        """استيراد البيانات من النسخة الاحتياطية"""
+    def import_batch(self, profiles, stats):
+        """تنظيف دفعة، إزالة المكرر بالواتساب، ثم كتابتها في معاملة واحدة"""
+        normalized, invalid = self.normalize_import_batch(profiles)
+        stats['invalid'] += invalid
+        by_whatsapp = {}
+        for key, profile in normalized:
+            if key in by_whatsapp:
+                stats['duplicates'] += 1
+            # آخر سجل لنفس الرقم في الملف هو الأحدث
+            by_whatsapp[key] = profile
+        
+        # رقم مسجل من قبل لملف آخر: السجل المستورد يحدث نفس الملف (استعلام واحد للدفعة)
+        owners = self.store.user_ids_by_whatsapp(list(by_whatsapp))
+        by_user_id = {}
+        for key, profile in by_whatsapp.items():
+            owner = owners.get(key)
+            if owner and owner != profile['user_id']:
+                profile['user_id'] = owner
+                stats['merged'] += 1
+            if profile['user_id'] in by_user_id:
+                stats['duplicates'] += 1
+            by_user_id[profile['user_id']] = profile
+        
+        batch = list(by_user_id.values())
         try:
-            if 'users_data' in import_data:
-                self.users_data.update(import_data['users_data'])
-            
-            if 'session_data' in import_data:
-                self.session_data.update(import_data['session_data'])
+            self.store.save_many(batch)
+            stats['imported'] += len(batch)
+        except DuplicateWhatsAppError:
+            # تعارض نادر (كتابة متزامنة من worker آخر) - حفظ الدفعة سجلاً سجلاً
+            for profile in batch:
+                try:
+                    self.store.save(profile)
+                    stats['imported'] += 1
+                except DuplicateWhatsAppError:
+                    stats['duplicates'] += 1
+    
+    def bulk_import(self, records, batch_size=1000, progress_every=10000):
+        """استيراد جماعي من سجلات التصدير (user / session) على دفعات مع تقرير التقدم"""
+        stats = {'read': 0, 'imported': 0, 'merged': 0, 'duplicates': 0, 'invalid': 0, 'sessions': 0}
+        started = time.perf_counter()
+        next_report = progress_every
+        batch = []
+        
+        def flush():
+            nonlocal next_report
+            self.import_batch(batch, stats)
+            batch.clear()
+            if progress_every and stats['read'] >= next_report:
+                elapsed = time.perf_counter() - started
+                print(f"📥 {stats['read']} سجل ({stats['read'] / elapsed:.0f} سجل/ث) - "
+                      f"مستورد {stats['imported']}، مكرر {stats['duplicates']}، غير صالح {stats['invalid']}")
+                next_report = (stats['read'] // progress_every + 1) * progress_every
+        
+        for record in records:
+            record_type = record.get('type', 'user')
+            if record_type == 'session':
+                self.session_data[record['session_id']] = record['data']
+                stats['sessions'] += 1
+                continue
+            if record_type != 'user':
+                continue
             
-            print(f"📥 تم استيراد {len(import_data.get('users_data', {}))} مستخدم")
+            profile = record.get('data', record)
+            if record.get('user_id'):
+                profile = {**profile, 'user_id': record['user_id']}
+            batch.append(profile)
+            stats['read'] += 1
             
+            if len(batch) >= batch_size:
+                flush()
+        
+        if batch:
+            flush()
+        
+        elapsed = time.perf_counter() - started
+        stats['elapsed_seconds'] = round(elapsed, 3)
+        stats['records_per_second'] = round(stats['read'] / elapsed, 1) if elapsed else 0
+        print(f"📥 تم استيراد {stats['imported']} مستخدم ({stats['records_per_second']} سجل/ث)")
+        
+        return {
+            'success': True,
+            'stats': stats,
+            'message': 'تم استيراد البيانات بنجاح'
+        }
+    
+    def import_file(self, path, batch_size=1000):
+        """استيراد ملف تصدير (NDJSON / JSON، مضغوط أو لا) بدون تحميله كاملاً"""
+        try:
+            return self.bulk_import(iter_import_records(path), batch_size)
+        except Exception as e:
+            print(f"خطأ في استيراد الملف: {str(e)}")
             return {
-                'success': True,
-                'message': 'تم استيراد البيانات بنجاح'
+                'success': False,
+                'error': str(e),
+                'message': 'فشل في استيراد الملف'
             }
+    
+    def import_data(self, import_data):
+        """استيراد البيانات من النسخة الاحتياطية"""
+        try:
+            return self.bulk_import(legacy_export_records(import_data))
             
         except Exception as e:
             print(f"خطأ في استيراد البيانات: {str(e)}")
@@ -316,12 +524,100 @@ class ProfileHandler:
             }
 
 
+# ============================================================================
+# 📤 أدوات التصدير المتدفق
+# ============================================================================
+
+def encode_export_records(records, export_format='ndjson', lines_per_chunk=200):
+    """تحويل السجلات لنص على دفعات - NDJSON (سطر لكل سجل) أو مصفوفة JSON واحدة"""
+    is_array = export_format == 'json'
+    if is_array:
+        yield '[\n'
+    
+    lines = []
+    first = True
+    for record in records:
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        if is_array and not first:
+            line = ',' + line
+        first = False
+        lines.append(line)
+        if len(lines) >= lines_per_chunk:
+            yield ''.join(lines)
+            lines = []
+    
+    if lines:
+        yield ''.join(lines)
+    if is_array:
+        yield ']\n'
+
+
+def gzip_chunks(chunks, level=6):
+    """ضغط gzip أثناء الإرسال بدون تجميع الملف في الذاكرة"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# ============================================================================
+# 📥 أدوات قراءة ملفات الاستيراد
+# ============================================================================
+
+def legacy_export_records(export_data):
+    """تحويل تصدير قديم (قاموس واحد) لنفس سجلات التصدير المتدفق"""
+    # تصدير لوحة التحكم القديم يضع بيانات المستخدمين تحت raw_data.users
+    export_data = export_data.get('raw_data', {}).get('users', export_data)
+    for user_id, user_data in export_data.get('users_data', {}).items():
+        yield {'type': 'user', 'user_id': user_id, 'data': user_data}
+    for session_id, session in export_data.get('session_data', {}).items():
+        yield {'type': 'session', 'session_id': session_id, 'data': session}
+
+
+def iter_import_records(path):
+    """قراءة سجلات ملف تصدير سطراً بسطر: NDJSON، مصفوفة JSON متدفقة، أو تصدير قديم"""
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    opener = gzip.open if is_gzip else open
+    
+    with opener(path, 'rt', encoding='utf-8') as f:
+        first_line = f.readline().strip()
+        
+        if first_line == '[':
+            # مصفوفة من encode_export_records: سجل واحد في كل سطر
+            for line in f:
+                line = line.strip().lstrip(',')
+                if line and line != ']':
+                    yield json.loads(line)
+            return
+        
+        try:
+            first_record = json.loads(first_line) if first_line else None
+        except ValueError:
+            # JSON منسق على عدة أسطر (تصدير قديم) - لا بديل عن قراءته كاملاً
+            yield from legacy_export_records(json.loads(first_line + f.read()))
+            return
+        
+        if isinstance(first_record, dict) and ('users_data' in first_record or 'raw_data' in first_record):
+            yield from legacy_export_records(first_record)
+            return
+        
+        if first_record is not None:
+            yield first_record
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
 # إنشاء instance عام للاستخدام
 profile_handler = ProfileHandler()
 
 # تصدير الدوال للتوافق مع الكود الأصلي
-def create_user_profile(form_data, client_ip, user_agent):
-    return profile_handler.create_user_profile(form_data, client_ip, user_agent)
+def create_user_profile(form_data, client_ip, user_agent, owner_user_id=None):
+    return profile_handler.create_user_profile(form_data, client_ip, user_agent, owner_user_id)
 
 def update_user_profile(user_id, update_data):
     return profile_handler.update_user_profile(user_id, update_data)
@@ -334,3 +630,18 @@ def search_user_by_whatsapp(whatsapp_number):
 
 def link_telegram_account(user_id, telegram_data):
     return profile_handler.link_telegram_account(user_id, telegram_data)
+
+
+if __name__ == '__main__':
+    # 📥 استعادة نسخة احتياطية كبيرة بدون المرور على الـ API
+    #   python profile_handler.py import FILE [BATCH_SIZE]
+    import sys
+    
+    if len(sys.argv) < 3 or sys.argv[1] != 'import':
+        print("الاستخدام: python profile_handler.py import FILE [BATCH_SIZE]")
+        sys.exit(2)
+    
+    result = profile_handler.import_file(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 1000)
+    if result['success']:
+        print(json.dumps(result['stats'], ensure_ascii=False, indent=2))
+    sys.exit(0 if result['success'] else 1)
@@ -0,0 +1,344 @@
+# profile_store.py - مخزن الملفات الشخصية الدائم
+"""
+🗄️ مخزن الملفات الشخصية - FC 26 Profile System
+===============================================
+طبقة تخزين قابلة للاستبدال لوزارة البيانات
+- ذاكرة العملية (للتطوير والاختبارات)
+- SQLite مشترك بين جميع gunicorn workers ويبقى بعد إعادة التشغيل
+- فهرس فريد على رقم الواتساب المنسق (بحث بدون مرور على كل المستخدمين)
+- قراءة على صفحات بالمفتاح (keyset) بدلاً من تحميل الكل في الذاكرة
+- كتابة دفعات كاملة في معاملة واحدة (للاستيراد الجماعي)
+- عداد نسخة يزيد مع كل كتابة (لمعرفة تغير البيانات بدون قراءتها)
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from system_metrics import timed_write
+
+
+class DuplicateWhatsAppError(ValueError):
+    """رقم الواتساب مسجل لملف شخصي آخر"""
+
+
+# ============================================================================
+# 🔢 عدادات النسخ - جدول مشترك لكل المخازن في نفس ملف SQLite
+# ============================================================================
+
+def ensure_version_row(conn, name):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS store_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO store_versions (name, version) VALUES (?, 0)', (name,))
+
+
+def bump_version(conn, name):
+    conn.execute('UPDATE store_versions SET version = version + 1 WHERE name = ?', (name,))
+
+
+def read_version(conn, name):
+    return conn.execute('SELECT version FROM store_versions WHERE name = ?', (name,)).fetchone()[0]
+
+
+def normalize_whatsapp(number):
+    """تنسيق رقم الواتساب للمقارنة: 11 رقم محلي (01xxxxxxxxx) أو None"""
+    digits = re.sub(r'\D', '', str(number or ''))
+    if digits.startswith('0020'):
+        digits = digits[2:]
+    if digits.startswith('20') and len(digits) == 12:
+        digits = '0' + digits[2:]
+    return digits or None
+
+
+class MemoryProfileStore:
+    """مخزن في ذاكرة العملية - قاموس بالمعرف + قاموس بالرقم المنسق"""
+
+    def __init__(self):
+        self.profiles = {}
+        self.whatsapp_index = {}
+        self.version = 0
+        self.lock = threading.RLock()
+
+    def get(self, user_id):
+        with self.lock:
+            profile = self.profiles.get(user_id)
+            return dict(profile) if profile else None
+
+    def get_by_whatsapp(self, whatsapp_number):
+        key = normalize_whatsapp(whatsapp_number)
+        with self.lock:
+            user_id = self.whatsapp_index.get(key) if key else None
+            return self.get(user_id) if user_id else None
+
+    def save(self, profile):
+        """حفظ ملف شخصي (إنشاء أو استبدال)"""
+        user_id = profile['user_id']
+        key = normalize_whatsapp(profile.get('whatsapp_number'))
+        with self.lock:
+            owner = self.whatsapp_index.get(key) if key else None
+            if owner is not None and owner != user_id:
+                raise DuplicateWhatsAppError(key)
+
+            previous = self.profiles.get(user_id)
+            previous_key = normalize_whatsapp(previous.get('whatsapp_number')) if previous else None
+            if previous_key and previous_key != key:
+                self.whatsapp_index.pop(previous_key, None)
+
+            self.profiles[user_id] = dict(profile)
+            if key:
+                self.whatsapp_index[key] = user_id
+            self.version += 1
+
+    def save_many(self, profiles):
+        """حفظ دفعة ملفات مرة واحدة - تُرفض الدفعة كاملة عند تعارض رقم واتساب"""
+        with self.lock:
+            snapshot = (dict(self.profiles), dict(self.whatsapp_index))
+            try:
+                for profile in profiles:
+                    self.save(profile)
+            except DuplicateWhatsAppError:
+                self.profiles, self.whatsapp_index = snapshot
+                raise
+
+    def user_ids_by_whatsapp(self, whatsapp_keys):
+        """أصحاب أرقام الواتساب المنسقة الموجودة: {الرقم: المعرف}"""
+        with self.lock:
+            return {key: self.whatsapp_index[key] for key in whatsapp_keys if key in self.whatsapp_index}
+
+    def update(self, user_id, changes):
+        """دمج تغييرات في ملف موجود - يرجع الملف المحدث أو None"""
+        with self.lock:
+            profile = self.get(user_id)
+            if profile is None:
+                return None
+            profile.update(changes)
+            self.save(profile)
+            return profile
+
+    def count(self):
+        return len(self.profiles)
+
+    def get_version(self):
+        return self.version
+
+    def iter_pages(self, page_size=500):
+        """قراءة الملفات على صفحات مرتبة بالمعرف"""
+        with self.lock:
+            user_ids = sorted(self.profiles)
+        for start in range(0, len(user_ids), page_size):
+            page = [self.get(user_id) for user_id in user_ids[start:start + page_size]]
+            yield [profile for profile in page if profile is not None]
+
+    def iter_signup_pages(self, page_size=5000):
+        """(وقت التسجيل، المنصة) لكل ملف على صفحات - للتحليلات الزمنية"""
+        with self.lock:
+            rows = [(profile.get('created_at'), profile.get('platform')) for profile in self.profiles.values()]
+        for start in range(0, len(rows), page_size):
+            yield rows[start:start + page_size]
+
+    def clear(self):
+        with self.lock:
+            self.profiles.clear()
+            self.whatsapp_index.clear()
+            self.version += 1
+
+
+class SQLiteProfileStore:
+    """مخزن SQLite (WAL) - البحث بالمعرف أو الرقم عبر فهارس B-tree"""
+
+    def __init__(self, db_path='fc26_profiles.db'):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+
+    def _connect(self):
+        """اتصال SQLite خاص بكل خيط"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self._ensure_schema(conn)
+        return conn
+
+    def _ensure_schema(self, conn):
+        with self.schema_lock:
+            if self.schema_ready:
+                return
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS profiles (
+                    user_id TEXT PRIMARY KEY,
+                    whatsapp_key TEXT,
+                    data TEXT NOT NULL,
+                    created_at TEXT,
+                    updated_at TEXT
+                )
+            ''')
+            conn.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS idx_profiles_whatsapp_key '
+                'ON profiles (whatsapp_key)'
+            )
+            ensure_version_row(conn, 'profiles')
+            self.schema_ready = True
+
+    @staticmethod
+    def _row(profile):
+        return (
+            profile['user_id'],
+            normalize_whatsapp(profile.get('whatsapp_number')),
+            json.dumps(profile, ensure_ascii=False),
+            profile.get('created_at'),
+            profile.get('updated_at')
+        )
+
+    def get(self, user_id):
+        row = self._connect().execute(
+            'SELECT data FROM profiles WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_by_whatsapp(self, whatsapp_number):
+        key = normalize_whatsapp(whatsapp_number)
+        if not key:
+            return None
+        row = self._connect().execute(
+            'SELECT data FROM profiles WHERE whatsapp_key = ?', (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, profile):
+        """حفظ ملف شخصي (إنشاء أو استبدال)"""
+        with timed_write(self.db_path):
+            conn = self._connect()
+            try:
+                conn.execute(
+                    'INSERT INTO profiles (user_id, whatsapp_key, data, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT(user_id) DO UPDATE SET whatsapp_key = excluded.whatsapp_key, '
+                    'data = excluded.data, updated_at = excluded.updated_at',
+                    self._row(profile)
+                )
+            except sqlite3.IntegrityError as e:
+                raise DuplicateWhatsAppError(normalize_whatsapp(profile.get('whatsapp_number'))) from e
+            bump_version(conn, 'profiles')
+
+    def save_many(self, profiles):
+        """حفظ دفعة ملفات في معاملة واحدة - تُرفض الدفعة كاملة عند تعارض رقم واتساب"""
+        with timed_write(self.db_path):
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(
+                    'INSERT INTO profiles (user_id, whatsapp_key, data, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT(user_id) DO UPDATE SET whatsapp_key = excluded.whatsapp_key, '
+                    'data = excluded.data, updated_at = excluded.updated_at',
+                    [self._row(profile) for profile in profiles]
+                )
+                bump_version(conn, 'profiles')
+                conn.execute('COMMIT')
+            except sqlite3.IntegrityError as e:
+                conn.execute('ROLLBACK')
+                raise DuplicateWhatsAppError(str(e)) from e
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def user_ids_by_whatsapp(self, whatsapp_keys):
+        """أصحاب أرقام الواتساب المنسقة الموجودة: {الرقم: المعرف} (استعلام واحد للدفعة)"""
+        keys = [key for key in whatsapp_keys if key]
+        owners = {}
+        # حد SQLite لعدد المتغيرات في الاستعلام الواحد
+        for start in range(0, len(keys), 900):
+            chunk = keys[start:start + 900]
+            placeholders = ', '.join('?' * len(chunk))
+            owners.update(self._connect().execute(
+                f'SELECT whatsapp_key, user_id FROM profiles WHERE whatsapp_key IN ({placeholders})',
+                chunk
+            ).fetchall())
+        return owners
+
+    def update(self, user_id, changes):
+        """دمج تغييرات في ملف موجود بشكل ذري - يرجع الملف المحدث أو None"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            profile = self.get(user_id)
+            if profile is None:
+                conn.execute('ROLLBACK')
+                return None
+            profile.update(changes)
+            self.save(profile)
+            conn.execute('COMMIT')
+            return profile
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM profiles').fetchone()[0]
+
+    def get_version(self):
+        """عداد يزيد مع كل كتابة من أي worker"""
+        return read_version(self._connect(), 'profiles')
+
+    def iter_pages(self, page_size=500):
+        """قراءة الملفات على صفحات بالمفتاح (keyset) - ذاكرة ثابتة مهما كان العدد"""
+        last_user_id = ''
+        while True:
+            rows = self._connect().execute(
+                'SELECT user_id, data FROM profiles WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                (last_user_id, page_size)
+            ).fetchall()
+            if not rows:
+                return
+            last_user_id = rows[-1][0]
+            yield [json.loads(data) for _, data in rows]
+
+    def iter_signup_pages(self, page_size=5000):
+        """(وقت التسجيل، المنصة) على صفحات بالـ rowid - بدون تحويل JSON كل ملف في بايثون"""
+        last_rowid = 0
+        while True:
+            rows = self._connect().execute(
+                "SELECT rowid, created_at, json_extract(data, '$.platform') FROM profiles "
+                'WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (last_rowid, page_size)
+            ).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [(created_at, platform) for _, created_at, platform in rows]
+
+    def clear(self):
+        self._connect().execute('DELETE FROM profiles')
+        bump_version(self._connect(), 'profiles')
+
+
+def sqlite_path_from_url(database_url):
+    """استخراج مسار الملف من sqlite:///path - None لأي قاعدة بيانات أخرى"""
+    if database_url and database_url.startswith('sqlite:///'):
+        return database_url[len('sqlite:///'):]
+    return None
+
+
+def create_profile_store():
+    """إنشاء المخزن حسب متغيرات البيئة (SQLite من DATABASE_URL افتراضياً)"""
+    backend_name = os.environ.get('PROFILE_STORE_BACKEND', 'sqlite').lower()
+    if backend_name == 'memory':
+        return MemoryProfileStore()
+
+    database_url = os.environ.get('DATABASE_URL', 'sqlite:///fc26_profiles.db')
+    db_path = sqlite_path_from_url(database_url)
+    if db_path is None:
+        print("⚠️ DATABASE_URL ليس SQLite - استخدام fc26_profiles.db للملفات الشخصية")
+        db_path = 'fc26_profiles.db'
+    return SQLiteProfileStore(db_path)
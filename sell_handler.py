@@ -6,6 +6,7 @@
 - دعم كامل لبيانات حساب EA
 - تشفير آمن للبيانات الحساسة
 - نظام أكواد الاسترداد الذكي
+- التخزين عبر sell_store (SQLite مشترك أو ذاكرة العملية)
 """
 
 import os
@@ -15,6 +16,10 @@ import uuid
 from datetime import datetime
 import re
 import logging
+import threading
+import time
+
+from sell_store import create_sell_store
 
 # إعداد نظام السجلات
 logging.basicConfig(level=logging.INFO)
@@ -23,9 +28,19 @@ logger = logging.getLogger(__name__)
 class SellCoinsHandler:
     """كلاس معزول لإدارة طلبات بيع الكوينز مع دعم EA"""
     
-    def __init__(self):
-        # قاعدة بيانات في الذاكرة
-        self.sell_requests = {}
+    # أي حالة يمكن تغييرها لأي حالة (للمشرف) - expected_status فقط يمنع الكتابة فوق تعديل مشرف آخر
+    VALID_STATUSES = ['pending', 'processing', 'completed', 'cancelled']
+    
+    def __init__(self, store=None):
+        # 🗄️ مخزن الطلبات (SQLite من DATABASE_URL أو الذاكرة)
+        self.store = store or create_sell_store()
+        
+        # 📊 الإحصائيات عدادات تُحدث مع كل طلب - المطابقة الكاملة مع الطلبات دورية فقط
+        # المطابقة في خيط خلفي لكل عملية - طلب الإحصائيات يقرأ العدادات فقط
+        self.stats_reconcile_interval = float(os.environ.get('SELL_STATS_RECONCILE_INTERVAL', '3600'))
+        self.stats_reconciled_at = None
+        self.reconcile_lock = threading.Lock()
+        self.reconciler_pid = None
         
         # معدلات التحويل
         self.conversion_rates = {
@@ -152,8 +167,8 @@ class SellCoinsHandler:
                 'updated_at': datetime.now().isoformat()
             }
             
-            # حفظ في الذاكرة
-            self.sell_requests[request_id] = sell_request
+            # حفظ في المخزن
+            self.store.insert(sell_request)
             
             logger.info(f"💰 طلب بيع جديد: {request_id}")
             logger.info(f"   الكمية: {coins_amount} كوين")
@@ -183,10 +198,11 @@ class SellCoinsHandler:
     
     def get_sell_request(self, request_id):
         """الحصول على تفاصيل طلب بيع"""
-        if request_id in self.sell_requests:
+        sell_request = self.store.get(request_id)
+        if sell_request is not None:
             return {
                 'success': True,
-                'request': self.sell_requests[request_id]
+                'request': sell_request
             }
         else:
             return {
@@ -194,93 +210,132 @@ class SellCoinsHandler:
                 'error': 'الطلب غير موجود'
             }
     
-    def get_user_requests(self, user_id):
-        """الحصول على جميع طلبات مستخدم"""
-        user_requests = []
+    def get_user_requests(self, user_id, limit=20, cursor=None):
+        """طلبات مستخدم من الأحدث للأقدم على صفحات - cursor من next_cursor للصفحة السابقة"""
+        before = None
+        if cursor:
+            created_at, _, request_id = cursor.partition('|')
+            before = (created_at, request_id)
         
-        for request_id, request_data in self.sell_requests.items():
-            if request_data.get('user_info', {}).get('user_id') == user_id:
-                user_requests.append(request_data)
+        user_requests = self.store.list_by_user(user_id, limit + 1, before)
+        has_more = len(user_requests) > limit
+        user_requests = user_requests[:limit]
         
-        # ترتيب حسب التاريخ
-        user_requests.sort(key=lambda x: x['created_at'], reverse=True)
+        next_cursor = None
+        if has_more:
+            last = user_requests[-1]
+            next_cursor = f"{last['created_at']}|{last['request_id']}"
         
         return {
             'success': True,
             'requests': user_requests,
-            'count': len(user_requests)
+            'count': len(user_requests),
+            'has_more': has_more,
+            'next_cursor': next_cursor
         }
     
-    def update_request_status(self, request_id, new_status):
-        """تحديث حالة الطلب"""
-        if request_id not in self.sell_requests:
+    def update_request_status(self, request_id, new_status, expected_status=None):
+        """تحديث حالة الطلب بشكل ذري - expected_status لرفض التحديث إذا غيره مشرف آخر"""
+        if new_status not in self.VALID_STATUSES:
             return {
                 'success': False,
-                'error': 'الطلب غير موجود'
+                'error': 'حالة غير صحيحة'
             }
         
-        valid_statuses = ['pending', 'processing', 'completed', 'cancelled']
+        allowed_from = self.VALID_STATUSES if expected_status is None else [expected_status]
+        
+        previous, updated = self.store.transition_status(
+            request_id, new_status, allowed_from, datetime.now().isoformat()
+        )
         
-        if new_status not in valid_statuses:
+        if previous is None:
             return {
                 'success': False,
-                'error': 'حالة غير صحيحة'
+                'error': 'الطلب غير موجود'
             }
         
-        self.sell_requests[request_id]['status'] = new_status
-        self.sell_requests[request_id]['updated_at'] = datetime.now().isoformat()
+        if not updated:
+            return {
+                'success': False,
+                'error': f'لا يمكن تغيير الحالة من {previous} إلى {new_status}',
+                'current_status': previous
+            }
         
-        logger.info(f"📝 تحديث حالة الطلب {request_id} إلى {new_status}")
+        logger.info(f"📝 تحديث حالة الطلب {request_id} من {previous} إلى {new_status}")
         
         return {
             'success': True,
+            'previous_status': previous,
             'message': f'تم تحديث الحالة إلى {new_status}'
         }
     
+    def reconcile_statistics(self):
+        """مطابقة العدادات مع الطلبات المحفوظة وتصحيح أي فرق"""
+        with self.reconcile_lock:
+            drift = self.store.reconcile_counters()
+            if drift is None:
+                # كتابة جديدة أثناء التجميع - النتيجة قديمة، المحاولة في الدورة التالية
+                return {
+                    'success': False,
+                    'drift': None,
+                    'message': 'تغيرت الطلبات أثناء المطابقة'
+                }
+            self.stats_reconciled_at = time.time()
+        
+        if drift:
+            logger.warning(f"📊 تصحيح عدادات إحصائيات البيع: {drift}")
+        
+        return {
+            'success': True,
+            'drift': drift
+        }
+    
+    def start_reconciler(self):
+        """تشغيل خيط المطابقة الدورية (مرة واحدة لكل عملية - آمن بعد fork)"""
+        if self.reconciler_pid == os.getpid():
+            return
+        with self.reconcile_lock:
+            if self.reconciler_pid == os.getpid():
+                return
+            self.reconciler_pid = os.getpid()
+            threading.Thread(target=self._reconcile_loop, name='sell-stats-reconcile', daemon=True).start()
+    
+    def _reconcile_loop(self):
+        while True:
+            # العدادات تُحدث مع كل كتابة - المطابقة لتصحيح الانحراف فقط، لا حاجة لها عند التشغيل
+            time.sleep(self.stats_reconcile_interval)
+            try:
+                self.reconcile_statistics()
+            except Exception as e:
+                logger.error(f"خطأ في مطابقة عدادات البيع: {str(e)}")
+    
     def get_statistics(self):
-        """الحصول على إحصائيات عامة"""
-        total_requests = len(self.sell_requests)
-        total_coins = 0
-        total_value = 0
+        """الحصول على إحصائيات عامة (قراءة العدادات بدون المرور على الطلبات)"""
+        # المطابقة الكاملة في الخلفية فقط - لا تجميع على الجدول داخل الطلب
+        self.start_reconciler()
+        
+        counters = self.store.get_counters()
         
         status_counts = {
-            'pending': 0,
-            'processing': 0,
-            'completed': 0,
-            'cancelled': 0
+            status: int(counters.get(f'status:{status}', 0))
+            for status in self.VALID_STATUSES
         }
         
         transfer_type_counts = {
-            'instant': 0,
-            'normal': 0
+            transfer_type: int(counters.get(f'transfer_type:{transfer_type}', 0))
+            for transfer_type in self.conversion_rates
         }
         
-        ea_accounts_count = 0
-        
-        for request in self.sell_requests.values():
-            total_coins += request.get('coins_amount', 0)
-            total_value += request.get('pricing', {}).get('final_price', 0)
-            
-            status = request.get('status')
-            if status in status_counts:
-                status_counts[status] += 1
-            
-            transfer_type = request.get('transfer_type')
-            if transfer_type in transfer_type_counts:
-                transfer_type_counts[transfer_type] += 1
-            
-            # عد الحسابات مع بيانات EA
-            if request.get('ea_account', {}).get('email'):
-                ea_accounts_count += 1
-        
         return {
-            'total_requests': total_requests,
-            'total_coins': total_coins,
-            'total_value': round(total_value, 2),
+            'total_requests': int(counters.get('total_requests', 0)),
+            'total_coins': int(counters.get('total_coins', 0)),
+            'total_value': round(counters.get('total_value', 0), 2),
             'status_counts': status_counts,
             'transfer_type_counts': transfer_type_counts,
-            'ea_accounts_count': ea_accounts_count,
-            'coin_price': self.coin_price_egp
+            'ea_accounts_count': int(counters.get('ea_accounts', 0)),
+            'coin_price': self.coin_price_egp,
+            'reconciled_at': (datetime.fromtimestamp(self.stats_reconciled_at).isoformat()
+                              if self.stats_reconciled_at else None)
         }
     
     def sanitize_input(self, text):
@@ -379,8 +434,11 @@ def calculate_price(coins_amount, transfer_type='normal'):
 def get_sell_request(request_id):
     return sell_handler.get_sell_request(request_id)
 
-def get_user_requests(user_id):
-    return sell_handler.get_user_requests(user_id)
+def get_user_requests(user_id, limit=20, cursor=None):
+    return sell_handler.get_user_requests(user_id, limit, cursor)
+
+def update_request_status(request_id, new_status, expected_status=None):
+    return sell_handler.update_request_status(request_id, new_status, expected_status)
 
 def get_statistics():
     return sell_handler.get_statistics()
@@ -0,0 +1,421 @@
+# sell_store.py - مخزن طلبات بيع الكوينز الدائم
+"""
+🗄️ مخزن طلبات البيع - FC 26 Profile System
+==========================================
+طبقة تخزين قابلة للاستبدال لوزارة بيع الكوينز
+- ذاكرة العملية (للتطوير والاختبارات)
+- SQLite (WAL) مشترك بين جميع gunicorn workers ويبقى بعد إعادة النشر
+- فهارس على المستخدم والحالة وتاريخ الإنشاء
+- صفحات بالمفتاح (created_at, request_id) لطلبات المستخدم
+- تغيير الحالة ذري: مشرفان في نفس اللحظة لا يمكن أن ينجحا معاً
+- عدادات الإحصائيات تُحدث في نفس معاملة الإنشاء/تغيير الحالة (قراءة O(1))
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+from profile_store import bump_version, ensure_version_row, read_version, sqlite_path_from_url
+from system_metrics import timed_write
+
+
+def order_cursor(order):
+    """مفتاح الصفحة لطلب: (تاريخ الإنشاء، المعرف)"""
+    return (order['created_at'], order['request_id'])
+
+
+def order_counters(order):
+    """تغييرات العدادات عند إنشاء طلب: [(اسم العداد، الزيادة)]"""
+    counters = [
+        ('total_requests', 1),
+        ('total_coins', order.get('coins_amount', 0)),
+        ('total_value', order.get('pricing', {}).get('final_price', 0)),
+        (f"status:{order['status']}", 1),
+        (f"transfer_type:{order.get('transfer_type')}", 1)
+    ]
+    if order.get('ea_account', {}).get('email'):
+        counters.append(('ea_accounts', 1))
+    return counters
+
+
+def counters_drift(stored, actual):
+    """الفرق بين العدادات المحفوظة والقيم الفعلية (للتسجيل بعد المطابقة)"""
+    return {
+        name: round(actual.get(name, 0) - stored.get(name, 0), 2)
+        for name in set(stored) | set(actual)
+        if abs(actual.get(name, 0) - stored.get(name, 0)) > 0.001
+    }
+
+
+class MemorySellStore:
+    """مخزن في ذاكرة العملية - قاموس بالمعرف + قوائم معرفات لكل مستخدم"""
+
+    def __init__(self):
+        self.orders = {}
+        self.user_index = {}
+        self.counters = {}
+        self.version = 0
+        self.lock = threading.RLock()
+
+    def _bump(self, name, delta):
+        self.counters[name] = self.counters.get(name, 0) + delta
+
+    def insert(self, order):
+        with self.lock:
+            self.orders[order['request_id']] = json.loads(json.dumps(order))
+            user_id = order.get('user_info', {}).get('user_id')
+            self.user_index.setdefault(user_id, []).append(order['request_id'])
+            for name, delta in order_counters(order):
+                self._bump(name, delta)
+            self.version += 1
+
+    def get(self, request_id):
+        with self.lock:
+            order = self.orders.get(request_id)
+            return json.loads(json.dumps(order)) if order else None
+
+    def list_by_user(self, user_id, limit=20, before=None):
+        """طلبات مستخدم من الأحدث للأقدم - before = مفتاح آخر طلب في الصفحة السابقة"""
+        with self.lock:
+            orders = [self.orders[request_id] for request_id in self.user_index.get(user_id, [])]
+        orders.sort(key=order_cursor, reverse=True)
+        if before is not None:
+            orders = [order for order in orders if order_cursor(order) < tuple(before)]
+        return [json.loads(json.dumps(order)) for order in orders[:limit]]
+
+    def transition_status(self, request_id, new_status, allowed_from, updated_at):
+        """تغيير الحالة إذا كانت الحالية ضمن allowed_from - يرجع (الحالة السابقة، تم التغيير)"""
+        with self.lock:
+            order = self.orders.get(request_id)
+            if order is None:
+                return None, False
+            previous = order['status']
+            if previous not in allowed_from:
+                return previous, False
+            order['status'] = new_status
+            order['updated_at'] = updated_at
+            self._bump(f'status:{previous}', -1)
+            self._bump(f'status:{new_status}', 1)
+            self.version += 1
+            return previous, True
+
+    def get_counters(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def reconcile_counters(self):
+        """إعادة حساب العدادات من الطلبات نفسها - يرجع الفرق الذي تم تصحيحه"""
+        with self.lock:
+            actual = {}
+            for order in self.orders.values():
+                for name, delta in order_counters(order):
+                    actual[name] = actual.get(name, 0) + delta
+            drift = counters_drift(self.counters, actual)
+            self.counters = actual
+            if drift:
+                self.version += 1
+            return drift
+
+    def iter_all(self, page_size=500):
+        with self.lock:
+            request_ids = sorted(self.orders)
+        for request_id in request_ids:
+            order = self.get(request_id)
+            if order is not None:
+                yield order
+
+    def iter_volume_pages(self, page_size=5000):
+        """(وقت الإنشاء، نوع التحويل، الحالة، السعر النهائي) لكل طلب على صفحات"""
+        with self.lock:
+            rows = [
+                (order['created_at'], order.get('transfer_type'), order['status'],
+                 order.get('pricing', {}).get('final_price', 0))
+                for order in self.orders.values()
+            ]
+        for start in range(0, len(rows), page_size):
+            yield rows[start:start + page_size]
+
+    def count(self):
+        return len(self.orders)
+
+    def get_version(self):
+        return self.version
+
+    def clear(self):
+        with self.lock:
+            self.orders.clear()
+            self.user_index.clear()
+            self.counters.clear()
+            self.version += 1
+
+
+class SQLiteSellStore:
+    """مخزن SQLite (WAL) - الحالة والتواريخ أعمدة مفهرسة وباقي الطلب JSON"""
+
+    def __init__(self, db_path='fc26_profiles.db'):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+
+    def _connect(self):
+        """اتصال SQLite خاص بكل خيط"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self._ensure_schema(conn)
+        return conn
+
+    def _ensure_schema(self, conn):
+        with self.schema_lock:
+            if self.schema_ready:
+                return
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sell_orders (
+                    request_id TEXT PRIMARY KEY,
+                    user_id TEXT,
+                    status TEXT NOT NULL,
+                    transfer_type TEXT,
+                    coins_amount INTEGER NOT NULL DEFAULT 0,
+                    final_price REAL NOT NULL DEFAULT 0,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    data TEXT NOT NULL
+                )
+            ''')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_sell_orders_user_created '
+                'ON sell_orders (user_id, created_at, request_id)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_sell_orders_status_created '
+                'ON sell_orders (status, created_at)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_sell_orders_created '
+                'ON sell_orders (created_at)'
+            )
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sell_stats (
+                    name TEXT PRIMARY KEY,
+                    value REAL NOT NULL DEFAULT 0
+                )
+            ''')
+            ensure_version_row(conn, 'sell_orders')
+            self.schema_ready = True
+
+    @staticmethod
+    def _order(row):
+        """دمج أعمدة الحالة مع بيانات الطلب المحفوظة"""
+        order = json.loads(row['data'])
+        order['status'] = row['status']
+        order['updated_at'] = row['updated_at']
+        return order
+
+    @staticmethod
+    def _bump(conn, changes):
+        conn.executemany(
+            'INSERT INTO sell_stats (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            changes
+        )
+
+    def insert(self, order):
+        with timed_write(self.db_path):
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(
+                    'INSERT INTO sell_orders (request_id, user_id, status, transfer_type, coins_amount, '
+                    'final_price, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        order['request_id'],
+                        order.get('user_info', {}).get('user_id'),
+                        order['status'],
+                        order.get('transfer_type'),
+                        order.get('coins_amount', 0),
+                        order.get('pricing', {}).get('final_price', 0),
+                        order['created_at'],
+                        order['updated_at'],
+                        json.dumps(order, ensure_ascii=False)
+                    )
+                )
+                self._bump(conn, order_counters(order))
+                bump_version(conn, 'sell_orders')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def get(self, request_id):
+        row = self._connect().execute(
+            'SELECT status, updated_at, data FROM sell_orders WHERE request_id = ?', (request_id,)
+        ).fetchone()
+        return self._order(row) if row else None
+
+    def list_by_user(self, user_id, limit=20, before=None):
+        """طلبات مستخدم من الأحدث للأقدم عبر الفهرس - before = مفتاح آخر طلب في الصفحة السابقة"""
+        conn = self._connect()
+        if before is None:
+            rows = conn.execute(
+                'SELECT status, updated_at, data FROM sell_orders WHERE user_id = ? '
+                'ORDER BY created_at DESC, request_id DESC LIMIT ?',
+                (user_id, limit)
+            ).fetchall()
+        else:
+            created_at, request_id = before
+            rows = conn.execute(
+                'SELECT status, updated_at, data FROM sell_orders WHERE user_id = ? '
+                'AND (created_at, request_id) < (?, ?) '
+                'ORDER BY created_at DESC, request_id DESC LIMIT ?',
+                (user_id, created_at, request_id, limit)
+            ).fetchall()
+        return [self._order(row) for row in rows]
+
+    def transition_status(self, request_id, new_status, allowed_from, updated_at):
+        """تغيير الحالة إذا كانت الحالية ضمن allowed_from - يرجع (الحالة السابقة، تم التغيير)"""
+        with timed_write(self.db_path):
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT status FROM sell_orders WHERE request_id = ?', (request_id,)
+                ).fetchone()
+                if row is None:
+                    conn.execute('ROLLBACK')
+                    return None, False
+                previous = row[0]
+                if previous not in allowed_from:
+                    conn.execute('ROLLBACK')
+                    return previous, False
+                conn.execute(
+                    'UPDATE sell_orders SET status = ?, updated_at = ? WHERE request_id = ?',
+                    (new_status, updated_at, request_id)
+                )
+                self._bump(conn, [(f'status:{previous}', -1), (f'status:{new_status}', 1)])
+                bump_version(conn, 'sell_orders')
+                conn.execute('COMMIT')
+                return previous, True
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def get_counters(self):
+        return {
+            row['name']: row['value']
+            for row in self._connect().execute('SELECT name, value FROM sell_stats')
+        }
+
+    def reconcile_counters(self):
+        """إعادة حساب العدادات بتجميع SQL على الجدول - يرجع الفرق الذي تم تصحيحه
+
+        التجميع يُقرأ من لقطة قراءة (WAL) بدون قفل الكتابة، ثم تُستبدل العدادات في معاملة
+        قصيرة فقط إذا لم يتغير عداد النسخة منذ القراءة (compare-and-swap).
+        يرجع None إذا سبقتنا كتابة - المحاولة في الدورة التالية
+        """
+        conn = self._connect()
+        conn.execute('BEGIN')
+        try:
+            seen_version = read_version(conn, 'sell_orders')
+            totals = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(coins_amount), 0), COALESCE(SUM(final_price), 0), '
+                "COALESCE(SUM(COALESCE(json_extract(data, '$.ea_account.email'), '') != ''), 0) "
+                'FROM sell_orders'
+            ).fetchone()
+            actual = {
+                'total_requests': totals[0],
+                'total_coins': totals[1],
+                'total_value': totals[2],
+                'ea_accounts': totals[3]
+            }
+            for row in conn.execute('SELECT status, COUNT(*) FROM sell_orders GROUP BY status'):
+                actual[f'status:{row[0]}'] = row[1]
+            for row in conn.execute('SELECT transfer_type, COUNT(*) FROM sell_orders GROUP BY transfer_type'):
+                actual[f'transfer_type:{row[0]}'] = row[1]
+
+            drift = counters_drift(self.get_counters(), actual)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        if not drift:
+            return drift
+
+        with timed_write(self.db_path):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if read_version(conn, 'sell_orders') != seen_version:
+                    conn.execute('ROLLBACK')
+                    return None
+                conn.execute('DELETE FROM sell_stats')
+                conn.executemany('INSERT INTO sell_stats (name, value) VALUES (?, ?)', list(actual.items()))
+                bump_version(conn, 'sell_orders')
+                conn.execute('COMMIT')
+                return drift
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def iter_all(self, page_size=500):
+        """كل الطلبات على صفحات بالمفتاح - ذاكرة ثابتة مهما كان العدد"""
+        conn = self._connect()
+        last_request_id = ''
+        while True:
+            rows = conn.execute(
+                'SELECT request_id, status, updated_at, data FROM sell_orders '
+                'WHERE request_id > ? ORDER BY request_id LIMIT ?',
+                (last_request_id, page_size)
+            ).fetchall()
+            if not rows:
+                return
+            last_request_id = rows[-1]['request_id']
+            for row in rows:
+                yield self._order(row)
+
+    def iter_volume_pages(self, page_size=5000):
+        """(وقت الإنشاء، نوع التحويل، الحالة، السعر النهائي) من الأعمدة مباشرة بدون data"""
+        conn = self._connect()
+        last_rowid = 0
+        while True:
+            rows = conn.execute(
+                'SELECT rowid, created_at, transfer_type, status, final_price FROM sell_orders '
+                'WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (last_rowid, page_size)
+            ).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [tuple(row)[1:] for row in rows]
+
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM sell_orders').fetchone()[0]
+
+    def get_version(self):
+        """عداد يزيد مع كل طلب جديد أو تغيير حالة من أي worker"""
+        return read_version(self._connect(), 'sell_orders')
+
+    def clear(self):
+        self._connect().execute('DELETE FROM sell_orders')
+        self._connect().execute('DELETE FROM sell_stats')
+        bump_version(self._connect(), 'sell_orders')
+
+
+def create_sell_store():
+    """إنشاء المخزن حسب متغيرات البيئة (نفس ملف SQLite للملفات الشخصية افتراضياً)"""
+    backend_name = os.environ.get('SELL_STORE_BACKEND', 'sqlite').lower()
+    if backend_name == 'memory':
+        return MemorySellStore()
+
+    database_url = os.environ.get('DATABASE_URL', 'sqlite:///fc26_profiles.db')
+    db_path = sqlite_path_from_url(database_url)
+    if db_path is None:
+        print("⚠️ DATABASE_URL ليس SQLite - استخدام fc26_profiles.db لطلبات البيع")
+        db_path = 'fc26_profiles.db'
+    return SQLiteSellStore(db_path)
@@ -37,11 +37,25 @@
                 recent_activity: null,
                 last_updated: null
             };
+            // رقم نسخة آخر بيانات مستلمة (ETag) - للطلبات الشرطية والردود الجزئية
+            this.version = null;
             this.loading = false;
             this.error = null;
             this.retryCount = 0;
         }
 
+        mergeDelta(delta) {
+            // الأقسام المتغيرة فقط + النشاطات الجديدة تضاف في أول القائمة
+            const previousActivities = (this.data.recent_activity && this.data.recent_activity.activities) || [];
+            const newActivities = (delta.recent_activity && delta.recent_activity.activities) || [];
+
+            Object.assign(this.data, delta);
+            this.data.recent_activity = {
+                ...delta.recent_activity,
+                activities: newActivities.concat(previousActivities).slice(0, 30)
+            };
+        }
+
         async fetchDashboardData() {
             if (this.loading) {
                 console.log('🏰 البيانات قيد التحميل...');
@@ -52,14 +66,28 @@
             this.error = null;
 
             try {
-                const response = await fetch('/api/dashboard-data', {
+                const headers = {
+                    'Content-Type': 'application/json',
+                    'X-Requested-With': 'XMLHttpRequest'
+                };
+                let url = '/api/dashboard-data';
+                if (this.version) {
+                    headers['If-None-Match'] = `"${this.version}"`;
+                    url += `?since=${encodeURIComponent(this.version)}`;
+                }
+
+                const response = await fetch(url, {
                     method: 'GET',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'X-Requested-With': 'XMLHttpRequest'
-                    }
+                    cache: 'no-store',
+                    headers
                 });
 
+                // 304: لا شيء تغير منذ آخر طلب
+                if (response.status === 304) {
+                    this.retryCount = 0;
+                    return true;
+                }
+
                 if (!response.ok) {
                     throw new Error(`HTTP Error: ${response.status}`);
                 }
@@ -67,7 +95,12 @@
                 const result = await response.json();
 
                 if (result.success) {
-                    this.data = result.dashboard_data;
+                    if (result.delta) {
+                        this.mergeDelta(result.dashboard_data);
+                    } else {
+                        this.data = result.dashboard_data;
+                    }
+                    this.version = result.version;
                     this.data.last_updated = new Date().toISOString();
                     this.retryCount = 0;
 
@@ -422,28 +455,17 @@
             }, 3000);
         }
 
-        async exportData() {
+        exportData() {
             try {
-                const response = await fetch('/api/dashboard-export', {
-                    method: 'GET',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'X-Requested-With': 'XMLHttpRequest'
-                    }
-                });
-
-                if (response.ok) {
-                    const blob = await response.blob();
-                    const url = window.URL.createObjectURL(blob);
-                    const a = document.createElement('a');
-                    a.href = url;
-                    a.download = `fc26_dashboard_${new Date().getTime()}.json`;
-                    a.click();
-
-                    this.showSuccessMessage('تم تصدير البيانات بنجاح');
-                } else {
-                    throw new Error('فشل في تصدير البيانات');
-                }
+                // تحميل مباشر من الخادم - الملف يُكتب على القرص أثناء التدفق بدلاً من تجميعه في الذاكرة
+                const a = document.createElement('a');
+                a.href = '/api/dashboard-export?format=ndjson&compress=gzip';
+                a.download = `fc26_dashboard_${new Date().getTime()}.ndjson.gz`;
+                document.body.appendChild(a);
+                a.click();
+                a.remove();
+
+                this.showSuccessMessage('بدأ تصدير البيانات');
 
             } catch (error) {
                 this.showError('خطأ في تصدير البيانات: ' + error.message);
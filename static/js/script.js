@@ -1606,6 +1606,9 @@ console.log('FC 26 Profile Setup - تم تهيئة JavaScript المدمج بن
             this.currentCode = null;
             this.botUsername = null;
             this.pollTimer = null;
+            this.eventSource = null;
+            this.linkTimers = [];
+            this.longPollActive = false;
             this.startedAt = 0;
             this._inited = false;
 
@@ -1847,49 +1850,105 @@ console.log('FC 26 Profile Setup - تم تهيئة JavaScript المدمج بن
         }
 
         startAutoLinking(code) {
-            let attempt = 0;
-            const maxAttempts = 45;
-            if (this.pollTimer) clearInterval(this.pollTimer);
+            this.cleanup();
+
+            const notify = (delay, message) => {
+                this.linkTimers.push(setTimeout(() => {
+                    if (typeof showNotification === 'function') {
+                        showNotification(message, 'info');
+                    }
+                }, delay));
+            };
+            notify(15000, '📡 البحث عن الربط...');
+            notify(30000, '🔍 فحص حالة الاتصال...');
+            notify(60000, '⏳ يرجى التأكد من إرسال الكود للبوت');
+            notify(90000, '⚠️ تأكد من فتح التليجرام وإرسال الكود');
+
+            // المهلة الكلية للانتظار
+            this.pollTimer = setTimeout(() => {
+                this.cleanup();
+                this.showTimeoutError();
+            }, 135000);
+
+            // اتصال واحد ينتظر إشعار الخادم بدلاً من استطلاع كل 3 ثوانٍ
+            if (window.EventSource) {
+                this.startStatusStream(code);
+            } else {
+                this.startLongPoll(code);
+            }
+        }
+
+        handleLinked() {
+            this.cleanup();
+            this.showSuccess();
+        }
+
+        startStatusStream(code) {
+            const source = new EventSource(`/telegram-status-stream/${encodeURIComponent(code)}`);
+            this.eventSource = source;
+            let received = false;
+
+            // خلف proxy يخزن الردود مؤقتاً لن يصل أول حدث - التحويل للـ long-poll
+            this.linkTimers.push(setTimeout(() => {
+                if (!received) this.fallbackFromStream(code);
+            }, 5000));
+
+            source.addEventListener('status', (event) => {
+                received = true;
+                let j = {};
+                try {
+                    j = JSON.parse(event.data);
+                } catch (_) {}
+                if (j.success && j.linked) {
+                    this.handleLinked();
+                }
+            });
+            source.addEventListener('end', () => this.fallbackFromStream(code));
+            source.onerror = () => this.fallbackFromStream(code);
+        }
+
+        fallbackFromStream(code) {
+            if (this.eventSource) {
+                this.eventSource.close();
+                this.eventSource = null;
+            }
+            if (this.pollTimer && !this.longPollActive) {
+                this.startLongPoll(code);
+            }
+        }
+
+        async startLongPoll(code) {
+            this.longPollActive = true;
+            const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
 
-            this.pollTimer = setInterval(async () => {
-                attempt++;
+            while (this.pollTimer && this.longPollActive) {
+                const startedAt = Date.now();
                 try {
-                    const r = await fetch(`/check-telegram-status/${encodeURIComponent(code)}`, {
+                    const r = await fetch(`/wait-telegram-status/${encodeURIComponent(code)}?timeout=25`, {
                         method: 'GET',
                         headers: { 'X-Requested-With': 'XMLHttpRequest', 'Cache-Control': 'no-cache' }
                     });
                     if (r.ok) {
                         const j = await r.json();
                         if (j.success && j.linked) {
-                            clearInterval(this.pollTimer);
-                            this.pollTimer = null;
-                            this.showSuccess();
+                            this.handleLinked();
                             return;
                         }
+                    } else if (r.status === 503) {
+                        // خانات الانتظار في الخادم ممتلئة - الانتظار المطلوب قبل إعادة المحاولة
+                        const retryAfter = parseFloat(r.headers.get('Retry-After')) || 5;
+                        await sleep(retryAfter * 1000);
+                        continue;
                     }
                 } catch (e) {
-                    console.warn('AutoLink poll error:', e);
+                    console.warn('AutoLink long-poll error:', e);
                 }
 
-                if (attempt === 5 && typeof showNotification === 'function') {
-                    showNotification('📡 البحث عن الربط...', 'info');
+                // رد فوري بدون ربط (خطأ أو كود غير موجود) = الرجوع لاستطلاع كل 3 ثوانٍ
+                if (Date.now() - startedAt < 1000) {
+                    await sleep(3000);
                 }
-                if (attempt === 10 && typeof showNotification === 'function') {
-                    showNotification('🔍 فحص حالة الاتصال...', 'info');
-                }
-                if (attempt === 20 && typeof showNotification === 'function') {
-                    showNotification('⏳ يرجى التأكد من إرسال الكود للبوت', 'info');
-                }
-                if (attempt === 30 && typeof showNotification === 'function') {
-                    showNotification('⚠️ تأكد من فتح التليجرام وإرسال الكود', 'info');
-                }
-
-                if (attempt >= maxAttempts) {
-                    clearInterval(this.pollTimer);
-                    this.pollTimer = null;
-                    this.showTimeoutError();
-                }
-            }, 3000);
+            }
         }
 
         async checkAdvancedStatus(code) {
@@ -2008,9 +2067,16 @@ console.log('FC 26 Profile Setup - تم تهيئة JavaScript المدمج بن
 
         cleanup() {
             if (this.pollTimer) {
-                clearInterval(this.pollTimer);
+                clearTimeout(this.pollTimer);
                 this.pollTimer = null;
             }
+            this.linkTimers.forEach((timer) => clearTimeout(timer));
+            this.linkTimers = [];
+            if (this.eventSource) {
+                this.eventSource.close();
+                this.eventSource = null;
+            }
+            this.longPollActive = false;
         }
 
         _onBeforeUnload() {
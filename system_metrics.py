@@ -0,0 +1,209 @@
+# system_metrics.py - مقاييس النظام الحية
+"""
+📈 مقاييس النظام - FC 26 Profile System
+=======================================
+قياسات حقيقية لصحة النظام بتكلفة شبه معدومة
+- histograms بحدود ثابتة (بدون الاحتفاظ بقائمة لكل طلب)
+- زمن الاستجابة لكل مسار HTTP (middleware)
+- زمن الكتابة في ملفات SQLite والاتصالات الخارجية
+- ذاكرة العملية (RSS) وإحصائيات جامع القمامة
+- القياسات لكل worker (كل عملية تجمع قياساتها)
+"""
+
+import bisect
+import gc
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # غير متاح على Windows
+    resource = None
+
+
+# حدود الـ buckets بالمللي ثانية - الطلب يُحسب في أول bucket حده أكبر من زمنه
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+class LatencyHistogram:
+    """توزيع أزمنة بحدود ثابتة - التسجيل O(log buckets) والذاكرة ثابتة"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+        self.last_at = None
+        self.lock = threading.Lock()
+
+    def observe(self, elapsed_ms, error=False):
+        index = bisect.bisect_left(self.bounds, elapsed_ms)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_ms += elapsed_ms
+            self.last_ms = elapsed_ms
+            self.last_at = time.time()
+            if elapsed_ms > self.max_ms:
+                self.max_ms = elapsed_ms
+            if error:
+                self.errors += 1
+
+    def percentile(self, fraction):
+        """الحد الأعلى للـ bucket الذي يقع فيه الترتيب المطلوب (تقدير من الأعلى)"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                if index < len(self.bounds):
+                    return float(min(self.bounds[index], self.max_ms))
+                return self.max_ms
+        return self.max_ms
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'errors': self.errors,
+                'error_rate': round(self.errors / self.count, 4) if self.count else 0,
+                'avg_ms': round(self.total_ms / self.count, 2) if self.count else 0,
+                'p50_ms': round(self.percentile(0.50), 2),
+                'p95_ms': round(self.percentile(0.95), 2),
+                'p99_ms': round(self.percentile(0.99), 2),
+                'max_ms': round(self.max_ms, 2),
+                'last_ms': round(self.last_ms, 2),
+                'last_at': self.last_at
+            }
+
+
+class MetricsRegistry:
+    """مجموعات histograms بالاسم: مسارات HTTP، hosts خارجية، ملفات SQLite"""
+
+    def __init__(self):
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, group, name):
+        histograms = self.groups.get(group)
+        if histograms is None or name not in histograms:
+            with self.lock:
+                histograms = self.groups.setdefault(group, {})
+                histograms.setdefault(name, LatencyHistogram())
+        return histograms[name]
+
+    def observe(self, group, name, elapsed_ms, error=False):
+        self.histogram(group, name).observe(elapsed_ms, error)
+
+    def get_group(self, group):
+        with self.lock:
+            histograms = dict(self.groups.get(group, {}))
+        return {name: histogram.get_stats() for name, histogram in sorted(histograms.items())}
+
+    def reset(self):
+        with self.lock:
+            self.groups = {}
+
+
+# إنشاء instance عام مشترك بين جميع الوزارات
+metrics = MetricsRegistry()
+
+
+# ============================================================================
+# ⏱️ أدوات القياس
+# ============================================================================
+
+@contextmanager
+def timed_write(db_path):
+    """قياس زمن كتابة في ملف SQLite (يُسجل حتى عند الفشل)"""
+    started = time.perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        metrics.observe('sqlite_writes', os.path.basename(db_path),
+                        (time.perf_counter() - started) * 1000, error)
+
+
+def install_request_timing(app):
+    """middleware لقياس زمن كل طلب حسب المسار (قالب المسار وليس الرابط الفعلي)"""
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            rule = request.url_rule.rule if request.url_rule else 'unmatched'
+            metrics.observe('requests', f"{request.method} {rule}",
+                            (time.perf_counter() - started) * 1000,
+                            error=response.status_code >= 500)
+        return response
+
+
+# ============================================================================
+# 🧠 العملية و SQLite
+# ============================================================================
+
+def get_process_stats():
+    """ذاكرة العملية الحالية والقصوى وإحصائيات جامع القمامة"""
+    rss_bytes = None
+    try:
+        # Linux: الصفحات المقيمة حالياً
+        with open('/proc/self/statm') as f:
+            rss_bytes = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    peak_rss_bytes = None
+    if resource is not None:
+        # ru_maxrss بالكيلوبايت على Linux
+        peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        if rss_bytes is None:
+            rss_bytes = peak_rss_bytes
+
+    return {
+        'pid': os.getpid(),
+        'rss_mb': round(rss_bytes / 1024 / 1024, 1) if rss_bytes else None,
+        'peak_rss_mb': round(peak_rss_bytes / 1024 / 1024, 1) if peak_rss_bytes else None,
+        'threads': threading.active_count(),
+        'gc': {
+            'enabled': gc.isenabled(),
+            'pending': gc.get_count(),
+            'collections': [generation['collections'] for generation in gc.get_stats()],
+            'collected': sum(generation['collected'] for generation in gc.get_stats()),
+            'uncollectable': sum(generation['uncollectable'] for generation in gc.get_stats())
+        }
+    }
+
+
+def get_sqlite_stats(db_paths):
+    """حجم كل ملف SQLite (مع ملف WAL) وآخر زمن كتابة مسجل"""
+    writes = metrics.get_group('sqlite_writes')
+    files = {}
+    for db_path in dict.fromkeys(path for path in db_paths if path):
+        name = os.path.basename(db_path)
+        size = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+        wal_path = f"{db_path}-wal"
+        wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        write_stats = writes.get(name, {})
+        files[name] = {
+            'exists': os.path.exists(db_path),
+            'size_kb': round(size / 1024, 1),
+            'wal_size_kb': round(wal_size / 1024, 1),
+            'writes': write_stats.get('count', 0),
+            'last_write_ms': write_stats.get('last_ms'),
+            'p95_write_ms': write_stats.get('p95_ms')
+        }
+    return files
@@ -7,14 +7,244 @@
 import os
 import secrets
 import json
-import requests
+import sqlite3
+import threading
+import time
+from collections import deque
 from datetime import datetime
 import hashlib
 
+from http_client import http_client
+from telegram_outbox import RetryAfter, TelegramOutbox
+from telegram_store import TelegramCodeStore
+
+
+class TelegramSendScheduler:
+    """جدولة الإرسال حسب حدود التليجرام: حد عام + حد لكل محادثة
+
+    حالة الدلاء في جدول SQLite داخل ملف طابور الصادر - مشتركة بين كل gunicorn workers
+    حتى لا يتضاعف الحد بعدد العمليات. الطابور يحجز الرمز داخل نفس معاملة حجز الرسالة.
+    """
+    
+    # أقصى طول لرسالة تليجرام
+    MAX_MESSAGE_LENGTH = 4096
+    DIGEST_SEPARATOR = "\n\n━━━━━━━━━━━━━━\n\n"
+    
+    # دلو المحادثة الممتلئ وغير المستخدم لهذه المدة يُحذف (إعادة إنشائه = نفس الحالة)
+    IDLE_BUCKET_SECONDS = 60 * 60
+    
+    def __init__(self, global_rate=None, chat_rate=None, chat_burst=None, db_path=None):
+        # ~30 رسالة/ثانية للبوت كاملاً و ~1 رسالة/ثانية لكل محادثة
+        self.global_rate = float(global_rate or os.environ.get('TELEGRAM_GLOBAL_RATE', '30'))
+        self.chat_rate = float(chat_rate or os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+        self.chat_burst = float(chat_burst or os.environ.get('TELEGRAM_CHAT_BURST', '1'))
+        # TelegramOutbox يضبطه على ملف الطابور نفسه
+        self.db_path = db_path or os.environ.get('TELEGRAM_OUTBOX_PATH', 'fc26_telegram_outbox.db')
+        
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        
+        # أنواع الرسائل التي تُدمج في ملخص واحد عند الازدحام
+        self.coalesce_kinds = {'admin'}
+        
+        self.rate_limited = 0
+        self.digests_built = 0
+    
+    def _connect(self):
+        """اتصال SQLite خاص بكل خيط (للاستدعاء خارج معاملة الطابور)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid() or self.local.path != self.db_path:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.ensure_schema(conn)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self.local.path = self.db_path
+        return conn
+    
+    @staticmethod
+    def ensure_schema(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS telegram_rate_buckets (
+                bucket TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                blocked_until REAL NOT NULL DEFAULT 0
+            )
+        ''')
+    
+    def _bucket_state(self, conn, bucket, rate, capacity, now):
+        """(الرموز بعد إعادة الملء، ثواني الانتظار) لدلو من الجدول المشترك"""
+        row = conn.execute(
+            'SELECT tokens, updated_at, blocked_until FROM telegram_rate_buckets WHERE bucket = ?',
+            (bucket,)
+        ).fetchone()
+        tokens, updated_at, blocked_until = row or (capacity, now, 0.0)
+        tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+        
+        if now < blocked_until:
+            return tokens, blocked_until - now
+        if tokens >= 1:
+            return tokens, 0.0
+        return tokens, (1 - tokens) / rate
+    
+    def reserve(self, chat_id, conn=None):
+        """حجز رمز للإرسال - يرجع 0 إذا سُمح بالإرسال الآن أو عدد ثواني الانتظار
+
+        conn: اتصال داخل معاملة BEGIN IMMEDIATE قائمة (حجز رسالة الطابور)، وإلا معاملة خاصة
+        """
+        if conn is not None:
+            return self._reserve(conn, str(chat_id))
+        
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            wait = self._reserve(conn, str(chat_id))
+            conn.execute('COMMIT')
+            return wait
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def _reserve(self, conn, chat_id):
+        now = time.time()
+        global_tokens, global_wait = self._bucket_state(conn, 'global', self.global_rate, self.global_rate, now)
+        chat_tokens, chat_wait = self._bucket_state(conn, f'chat:{chat_id}', self.chat_rate, self.chat_burst, now)
+        wait = max(global_wait, chat_wait)
+        if wait > 0:
+            return wait
+        
+        conn.executemany(
+            'INSERT INTO telegram_rate_buckets (bucket, tokens, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (bucket) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at',
+            [('global', global_tokens - 1, now), (f'chat:{chat_id}', chat_tokens - 1, now)]
+        )
+        return 0.0
+    
+    def pause(self, chat_id, retry_after):
+        """احترام retry_after القادم من رد 429 (لكل العمليات)"""
+        now = time.time()
+        self._connect().execute(
+            'INSERT INTO telegram_rate_buckets (bucket, tokens, updated_at, blocked_until) VALUES (?, 0, ?, ?) '
+            'ON CONFLICT (bucket) DO UPDATE SET blocked_until = excluded.blocked_until',
+            (f'chat:{chat_id}', now, now + retry_after)
+        )
+        with self.lock:
+            self.rate_limited += 1
+    
+    def prune(self, conn=None):
+        """حذف دلاء المحادثات الخاملة - يرجع عدد المحذوف"""
+        cutoff = time.time() - self.IDLE_BUCKET_SECONDS
+        return (conn or self._connect()).execute(
+            "DELETE FROM telegram_rate_buckets WHERE bucket != 'global' "
+            'AND updated_at < ? AND blocked_until < ?',
+            (cutoff, cutoff)
+        ).rowcount
+    
+    def build_digest(self, texts):
+        """دمج عدة إشعارات في رسالة واحدة - يرجع (النص, عدد الإشعارات المدموجة)"""
+        header = f"📬 ملخص {len(texts)} إشعارات جديدة\n\n"
+        parts = []
+        length = len(header)
+        for text in texts:
+            addition = len(text) + (len(self.DIGEST_SEPARATOR) if parts else 0)
+            if parts and length + addition > self.MAX_MESSAGE_LENGTH:
+                break
+            parts.append(text)
+            length += addition
+        
+        if len(parts) == 1:
+            return parts[0], 1
+        
+        with self.lock:
+            self.digests_built += 1
+        header = f"📬 ملخص {len(parts)} إشعارات جديدة\n\n"
+        return header + self.DIGEST_SEPARATOR.join(parts), len(parts)
+    
+    def get_stats(self):
+        tracked = self._connect().execute(
+            "SELECT COUNT(*) FROM telegram_rate_buckets WHERE bucket != 'global'"
+        ).fetchone()[0]
+        return {
+            'global_rate': self.global_rate,
+            'chat_rate': self.chat_rate,
+            'tracked_chats': tracked,
+            'rate_limited_responses': self.rate_limited,
+            'digests_built': self.digests_built
+        }
+
+
+class UpdateDeduplicator:
+    """نافذة update_id المعالجة مؤخراً: حلقة محدودة + set في الذاكرة ثم الحجز في المخزن المشترك
+
+    الذاكرة تحتوي فقط التحديثات التي اكتملت معالجتها - التحديث المحجوز لدى worker آخر
+    (أو الذي فشلت معالجته) يُسأل عنه المخزن في كل إعادة إرسال
+    """
+    
+    def __init__(self, store, window_size=None):
+        self.store = store
+        self.window_size = int(window_size or os.environ.get('TELEGRAM_UPDATE_DEDUP_SIZE', '10000'))
+        self.recent = deque()
+        self.recent_ids = set()
+        self.lock = threading.Lock()
+        
+        self.accepted = 0
+        self.duplicates = 0
+        self.released = 0
+    
+    def _remember(self, update_id):
+        self.recent.append(update_id)
+        self.recent_ids.add(update_id)
+        # إخراج الأقدم لإبقاء الذاكرة محدودة
+        while len(self.recent) > self.window_size:
+            self.recent_ids.discard(self.recent.popleft())
+    
+    def is_new(self, update_id):
+        """True إذا حُجز التحديث لهذا الـ worker - False إذا عولج أو يعالجه worker آخر الآن"""
+        with self.lock:
+            if update_id in self.recent_ids:
+                self.duplicates += 1
+                return False
+        
+        # الـ worker الذي استلم التحديث أولاً قد يكون غيرنا - لا نحفظه في الذاكرة حتى يكتمل
+        if not self.store.register_update(update_id):
+            with self.lock:
+                self.duplicates += 1
+            return False
+        
+        with self.lock:
+            self.accepted += 1
+        return True
+    
+    def complete(self, update_id):
+        """تعليم التحديث كمعالج بالكامل - إعادة إرساله بعد ذلك تُتجاهل دائماً"""
+        self.store.complete_update(update_id)
+        with self.lock:
+            self._remember(update_id)
+    
+    def forget(self, update_id):
+        """تحرير حجز تحديث فشلت معالجته حتى تُقبل إعادة إرسال التليجرام له"""
+        with self.lock:
+            self.accepted -= 1
+            self.released += 1
+        self.store.forget_update(update_id)
+    
+    def get_stats(self):
+        return {
+            'window_size': self.window_size,
+            'tracked_in_memory': len(self.recent),
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'released_after_error': self.released
+        }
+
 
 class TelegramManager:
     """الكلاس الأساسي لإدارة التليجرام"""
     
+    # أقل مدة بين محاولتي تحديث معلومات البوت في الخلفية
+    BOT_INFO_RETRY_SECONDS = 60
+    
     def __init__(self):
         # 🔥 تحميل محسن من متغيرات البيئة
         self.bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
@@ -26,32 +256,53 @@ class TelegramManager:
         # تحديث URL الـ webhook تلقائياً
         self.webhook_url = 'https://ea-fc-fifa-5jbn.onrender.com/telegram-webhook'
         
-        # محاولة الحصول على اسم البوت من API إذا كان التوكن موجوداً
+        # 👮 محادثة الإدارة لإشعارات طلبات البيع
+        self.admin_chat_id = os.environ.get('TELEGRAM_ADMIN_CHAT_ID') or os.environ.get('TELEGRAM_CHAT_ID')
+        
+        # 🚦 جدولة الإرسال حسب حدود التليجرام
+        self.scheduler = TelegramSendScheduler()
+        
+        # 📮 طابور الرسائل الصادرة - الإرسال الفعلي يتم في الخلفية
+        self.outbox = TelegramOutbox(self.deliver_message, scheduler=self.scheduler)
+        
+        # 🐞 طباعة التحديث كاملاً فقط عند التشخيص (مكلفة أثناء موجات إعادة الإرسال)
+        self.debug_webhook = os.environ.get('TELEGRAM_DEBUG_WEBHOOK', 'false').lower() == 'true'
+        
+        # 🤖 معلومات البوت من ملف مؤقت - لا اتصال بالتليجرام أثناء تشغيل الـ worker
+        self.bot_info_path = os.environ.get('TELEGRAM_BOT_INFO_PATH', 'fc26_telegram_bot.json')
+        self.bot_info_ttl = int(os.environ.get('TELEGRAM_BOT_INFO_TTL', 24 * 60 * 60))
+        self.bot_info = None
+        self.bot_info_fetched_at = 0
+        self.bot_info_lock = threading.Lock()
+        self.bot_info_refreshing = False
+        self.bot_info_attempted_at = 0
+        
         if self.bot_token:
-            bot_info = self.get_bot_info_init()
-            if bot_info and bot_info.get('username'):
-                self.bot_username = bot_info.get('username')
-                print(f"✅ تم الحصول على اسم البوت من API: @{self.bot_username}")
+            if self.load_cached_bot_info():
+                print(f"✅ اسم البوت من الملف المؤقت: @{self.bot_username}")
             else:
-                print(f"⚠️ استخدام اسم البوت الافتراضي: @{self.bot_username}")
+                # سيتم تحديثه في الخلفية عند أول طلب
+                print(f"⚠️ استخدام اسم البوت الافتراضي مؤقتاً: @{self.bot_username}")
         else:
             print(f"⚠️ لا يوجد توكن - استخدام اسم البوت الافتراضي: @{self.bot_username}")
         
         # 🔥 تشخيص فوري
         self.diagnose_telegram_config()
         
-        # قاعدة بيانات الأكواد في الذاكرة
-        self.telegram_codes = {}
-        self.users_data = {}
+        # 🗄️ مخزن الأكواد والمستخدمين المربوطين (SQLite مشترك بين الـ workers)
+        self.code_store = TelegramCodeStore()
+        
+        # 🔁 تجاهل التحديثات التي يعيد التليجرام إرسالها
+        self.update_dedup = UpdateDeduplicator(self.code_store)
     
-    def get_bot_info_init(self):
-        """الحصول على معلومات البوت عند التهيئة بدون طباعة"""
+    def fetch_bot_info(self):
+        """استدعاء getMe مباشرة بدون طباعة - يرجع معلومات البوت أو None"""
         if not self.bot_token:
             return None
         
         try:
             url = f"https://api.telegram.org/bot{self.bot_token}/getMe"
-            response = requests.get(url, timeout=10)
+            response = http_client.get(url, timeout=10)
             result = response.json()
             
             if result.get('ok'):
@@ -62,6 +313,84 @@ class TelegramManager:
         except Exception:
             return None
     
+    def bot_cache_key(self):
+        """معرف البوت من التوكن (الجزء العام قبل :) لتجاهل ملف يخص بوتاً آخر"""
+        return self.bot_token.split(':')[0] if self.bot_token else None
+    
+    def load_cached_bot_info(self):
+        """تحميل معلومات البوت من الملف المؤقت - True إذا وُجدت"""
+        try:
+            with open(self.bot_info_path, encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        
+        bot_info = cached.get('bot_info') or {}
+        if cached.get('bot_id') != self.bot_cache_key() or not bot_info.get('username'):
+            return False
+        
+        self.bot_info = bot_info
+        self.bot_info_fetched_at = cached.get('fetched_at', 0)
+        self.bot_username = bot_info['username']
+        return True
+    
+    def save_bot_info(self, bot_info):
+        """كتابة معلومات البوت للملف المؤقت (كتابة ذرية) ثم تحديثها في الذاكرة"""
+        fetched_at = time.time()
+        temp_path = f"{self.bot_info_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'bot_id': self.bot_cache_key(),
+                    'bot_info': bot_info,
+                    'fetched_at': fetched_at
+                }, f, ensure_ascii=False)
+            os.replace(temp_path, self.bot_info_path)
+        except OSError as e:
+            print(f"خطأ في حفظ معلومات البوت: {str(e)}")
+        
+        self.bot_info = bot_info
+        self.bot_info_fetched_at = fetched_at
+        if bot_info.get('username'):
+            self.bot_username = bot_info['username']
+    
+    def refresh_bot_info(self):
+        """جلب معلومات البوت من API وحفظها - يرجع True عند النجاح"""
+        bot_info = self.fetch_bot_info()
+        if bot_info and bot_info.get('username'):
+            self.save_bot_info(bot_info)
+            return True
+        return False
+    
+    def refresh_bot_info_async(self):
+        """تحديث معلومات البوت في خيط خلفي (مرة واحدة في نفس الوقت)"""
+        with self.bot_info_lock:
+            # عدم تكرار المحاولة بسرعة أثناء تعطل التليجرام
+            if self.bot_info_refreshing or time.time() - self.bot_info_attempted_at < self.BOT_INFO_RETRY_SECONDS:
+                return
+            self.bot_info_refreshing = True
+            self.bot_info_attempted_at = time.time()
+        
+        def refresh():
+            try:
+                self.refresh_bot_info()
+            finally:
+                self.bot_info_refreshing = False
+        
+        threading.Thread(target=refresh, name='telegram-bot-info', daemon=True).start()
+    
+    def get_cached_bot_info(self):
+        """معلومات البوت بدون انتظار الشبكة - التحديث يتم في الخلفية عند انتهاء الصلاحية"""
+        if self.bot_token and time.time() - self.bot_info_fetched_at > self.bot_info_ttl:
+            self.refresh_bot_info_async()
+        
+        return self.bot_info or {
+            'username': self.bot_username,
+            'first_name': 'FC 26 Bot',
+            'is_bot': True,
+            'default_mode': True
+        }
+    
     def diagnose_telegram_config(self):
         """تشخيص إعدادات التليجرام - جديد"""
         print("🔍 تشخيص إعدادات التليجرام:")
@@ -85,8 +414,8 @@ class TelegramManager:
             # إذا لم يكن هناك توكن، نعطي رابط مؤقت باسم البوت الافتراضي
             telegram_code = self.generate_telegram_code()
             
-            # حفظ البيانات في الذاكرة المؤقتة
-            self.telegram_codes[telegram_code] = {
+            # حفظ البيانات في المخزن
+            self.code_store.save_code(telegram_code, {
                 'code': telegram_code,
                 'platform': platform,
                 'whatsapp_number': whatsapp_number,
@@ -95,7 +424,7 @@ class TelegramManager:
                 'telegram_username': telegram_username,
                 'created_at': datetime.now().isoformat(),
                 'used': False
-            }
+            })
             
             # استخدام اسم البوت الافتراضي
             telegram_link = f"https://t.me/{self.bot_username}?start={telegram_code}"
@@ -114,8 +443,8 @@ class TelegramManager:
         
         telegram_code = self.generate_telegram_code()
         
-        # حفظ البيانات في الذاكرة المؤقتة
-        self.telegram_codes[telegram_code] = {
+        # حفظ البيانات في المخزن
+        self.code_store.save_code(telegram_code, {
             'code': telegram_code,
             'platform': platform,
             'whatsapp_number': whatsapp_number,
@@ -124,7 +453,7 @@ class TelegramManager:
             'telegram_username': telegram_username,
             'created_at': datetime.now().isoformat(),
             'used': False
-        }
+        })
         
         telegram_link = f"https://t.me/{self.bot_username}?start={telegram_code}"
         
@@ -140,7 +469,14 @@ class TelegramManager:
         }
     
     def send_telegram_message(self, chat_id, message):
-        """إرسال رسالة عبر التليجرام"""
+        """إرسال رسالة عبر التليجرام - عبر الطابور حتى تمر بحدود المعدل في الـ scheduler
+        
+        يرجع True عند إضافة الرسالة للطابور (التوصيل الفعلي في الخلفية)
+        """
+        return self.queue_telegram_message(chat_id, message)
+    
+    def deliver_message(self, chat_id, message):
+        """الإرسال الفعلي لرسالة - يرفع RetryAfter عند تجاوز حدود التليجرام (429)"""
         if not self.bot_token:
             print("⚠️ لا يوجد توكن للبوت")
             return False
@@ -153,11 +489,13 @@ class TelegramManager:
                 'parse_mode': 'HTML'
             }
             
-            response = requests.post(url, json=data, timeout=30)
+            response = http_client.post(url, json=data, timeout=30)
             
             if response.status_code == 200:
                 print(f"✅ تم إرسال رسالة تليجرام بنجاح إلى {chat_id}")
                 return True
+            elif response.status_code == 429:
+                retry_after = self._parse_retry_after(response)
             else:
                 print(f"❌ فشل إرسال رسالة تليجرام: {response.status_code}")
                 print(f"Response: {response.text}")
@@ -166,6 +504,45 @@ class TelegramManager:
         except Exception as e:
             print(f"خطأ في إرسال رسالة تليجرام: {str(e)}")
             return False
+        
+        print(f"🚦 التليجرام طلب الانتظار {retry_after} ثانية للمحادثة {chat_id}")
+        self.scheduler.pause(chat_id, retry_after)
+        raise RetryAfter(retry_after)
+    
+    def _parse_retry_after(self, response):
+        """استخراج retry_after من رد 429"""
+        try:
+            return float(response.json().get('parameters', {}).get('retry_after', 1))
+        except Exception:
+            return float(response.headers.get('Retry-After', 1))
+    
+    def queue_telegram_message(self, chat_id, message, kind='message'):
+        """إضافة رسالة لطابور الإرسال في الخلفية - لا تنتظر رد التليجرام"""
+        if not self.bot_token:
+            print("⚠️ لا يوجد توكن للبوت")
+            return False
+        
+        try:
+            self.outbox.enqueue(chat_id, message, kind)
+            return True
+        except Exception as e:
+            print(f"خطأ في إضافة رسالة تليجرام للطابور: {str(e)}")
+            return False
+    
+    def send_admin_notification(self, message):
+        """إرسال إشعار لمحادثة الإدارة عبر الطابور"""
+        if not self.admin_chat_id:
+            print("⚠️ TELEGRAM_ADMIN_CHAT_ID غير محدد - تم تجاهل إشعار الإدارة")
+            return False
+        
+        return self.queue_telegram_message(self.admin_chat_id, message, kind='admin')
+    
+    def get_outbox_stats(self):
+        """إحصائيات طابور الرسائل الصادرة وجدولة الإرسال"""
+        return {
+            **self.outbox.get_stats(),
+            'scheduler': self.scheduler.get_stats()
+        }
     
     def set_webhook(self, webhook_url=None):
         """تعيين webhook للبوت"""
@@ -178,7 +555,7 @@ class TelegramManager:
             url = f"https://api.telegram.org/bot{self.bot_token}/setWebhook"
             data = {'url': webhook_url}
             
-            response = requests.post(url, json=data, timeout=30)
+            response = http_client.post(url, json=data, timeout=30)
             result = response.json()
             
             if result.get('ok'):
@@ -192,8 +569,26 @@ class TelegramManager:
             print(f"خطأ في تعيين webhook: {str(e)}")
             return {'success': False, 'error': str(e)}
     
+    def ensure_webhook(self, webhook_url=None):
+        """تعيين webhook فقط إذا كان مختلفاً عن المسجل حالياً (للاستخدام مرة واحدة لكل نشر)"""
+        if not self.bot_token:
+            return {'success': False, 'error': 'لا يوجد توكن للبوت'}
+        
+        webhook_url = webhook_url or self.webhook_url
+        
+        try:
+            url = f"https://api.telegram.org/bot{self.bot_token}/getWebhookInfo"
+            result = http_client.get(url, timeout=10).json()
+            if result.get('ok') and result.get('result', {}).get('url') == webhook_url:
+                print(f"✅ webhook مسجل مسبقاً: {webhook_url}")
+                return {'success': True, 'already_set': True}
+        except Exception as e:
+            print(f"خطأ في قراءة webhook الحالي: {str(e)}")
+        
+        return self.set_webhook(webhook_url)
+    
     def get_bot_info(self):
-        """الحصول على معلومات البوت"""
+        """الحصول على معلومات البوت (استدعاء مباشر لـ API)"""
         if not self.bot_token:
             # إرجاع معلومات افتراضية إذا لم يكن هناك توكن
             return {
@@ -205,7 +600,7 @@ class TelegramManager:
         
         try:
             url = f"https://api.telegram.org/bot{self.bot_token}/getMe"
-            response = requests.get(url, timeout=30)
+            response = http_client.get(url, timeout=30)
             result = response.json()
             
             if result.get('ok'):
@@ -213,8 +608,8 @@ class TelegramManager:
                 print(f"🤖 معلومات البوت: {bot_info.get('first_name')} (@{bot_info.get('username')})")
                 # تحديث اسم البوت إذا كان مختلفاً
                 if bot_info.get('username') and bot_info.get('username') != self.bot_username:
-                    self.bot_username = bot_info.get('username')
-                    print(f"✅ تم تحديث اسم البوت إلى: @{self.bot_username}")
+                    print(f"✅ تم تحديث اسم البوت إلى: @{bot_info.get('username')}")
+                self.save_bot_info(bot_info)
                 return bot_info
             else:
                 print(f"❌ فشل الحصول على معلومات البوت: {result}")
@@ -235,49 +630,79 @@ class TelegramManager:
             }
     
     def process_telegram_webhook(self, update_data):
-        """معالجة webhook من التليجرام"""
+        """معالجة webhook من التليجرام
+        
+        update_id يُحجز قبل المعالجة (حتى لا يعالجه workerان معاً) ويُعلّم كمكتمل بعدها.
+        إذا فشلت المعالجة يُحرر الحجز ويُرجع retry=True (رد 500) فيعيد التليجرام الإرسال،
+        وإذا مات الـ worker أثناء المعالجة تُقبل إعادة الإرسال بعد انتهاء مدة الحجز.
+        """
+        update_id = update_data.get('update_id')
+        if update_id is not None and not self.update_dedup.is_new(update_id):
+            return {'ok': True, 'duplicate': True}
+        
         try:
+            result = self.handle_update(update_data)
+        except Exception as e:
+            print(f"خطأ في معالجة webhook: {str(e)}")
+            if update_id is not None:
+                self.update_dedup.forget(update_id)
+            return {'success': False, 'error': str(e), 'retry': True}
+        
+        if update_id is not None:
+            self.update_dedup.complete(update_id)
+        return result
+    
+    def handle_update(self, update_data):
+        """تنفيذ تحديث واحد من التليجرام (أي استثناء يصل لـ process_telegram_webhook)"""
+        update_id = update_data.get('update_id')
+        if self.debug_webhook:
             print(f"🤖 Telegram Webhook received: {json.dumps(update_data, indent=2, ensure_ascii=False)}")
-            
-            if 'message' not in update_data:
-                return {'ok': True}
-            
-            message = update_data['message']
-            text = message.get('text', '').strip().upper()
-            chat_id = message['chat']['id']
-            username = message.get('from', {}).get('username', 'Unknown')
-            first_name = message.get('from', {}).get('first_name', 'مستخدم')
-            
-            # التحقق من كود /start
-            if text.startswith('/START'):
-                if ' ' in text:
-                    code = text.replace('/START ', '').strip().upper()
-                    print(f"🔍 Looking for /start code: {code}")
+        else:
+            print(f"🤖 Telegram Webhook received: update {update_id}")
+        
+        if 'message' not in update_data:
+            return {'ok': True}
+        
+        message = update_data['message']
+        text = message.get('text', '').strip().upper()
+        chat_id = message['chat']['id']
+        username = message.get('from', {}).get('username', 'Unknown')
+        first_name = message.get('from', {}).get('first_name', 'مستخدم')
+        
+        # التحقق من كود /start
+        if text.startswith('/START'):
+            if ' ' in text:
+                code = text.replace('/START ', '').strip().upper()
+                print(f"🔍 Looking for /start code: {code}")
+                
+                # البحث عن الكود في المخزن
+                profile_data = self.code_store.get_code(code)
+                if profile_data is not None:
+                    # تحديث الكود كمستخدم بشكل ذري (لا يربطه workerان معاً)
+                    linked_data = None
+                    if not profile_data.get('used', False):
+                        linked_data = self.code_store.claim_code(code, {
+                            'telegram_chat_id': chat_id,
+                            'telegram_username_actual': username
+                        })
                     
-                    # البحث عن الكود في الذاكرة
-                    if code in self.telegram_codes:
-                        profile_data = self.telegram_codes[code]
-                        if not profile_data.get('used', False):
-                            # تحديث الكود كمستخدم
-                            self.telegram_codes[code]['used'] = True
-                            self.telegram_codes[code]['telegram_chat_id'] = chat_id
-                            self.telegram_codes[code]['telegram_username_actual'] = username
-                            self.telegram_codes[code]['linked'] = True  # 🔥 إضافة حالة الربط
-                            
-                            # إرسال إشعار للموقع
-                            success, user_data = self.notify_website_telegram_linked(
-                                code, profile_data, chat_id, first_name, username
+                    if linked_data is not None:
+                        profile_data = linked_data
+                        
+                        # إرسال إشعار للموقع
+                        success, user_data = self.notify_website_telegram_linked(
+                            code, profile_data, chat_id, first_name, username
+                        )
+                        
+                        if success:
+                            # تحديد نص الدفع
+                            payment_text = self.get_payment_display_text(
+                                profile_data['payment_method'], 
+                                profile_data.get('payment_details', '')
                             )
                             
-                            if success:
-                                # تحديد نص الدفع
-                                payment_text = self.get_payment_display_text(
-                                    profile_data['payment_method'], 
-                                    profile_data.get('payment_details', '')
-                                )
-                                
-                                # إرسال رسالة ترحيب مخصصة
-                                welcome_message = f"""🎮 أهلاً بك {first_name} في FC 26 Profile System!
+                            # إرسال رسالة ترحيب مخصصة
+                            welcome_message = f"""🎮 أهلاً بك {first_name} في FC 26 Profile System!
 
 ✅ تم ربط حسابك بنجاح!
 
@@ -290,28 +715,28 @@ class TelegramManager:
 🔗 رابط الموقع: https://ea-fc-fifa-5jbn.onrender.com/
 
 شكراً لاختيارك خدماتنا! 🚀"""
-                                
-                                # إرسال الرسالة
-                                self.send_telegram_message(chat_id, welcome_message)
-                                
-                                return {
-                                    'success': True,
-                                    'message': 'تم ربط الحساب بنجاح',
-                                    'user_data': user_data
-                                }
-                            else:
-                                return {'success': False, 'message': 'فشل في ربط الحساب'}
+                            
+                            # إرسال الرسالة
+                            self.queue_telegram_message(chat_id, welcome_message)
+                            
+                            return {
+                                'success': True,
+                                'message': 'تم ربط الحساب بنجاح',
+                                'user_data': user_data
+                            }
                         else:
-                            # الكود مستخدم بالفعل
-                            self.send_telegram_message(chat_id, "❌ هذا الكود تم استخدامه من قبل!")
-                            return {'success': False, 'message': 'الكود مستخدم'}
+                            return {'success': False, 'message': 'فشل في ربط الحساب'}
                     else:
-                        # الكود غير موجود
-                        self.send_telegram_message(chat_id, "❌ الكود غير صحيح أو منتهي الصلاحية!")
-                        return {'success': False, 'message': 'كود غير صحيح'}
+                        # الكود مستخدم بالفعل
+                        self.queue_telegram_message(chat_id, "❌ هذا الكود تم استخدامه من قبل!")
+                        return {'success': False, 'message': 'الكود مستخدم'}
                 else:
-                    # لا يوجد كود
-                    welcome_msg = f"""مرحباً {first_name}! 👋
+                    # الكود غير موجود
+                    self.queue_telegram_message(chat_id, "❌ الكود غير صحيح أو منتهي الصلاحية!")
+                    return {'success': False, 'message': 'كود غير صحيح'}
+            else:
+                # لا يوجد كود
+                welcome_msg = f"""مرحباً {first_name}! 👋
 
 أنا بوت FC 26 Profile System 🎮
 
@@ -322,23 +747,19 @@ class TelegramManager:
 4️⃣ اضغط على الرابط لربط حسابك
 
 نحن في انتظارك! 🚀"""
-                    self.send_telegram_message(chat_id, welcome_msg)
-                    return {'success': False, 'message': 'لا يوجد كود'}
-            else:
-                # رسالة عادية
-                help_msg = """📌 تحتاج مساعدة؟
+                self.queue_telegram_message(chat_id, welcome_msg)
+                return {'success': False, 'message': 'لا يوجد كود'}
+        else:
+            # رسالة عادية
+            help_msg = """📌 تحتاج مساعدة؟
 
 يرجى استخدام الرابط من الموقع لربط حسابك.
 
 🔗 الموقع: https://ea-fc-fifa-5jbn.onrender.com
 
 للدعم الفني، تواصل معنا عبر الواتساب المسجل في الموقع."""
-                self.send_telegram_message(chat_id, help_msg)
-                return {'success': True, 'message': 'رسالة عادية'}
-                
-        except Exception as e:
-            print(f"خطأ في معالجة webhook: {str(e)}")
-            return {'success': False, 'error': str(e)}
+            self.queue_telegram_message(chat_id, help_msg)
+            return {'success': True, 'message': 'رسالة عادية'}
     
     def notify_website_telegram_linked(self, code, profile_data, chat_id, first_name, username):
         """إشعار الموقع بنجاح ربط التليجرام"""
@@ -357,7 +778,7 @@ class TelegramManager:
             }
             
             # حفظ في بيانات المستخدمين
-            self.users_data[user_id] = updated_user_data
+            self.code_store.save_user(user_id, updated_user_data)
             
             print(f"🔗 Telegram Linked Successfully!")
             print(f"   User: {first_name} (@{username})")
@@ -399,8 +820,15 @@ class TelegramManager:
     
     def check_telegram_status(self, code):
         """فحص حالة كود التليجرام - مُحسنة"""
-        if code in self.telegram_codes:
-            code_data = self.telegram_codes[code]
+        return self._build_status(self.code_store.get_code(code))
+    
+    def wait_for_telegram_link(self, code, timeout=25):
+        """انتظار ربط الكود حتى المهلة (long-poll) ثم إرجاع الحالة"""
+        return self._build_status(self.code_store.wait_for_link(code, timeout))
+    
+    def _build_status(self, code_data):
+        """تحويل بيانات الكود لرد حالة الربط"""
+        if code_data is not None:
             is_linked = code_data.get('linked', False) or code_data.get('used', False)
             
             return {
@@ -422,13 +850,15 @@ class TelegramManager:
     def get_admin_data(self):
         """الحصول على بيانات إدارية"""
         return {
-            'telegram_codes_count': len(self.telegram_codes),
-            'users_data_count': len(self.users_data),
-            'telegram_codes': self.telegram_codes,
-            'users_data': self.users_data,
+            'telegram_codes_count': self.code_store.count_codes(),
+            'users_data_count': self.code_store.count_users(),
+            'telegram_codes': self.code_store.recent_codes(),
+            'users_data': self.code_store.recent_users(),
             'bot_username': self.bot_username,
             'bot_configured': bool(self.bot_token),
-            'webhook_url': self.webhook_url
+            'bot_info_fetched_at': self.bot_info_fetched_at,
+            'webhook_url': self.webhook_url,
+            'webhook_dedup': self.update_dedup.get_stats()
         }
 
 
@@ -448,5 +878,39 @@ def process_telegram_webhook(update_data):
 def send_telegram_message(chat_id, message):
     return telegram_manager.send_telegram_message(chat_id, message)
 
+def send_admin_notification(message):
+    return telegram_manager.send_admin_notification(message)
+
 def get_payment_display_text(payment_method, payment_details):
     return telegram_manager.get_payment_display_text(payment_method, payment_details)
+
+
+if __name__ == '__main__':
+    # 🛠️ أوامر تُنفذ مرة واحدة لكل نشر (وليس عند تشغيل كل worker)
+    #   python telegram_manager.py setup            -> تحديث معلومات البوت + تسجيل webhook
+    #   python telegram_manager.py set-webhook URL  -> تسجيل webhook بعنوان محدد
+    #   python telegram_manager.py requeue-failed [ID...] -> إعادة الرسائل الفاشلة للطابور
+    #   python telegram_manager.py purge-failed     -> حذف كل الرسائل الفاشلة الآن
+    import sys
+    
+    command = sys.argv[1] if len(sys.argv) > 1 else 'setup'
+    if command == 'setup':
+        if telegram_manager.refresh_bot_info():
+            print(f"✅ معلومات البوت محفوظة: @{telegram_manager.bot_username}")
+        result = telegram_manager.ensure_webhook()
+    elif command == 'set-webhook':
+        result = telegram_manager.set_webhook(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif command == 'requeue-failed':
+        message_ids = [int(value) for value in sys.argv[2:]] or None
+        requeued = telegram_manager.outbox.requeue_failed(message_ids)
+        print(f"🔁 أعيدت {requeued} رسالة للطابور")
+        result = {'success': True}
+    elif command == 'purge-failed':
+        removed = telegram_manager.outbox.purge_failed(older_than=0)
+        print(f"🧹 حُذفت {removed} رسالة فاشلة")
+        result = {'success': True}
+    else:
+        print(f"❌ أمر غير معروف: {command}")
+        sys.exit(2)
+    
+    sys.exit(0 if result.get('success') else 1)
@@ -0,0 +1,436 @@
+# telegram_outbox.py - صندوق الرسائل الصادرة للتليجرام
+"""
+📮 صندوق الصادر - FC 26 Profile System
+======================================
+طابور دائم (SQLite) لرسائل التليجرام مع workers في الخلفية
+- الـ webhook وطلبات البيع تضيف الرسالة للطابور وترد فوراً
+- الإرسال الفعلي في خيوط خلفية مع إعادة المحاولة و backoff
+- الطابور مشترك بين جميع gunicorn workers (حجز الرسالة ذري)
+- إحصائيات عمق الطابور وزمن التوصيل
+- scheduler اختياري لحدود المعدل ودمج الإشعارات في رسالة واحدة
+  (حالة حدود المعدل في نفس الملف وتُحجز مع الرسالة في معاملة واحدة)
+- الرسائل الفاشلة نهائياً تُحذف بعد مدة احتفاظ، ويمكن إعادتها للطابور يدوياً
+"""
+
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from system_metrics import timed_write
+
+
+class RetryAfter(Exception):
+    """رفض مؤقت من التليجرام (429) - يجب الانتظار retry_after ثانية"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class TelegramOutbox:
+    """طابور رسائل دائم مع مجمع workers للتوصيل في الخلفية"""
+
+    # مدة حجز الرسالة أثناء الإرسال - بعدها تعود للطابور إذا توقف الـ worker
+    LEASE_SECONDS = 60
+
+    # عدد الصفوف المحذوفة في كل دفعة تنظيف (لتجنب أقفال كتابة طويلة)
+    PURGE_BATCH = 500
+
+    # أقصى عدد محادثات محجوبة بحد المعدل تُتخطى في حجز واحد
+    CLAIM_SCAN = 20
+
+    def __init__(self, send_func, db_path=None, workers=None, max_attempts=None,
+                 base_delay=None, poll_interval=1.0, scheduler=None):
+        self.send_func = send_func
+        # scheduler يحدد متى يُسمح بالإرسال لكل محادثة (reserve / build_digest)
+        self.scheduler = scheduler
+        self.db_path = db_path or os.environ.get('TELEGRAM_OUTBOX_PATH', 'fc26_telegram_outbox.db')
+        if scheduler is not None:
+            # دلاء حدود المعدل في ملف الطابور نفسه (مشتركة بين كل العمليات)
+            scheduler.db_path = self.db_path
+        self.workers_count = int(workers or os.environ.get('TELEGRAM_OUTBOX_WORKERS', '2'))
+        self.max_attempts = int(max_attempts or os.environ.get('TELEGRAM_OUTBOX_MAX_ATTEMPTS', '5'))
+        self.base_delay = float(base_delay or os.environ.get('TELEGRAM_OUTBOX_BASE_DELAY', '2'))
+        self.poll_interval = poll_interval
+        # ⏱️ مدة الاحتفاظ بالرسائل الفاشلة نهائياً (للفحص أو إعادة الإرسال) قبل حذفها
+        self.failed_retention = float(os.environ.get('TELEGRAM_OUTBOX_FAILED_RETENTION', 7 * 24 * 60 * 60))
+        self.purge_interval = float(os.environ.get('TELEGRAM_OUTBOX_PURGE_INTERVAL', 10 * 60))
+        self.last_purge_at = 0.0
+
+        self.local = threading.local()
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.start_lock = threading.Lock()
+        self.threads = []
+        self.started_pid = None
+
+        # 📊 إحصائيات التوصيل (لكل عملية)
+        self.stats_lock = threading.Lock()
+        self.delivered = 0
+        self.failed = 0
+        self.retries = 0
+        self.deferred = 0
+        self.coalesced = 0
+        self.purged = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    # ------------------------------------------------------------------
+    # قاعدة البيانات
+    # ------------------------------------------------------------------
+
+    def _connect(self):
+        """اتصال SQLite خاص بكل خيط"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self._ensure_schema(conn)
+        return conn
+
+    def _ensure_schema(self, conn):
+        with self.schema_lock:
+            if self.schema_ready:
+                return
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS telegram_outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    kind TEXT NOT NULL DEFAULT 'message',
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    locked_until REAL,
+                    created_at REAL NOT NULL,
+                    last_error TEXT
+                )
+            ''')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_telegram_outbox_status_next '
+                'ON telegram_outbox (status, next_attempt_at)'
+            )
+            if self.scheduler is not None:
+                self.scheduler.ensure_schema(conn)
+            self.schema_ready = True
+
+    # ------------------------------------------------------------------
+    # الطابور
+    # ------------------------------------------------------------------
+
+    def enqueue(self, chat_id, text, kind='message'):
+        """إضافة رسالة للطابور - يرجع معرف الرسالة فوراً"""
+        now = time.time()
+        with timed_write(self.db_path):
+            cursor = self._connect().execute(
+                'INSERT INTO telegram_outbox (chat_id, text, kind, next_attempt_at, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (str(chat_id), text, kind, now, now)
+            )
+        self.start()
+        self.wakeup.set()
+        return cursor.lastrowid
+
+    def claim_next(self):
+        """حجز رسالة مستحقة بشكل ذري (آمن بين العمليات)
+
+        مع scheduler: رمز حد المعدل يُحجز في نفس المعاملة، والرسالة التي لم يحن دورها
+        تؤجل وتُجرب رسالة محادثة أخرى
+        """
+        conn = self._connect()
+        now = time.time()
+        blocked_chats = []
+        deferred = 0
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            while True:
+                row = conn.execute(
+                    f'''SELECT * FROM telegram_outbox
+                       WHERE ((status = 'pending' AND next_attempt_at <= ?)
+                          OR (status = 'sending' AND locked_until < ?))
+                         AND chat_id NOT IN ({', '.join('?' * len(blocked_chats))})
+                       ORDER BY next_attempt_at
+                       LIMIT 1''',
+                    (now, now, *blocked_chats)
+                ).fetchone()
+                if row is None:
+                    break
+
+                wait = self.scheduler.reserve(row['chat_id'], conn) if self.scheduler is not None else 0
+                if wait <= 0:
+                    conn.execute(
+                        "UPDATE telegram_outbox SET status = 'sending', locked_until = ? WHERE id = ?",
+                        (now + self.LEASE_SECONDS, row['id'])
+                    )
+                    break
+
+                # تأجيل بدون احتساب محاولة - رسائل نفس المحادثة بعدها تنتظر أيضاً
+                conn.execute(
+                    "UPDATE telegram_outbox SET status = 'pending', next_attempt_at = ?, "
+                    "locked_until = NULL WHERE id = ?",
+                    (now + wait, row['id'])
+                )
+                deferred += 1
+                blocked_chats.append(row['chat_id'])
+                row = None
+                if len(blocked_chats) >= self.CLAIM_SCAN:
+                    break
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        if deferred:
+            with self.stats_lock:
+                self.deferred += deferred
+        return row
+
+    def claim_companions(self, row, limit=50):
+        """حجز باقي الرسائل المعلقة من نفس النوع لنفس المحادثة (للدمج)"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                '''SELECT * FROM telegram_outbox
+                   WHERE status = 'pending' AND chat_id = ? AND kind = ? AND id != ?
+                   ORDER BY created_at
+                   LIMIT ?''',
+                (row['chat_id'], row['kind'], row['id'], limit)
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE telegram_outbox SET status = 'sending', locked_until = ? WHERE id = ?",
+                    [(now + self.LEASE_SECONDS, r['id']) for r in rows]
+                )
+            conn.execute('COMMIT')
+            return rows
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def defer(self, row, delay):
+        """إرجاع الرسالة للطابور بعد مهلة بدون احتسابها كمحاولة فاشلة"""
+        self._connect().execute(
+            "UPDATE telegram_outbox SET status = 'pending', next_attempt_at = ?, "
+            "locked_until = NULL WHERE id = ?",
+            (time.time() + delay, row['id'])
+        )
+        with self.stats_lock:
+            self.deferred += 1
+
+    def mark_sent(self, row):
+        self._connect().execute('DELETE FROM telegram_outbox WHERE id = ?', (row['id'],))
+
+        latency = time.time() - row['created_at']
+        with self.stats_lock:
+            self.delivered += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def mark_failed(self, row, error):
+        """إعادة جدولة الرسالة مع backoff أسي أو تعليمها كفاشلة نهائياً"""
+        attempts = row['attempts'] + 1
+        conn = self._connect()
+
+        if attempts >= self.max_attempts:
+            # next_attempt_at للرسالة الفاشلة = وقت الفشل (تُحسب منه مدة الاحتفاظ)
+            conn.execute(
+                "UPDATE telegram_outbox SET status = 'failed', attempts = ?, last_error = ?, "
+                "next_attempt_at = ?, locked_until = NULL WHERE id = ?",
+                (attempts, str(error)[:500], time.time(), row['id'])
+            )
+            with self.stats_lock:
+                self.failed += 1
+            print(f"❌ فشل نهائي في إرسال رسالة تليجرام #{row['id']} بعد {attempts} محاولات")
+            return
+
+        delay = self.base_delay * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+        conn.execute(
+            "UPDATE telegram_outbox SET status = 'pending', attempts = ?, last_error = ?, "
+            "next_attempt_at = ?, locked_until = NULL WHERE id = ?",
+            (attempts, str(error)[:500], time.time() + delay, row['id'])
+        )
+        with self.stats_lock:
+            self.retries += 1
+
+    def deliver(self, row):
+        """محاولة توصيل رسالة (أو ملخص رسائل مدموجة) مع احترام حدود المعدل"""
+        rows = [row]
+        text = row['text']
+
+        # رمز حد المعدل حُجز مع الرسالة في claim_next
+        if self.scheduler is not None:
+            if row['kind'] in self.scheduler.coalesce_kinds:
+                companions = self.claim_companions(row)
+                if companions:
+                    rows = [row] + companions
+                    text, used = self.scheduler.build_digest([r['text'] for r in rows])
+                    # ما لا يتسع في رسالة واحدة يعود للطابور فوراً
+                    for extra in rows[used:]:
+                        self.defer(extra, 0)
+                    rows = rows[:used]
+
+        try:
+            sent = self.send_func(row['chat_id'], text)
+        except RetryAfter as e:
+            for r in rows:
+                self.defer(r, e.retry_after)
+            return
+        except Exception as e:
+            for r in rows:
+                self.mark_failed(r, e)
+            return
+
+        for r in rows:
+            if sent:
+                self.mark_sent(r)
+            else:
+                self.mark_failed(r, 'send returned False')
+
+        if sent and len(rows) > 1:
+            with self.stats_lock:
+                self.coalesced += len(rows)
+
+    # ------------------------------------------------------------------
+    # الرسائل الفاشلة
+    # ------------------------------------------------------------------
+
+    def purge_failed(self, older_than=None):
+        """حذف الرسائل الفاشلة الأقدم من مدة الاحتفاظ على دفعات - يرجع عدد المحذوف"""
+        retention = self.failed_retention if older_than is None else older_than
+        cutoff = time.time() - retention
+        conn = self._connect()
+        removed = 0
+        while True:
+            deleted = conn.execute(
+                'DELETE FROM telegram_outbox WHERE id IN ('
+                "SELECT id FROM telegram_outbox WHERE status = 'failed' AND next_attempt_at < ? LIMIT ?)",
+                (cutoff, self.PURGE_BATCH)
+            ).rowcount
+            removed += deleted
+            if deleted < self.PURGE_BATCH:
+                break
+
+        self.last_purge_at = time.time()
+        with self.stats_lock:
+            self.purged += removed
+        return removed
+
+    def requeue_failed(self, message_ids=None):
+        """إعادة الرسائل الفاشلة للطابور بعداد محاولات جديد (كلها أو معرفات محددة)"""
+        query = ("UPDATE telegram_outbox SET status = 'pending', attempts = 0, "
+                 "next_attempt_at = ?, locked_until = NULL WHERE status = 'failed'")
+        params = [time.time()]
+        if message_ids is not None:
+            message_ids = list(message_ids)
+            if not message_ids:
+                return 0
+            query += f" AND id IN ({', '.join('?' * len(message_ids))})"
+            params.extend(message_ids)
+
+        requeued = self._connect().execute(query, params).rowcount
+        # الـ workers العاملة تلتقطها في الاستطلاع التالي (حتى لو نُفذ الأمر من عملية أخرى)
+        self.wakeup.set()
+        return requeued
+
+    def _maybe_purge(self):
+        """تنظيف دوري للرسائل الفاشلة من الـ worker الخامل"""
+        if time.time() - self.last_purge_at < self.purge_interval:
+            return
+        try:
+            removed = self.purge_failed()
+            if removed:
+                print(f"🧹 تم حذف {removed} رسالة تليجرام فاشلة أقدم من مدة الاحتفاظ")
+            if self.scheduler is not None:
+                self.scheduler.prune(self._connect())
+        except Exception as e:
+            self.last_purge_at = time.time()
+            print(f"خطأ في تنظيف الرسائل الفاشلة: {str(e)}")
+
+    # ------------------------------------------------------------------
+    # الـ workers
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """تشغيل الـ workers (مرة واحدة لكل عملية - آمن بعد fork)"""
+        if self.started_pid == os.getpid():
+            return
+
+        with self.start_lock:
+            if self.started_pid == os.getpid():
+                return
+
+            self.stop_event.clear()
+            self.threads = []
+            for index in range(self.workers_count):
+                thread = threading.Thread(
+                    target=self._worker_loop,
+                    name=f"telegram-outbox-{index}",
+                    daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+            self.started_pid = os.getpid()
+
+    def stop(self, timeout=5):
+        self.stop_event.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.started_pid = None
+
+    def _worker_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                row = self.claim_next()
+            except Exception as e:
+                print(f"خطأ في قراءة طابور التليجرام: {str(e)}")
+                row = None
+
+            if row is None:
+                # لا توجد رسائل مستحقة - انتظار رسالة جديدة أو مهلة الاستطلاع
+                self._maybe_purge()
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+
+            self.deliver(row)
+
+    # ------------------------------------------------------------------
+    # الإحصائيات
+    # ------------------------------------------------------------------
+
+    def get_stats(self):
+        """عمق الطابور وإحصائيات زمن التوصيل"""
+        depth = {'pending': 0, 'sending': 0, 'failed': 0}
+        for row in self._connect().execute(
+            'SELECT status, COUNT(*) AS count FROM telegram_outbox GROUP BY status'
+        ):
+            depth[row['status']] = row['count']
+
+        with self.stats_lock:
+            return {
+                'queue_depth': depth['pending'] + depth['sending'],
+                'status_counts': depth,
+                'delivered': self.delivered,
+                'failed': self.failed,
+                'retries': self.retries,
+                'deferred': self.deferred,
+                'coalesced': self.coalesced,
+                'purged_failed': self.purged,
+                'failed_retention_seconds': self.failed_retention,
+                'avg_delivery_latency_ms': round(self.total_latency / self.delivered * 1000, 2) if self.delivered else 0,
+                'max_delivery_latency_ms': round(self.max_latency * 1000, 2),
+                'workers': self.workers_count,
+                'workers_running': self.started_pid == os.getpid()
+            }
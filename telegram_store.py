@@ -0,0 +1,407 @@
+# telegram_store.py - مخزن أكواد التليجرام الدائم
+"""
+🗄️ مخزن أكواد التليجرام - FC 26 Profile System
+==============================================
+تخزين أكواد الربط وبيانات المستخدمين المربوطين في SQLite (WAL)
+- مشترك بين جميع gunicorn workers (نفس الكود يظهر في أي worker)
+- البحث بالكود عبر المفتاح الأساسي
+- صلاحية محددة للأكواد مع تنظيف دوري في الخلفية
+- ذاكرة العملية محدودة: لا شيء يتراكم في قواميس العملية
+- telegram_users لا يُنظف عمداً: صف واحد لكل مستخدم مربوط (يُستبدل عند إعادة الربط)
+  وهو السجل الدائم للربط الذي تعتمد عليه تحليلات نسبة الربط - ينمو بعدد المستخدمين لا بالطلبات
+- انتظار ربط الكود (long-poll / SSE) بدون استطلاع HTTP من المتصفح
+- سجل update_id لتجاهل إعادة إرسال التليجرام لنفس التحديث في أي worker
+- عداد نسخة يزيد مع كل تغيير في الأكواد أو المستخدمين المربوطين
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from system_metrics import timed_write
+
+
+class TelegramCodeStore:
+    """مخزن SQLite لأكواد التليجرام مع صلاحية وتنظيف تلقائي"""
+
+    # عدد الصفوف المحذوفة في كل دفعة تنظيف (لتجنب أقفال كتابة طويلة)
+    SWEEP_BATCH = 500
+
+    # مدة حجز update_id أثناء المعالجة - بعدها تُقبل إعادة الإرسال (الـ worker توقف)
+    UPDATE_PROCESSING_LEASE = 60
+
+    def __init__(self, db_path=None, code_ttl=None, sweep_interval=None, update_window=None):
+        self.db_path = db_path or os.environ.get('TELEGRAM_STORE_PATH', 'fc26_telegram.db')
+        # ⏱️ صلاحية الكود بالثواني
+        self.code_ttl = int(code_ttl or os.environ.get('TELEGRAM_CODE_TTL', 24 * 60 * 60))
+        self.sweep_interval = int(sweep_interval or os.environ.get('TELEGRAM_CODE_SWEEP_INTERVAL', 5 * 60))
+        # ⏱️ مدة تذكر update_id (التليجرام يعيد الإرسال خلال دقائق)
+        self.update_window = int(update_window or os.environ.get('TELEGRAM_UPDATE_DEDUP_WINDOW', 60 * 60))
+
+        self.local = threading.local()
+        self.schema_lock = threading.Lock()
+        self.schema_ready = False
+
+        self.sweeper_lock = threading.Lock()
+        self.sweeper_pid = None
+        self.swept_total = 0
+
+        # 🔔 المتصفحات المنتظرة لربط الكود: code -> [Event, عدد المنتظرين]
+        self.waiters = {}
+        self.waiters_lock = threading.Lock()
+        self.watcher_pid = None
+        self.watch_interval = float(os.environ.get('TELEGRAM_LINK_WATCH_INTERVAL', '0.5'))
+
+    # ------------------------------------------------------------------
+    # قاعدة البيانات
+    # ------------------------------------------------------------------
+
+    def _connect(self):
+        """اتصال SQLite خاص بكل خيط"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self._ensure_schema(conn)
+            self._ensure_sweeper()
+        return conn
+
+    def _ensure_schema(self, conn):
+        with self.schema_lock:
+            if self.schema_ready:
+                return
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS telegram_codes (
+                    code TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    used INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_telegram_codes_created_at '
+                'ON telegram_codes (created_at)'
+            )
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS telegram_users (
+                    user_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_telegram_users_created_at '
+                'ON telegram_users (created_at)'
+            )
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS telegram_updates (
+                    update_id INTEGER PRIMARY KEY,
+                    received_at REAL NOT NULL,
+                    done INTEGER NOT NULL DEFAULT 1
+                )
+            ''')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(telegram_updates)')}
+            if 'done' not in columns:
+                # ملف من نسخة سابقة: التحديثات المسجلة فيه تُعتبر مكتملة
+                conn.execute('ALTER TABLE telegram_updates ADD COLUMN done INTEGER NOT NULL DEFAULT 1')
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_telegram_updates_received_at '
+                'ON telegram_updates (received_at)'
+            )
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS store_versions (
+                    name TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute("INSERT OR IGNORE INTO store_versions (name, version) VALUES ('telegram', 0)")
+            self.schema_ready = True
+
+    def _bump_version(self, conn):
+        conn.execute("UPDATE store_versions SET version = version + 1 WHERE name = 'telegram'")
+
+    def get_version(self):
+        """عداد يزيد مع كل تغيير في الأكواد أو المستخدمين من أي worker"""
+        return self._connect().execute(
+            "SELECT version FROM store_versions WHERE name = 'telegram'"
+        ).fetchone()[0]
+
+    # ------------------------------------------------------------------
+    # الأكواد
+    # ------------------------------------------------------------------
+
+    def save_code(self, code, data):
+        """حفظ كود جديد"""
+        with timed_write(self.db_path):
+            now = time.time()
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO telegram_codes (code, data, used, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (code, json.dumps(data, ensure_ascii=False), int(bool(data.get('used'))), now, now)
+            )
+            self._bump_version(conn)
+
+    def get_code(self, code):
+        """جلب بيانات كود صالح (None إذا لم يوجد أو انتهت صلاحيته)"""
+        row = self._connect().execute(
+            'SELECT data FROM telegram_codes WHERE code = ? AND created_at >= ?',
+            (code, time.time() - self.code_ttl)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def claim_code(self, code, link_data):
+        """تعليم الكود كمستخدم بشكل ذري - يرجع البيانات المحدثة أو None إذا سبقنا أحد"""
+        with timed_write(self.db_path):
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT data FROM telegram_codes WHERE code = ? AND used = 0 AND created_at >= ?',
+                    (code, time.time() - self.code_ttl)
+                ).fetchone()
+                if row is None:
+                    conn.execute('ROLLBACK')
+                    return None
+
+                data = {**json.loads(row[0]), **link_data, 'used': True, 'linked': True}
+                conn.execute(
+                    'UPDATE telegram_codes SET data = ?, used = 1, updated_at = ? WHERE code = ?',
+                    (json.dumps(data, ensure_ascii=False), time.time(), code)
+                )
+                self._bump_version(conn)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+        self.notify_linked(code)
+        return data
+
+    # ------------------------------------------------------------------
+    # انتظار الربط
+    # ------------------------------------------------------------------
+
+    def wait_for_link(self, code, timeout):
+        """الانتظار حتى يُربط الكود أو تنتهي المهلة - يرجع بيانات الكود الحالية"""
+        data = self.get_code(code)
+        if data is None or data.get('used'):
+            return data
+
+        with self.waiters_lock:
+            entry = self.waiters.setdefault(code, [threading.Event(), 0])
+            entry[1] += 1
+        self._ensure_watcher()
+
+        try:
+            # فحص ثانٍ بعد التسجيل حتى لا يفوتنا ربط حدث بين الفحص الأول والتسجيل
+            data = self.get_code(code)
+            if data is not None and not data.get('used'):
+                entry[0].wait(timeout)
+        finally:
+            with self.waiters_lock:
+                entry[1] -= 1
+                if entry[1] <= 0 and self.waiters.get(code) is entry:
+                    del self.waiters[code]
+
+        return self.get_code(code)
+
+    def notify_linked(self, code):
+        """إيقاظ المنتظرين لهذا الكود في نفس العملية فوراً"""
+        with self.waiters_lock:
+            entry = self.waiters.get(code)
+        if entry is not None:
+            entry[0].set()
+
+    def _ensure_watcher(self):
+        """خيط واحد لكل عملية يراقب الربط الذي يتم في workers أخرى"""
+        if self.watcher_pid == os.getpid():
+            return
+        with self.waiters_lock:
+            if self.watcher_pid == os.getpid():
+                return
+            self.watcher_pid = os.getpid()
+            threading.Thread(target=self._watcher_loop, name='telegram-link-watcher', daemon=True).start()
+
+    def _watcher_loop(self):
+        """فحص واحد رخيص لكل التغييرات بدلاً من استعلام لكل متصفح منتظر"""
+        conn = self._connect()
+        last_version = None
+        while True:
+            time.sleep(self.watch_interval)
+            try:
+                with self.waiters_lock:
+                    codes = list(self.waiters.keys())
+                if not codes:
+                    continue
+
+                # data_version يتغير فقط عند كتابة اتصال آخر في قاعدة البيانات
+                version = conn.execute('PRAGMA data_version').fetchone()[0]
+                if version == last_version:
+                    continue
+                last_version = version
+
+                placeholders = ','.join('?' * len(codes))
+                for (code,) in conn.execute(
+                    f'SELECT code FROM telegram_codes WHERE used = 1 AND code IN ({placeholders})',
+                    codes
+                ).fetchall():
+                    self.notify_linked(code)
+            except Exception as e:
+                print(f"خطأ في مراقبة ربط أكواد التليجرام: {str(e)}")
+
+    def count_codes(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM telegram_codes WHERE created_at >= ?',
+            (time.time() - self.code_ttl,)
+        ).fetchone()[0]
+
+    def recent_codes(self, limit=100):
+        """أحدث الأكواد الصالحة (للوحة الإدارة)"""
+        rows = self._connect().execute(
+            'SELECT code, data FROM telegram_codes WHERE created_at >= ? '
+            'ORDER BY created_at DESC LIMIT ?',
+            (time.time() - self.code_ttl, limit)
+        ).fetchall()
+        return {code: json.loads(data) for code, data in rows}
+
+    # ------------------------------------------------------------------
+    # المستخدمون المربوطون
+    # ------------------------------------------------------------------
+
+    def save_user(self, user_id, data):
+        with timed_write(self.db_path):
+            conn = self._connect()
+            conn.execute(
+                'INSERT OR REPLACE INTO telegram_users (user_id, data, created_at) VALUES (?, ?, ?)',
+                (user_id, json.dumps(data, ensure_ascii=False), time.time())
+            )
+            self._bump_version(conn)
+
+    def get_user(self, user_id):
+        row = self._connect().execute(
+            'SELECT data FROM telegram_users WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count_users(self):
+        return self._connect().execute('SELECT COUNT(*) FROM telegram_users').fetchone()[0]
+
+    def recent_users(self, limit=100):
+        rows = self._connect().execute(
+            'SELECT user_id, data FROM telegram_users ORDER BY created_at DESC LIMIT ?',
+            (limit,)
+        ).fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def iter_link_times(self, page_size=5000):
+        """أوقات ربط المستخدمين (epoch) على صفحات - للتحليلات الزمنية"""
+        last_rowid = 0
+        while True:
+            rows = self._connect().execute(
+                'SELECT rowid, created_at FROM telegram_users WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (last_rowid, page_size)
+            ).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            yield [created_at for _, created_at in rows]
+
+    # ------------------------------------------------------------------
+    # تحديثات الـ webhook
+    # ------------------------------------------------------------------
+
+    def register_update(self, update_id):
+        """حجز update_id للمعالجة بشكل ذري - يرجع False إذا عالجه أو يعالجه الآن أي worker
+
+        الحجز غير المكتمل الأقدم من مدة الحجز يُعاد لمن يستلم إعادة الإرسال
+        """
+        now = time.time()
+        return self._connect().execute(
+            'INSERT INTO telegram_updates (update_id, received_at, done) VALUES (?, ?, 0) '
+            'ON CONFLICT (update_id) DO UPDATE SET received_at = excluded.received_at '
+            'WHERE done = 0 AND received_at < ?',
+            (update_id, now, now - self.UPDATE_PROCESSING_LEASE)
+        ).rowcount == 1
+
+    def complete_update(self, update_id):
+        self._connect().execute('UPDATE telegram_updates SET done = 1 WHERE update_id = ?', (update_id,))
+
+    def forget_update(self, update_id):
+        """إلغاء حجز تحديث فشلت معالجته"""
+        self._connect().execute(
+            'DELETE FROM telegram_updates WHERE update_id = ? AND done = 0', (update_id,)
+        )
+
+    def count_updates(self):
+        return self._connect().execute('SELECT COUNT(*) FROM telegram_updates').fetchone()[0]
+
+    # ------------------------------------------------------------------
+    # التنظيف الدوري
+    # ------------------------------------------------------------------
+
+    def sweep_expired(self):
+        """حذف الأكواد و update_id المنتهية على دفعات صغيرة (telegram_users دائم - انظر أعلى الملف)"""
+        conn = self._connect()
+        cutoff = time.time() - self.code_ttl
+        removed = 0
+        while True:
+            deleted = conn.execute(
+                'DELETE FROM telegram_codes WHERE rowid IN ('
+                'SELECT rowid FROM telegram_codes WHERE created_at < ? LIMIT ?)',
+                (cutoff, self.SWEEP_BATCH)
+            ).rowcount
+            removed += deleted
+            if deleted < self.SWEEP_BATCH:
+                break
+
+        update_cutoff = time.time() - self.update_window
+        while conn.execute(
+            'DELETE FROM telegram_updates WHERE rowid IN ('
+            'SELECT rowid FROM telegram_updates WHERE received_at < ? LIMIT ?)',
+            (update_cutoff, self.SWEEP_BATCH)
+        ).rowcount >= self.SWEEP_BATCH:
+            pass
+
+        if removed:
+            self._bump_version(conn)
+        self.swept_total += removed
+        return removed
+
+    def _ensure_sweeper(self):
+        """تشغيل خيط التنظيف مرة واحدة لكل عملية"""
+        if self.sweeper_pid == os.getpid():
+            return
+        with self.sweeper_lock:
+            if self.sweeper_pid == os.getpid():
+                return
+            self.sweeper_pid = os.getpid()
+            threading.Thread(target=self._sweeper_loop, name='telegram-code-sweeper', daemon=True).start()
+
+    def _sweeper_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                removed = self.sweep_expired()
+                if removed:
+                    print(f"🧹 تم حذف {removed} كود تليجرام منتهي الصلاحية")
+            except Exception as e:
+                print(f"خطأ في تنظيف أكواد التليجرام: {str(e)}")
+
+    def get_stats(self):
+        return {
+            'db_path': self.db_path,
+            'codes_count': self.count_codes(),
+            'users_count': self.count_users(),
+            'code_ttl': self.code_ttl,
+            'updates_tracked': self.count_updates(),
+            'update_window': self.update_window,
+            'swept_total': self.swept_total,
+            'link_waiters': sum(entry[1] for entry in list(self.waiters.values()))
+        }
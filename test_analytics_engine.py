@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار محرك التحليلات الزمنية
+================================
+العد بالـ buckets من أعمدة NumPy يطابق البيانات المحفوظة
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import analytics_engine as engine_module
+from analytics_engine import TimeSeriesAnalytics
+from profile_store import MemoryProfileStore
+from sell_store import MemorySellStore
+from telegram_store import TelegramCodeStore
+
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    monkeypatch.setattr(engine_module.profile_handler, 'store', MemoryProfileStore())
+    monkeypatch.setattr(engine_module.sell_handler, 'store', MemorySellStore())
+    monkeypatch.setattr(engine_module.telegram_manager, 'code_store',
+                        TelegramCodeStore(db_path=str(tmp_path / 'telegram.db')))
+    engine = TimeSeriesAnalytics()
+    engine.refresh_seconds = 0
+    return engine
+
+
+def save_profile(index, created_at, platform):
+    engine_module.profile_handler.store.save({
+        'user_id': f'u{index}',
+        'whatsapp_number': f'010{index:08d}',
+        'platform': platform,
+        'created_at': created_at.isoformat()
+    })
+
+
+def test_signups_per_hour_by_platform(engine):
+    """كل تسجيل في الـ bucket الصحيح لمنصته، وما خارج النافذة لا يُحسب"""
+    now = datetime.now()
+    save_profile(1, now, 'pc')
+    save_profile(2, now, 'pc')
+    save_profile(3, now - timedelta(hours=2), 'ps')
+    save_profile(4, now - timedelta(days=3), 'xbox')
+    engine_module.profile_handler.store.save({'user_id': 'u5', 'created_at': 'not a date'})
+
+    result = engine.get_time_series('signups', bucket='hour', days=1)
+    assert result['success'] is True
+    assert len(result['labels']) == 24
+    assert result['series']['pc'][-1] == 2
+    assert result['series']['ps'][-3] == 1
+    assert 'xbox' not in result['series']
+    assert result['total'] == 3
+    assert engine.get_stats()['skipped_rows']['profiles'] == 1
+
+    # نفس البيانات = نفس النسخة، وأي تسجيل جديد يغيرها
+    assert engine.get_time_series('signups', bucket='hour', days=1)['version'] == result['version']
+    save_profile(6, now, 'xbox')
+    updated = engine.get_time_series('signups', bucket='hour', days=1)
+    assert updated['version'] != result['version']
+    assert updated['series']['xbox'][-1] == 1
+
+
+def test_sell_volume_per_day_excludes_cancelled(engine):
+    """عدد الطلبات يشمل الملغاة، وحجم المبيعات بالجنيه لا يشملها"""
+    sell = engine_module.sell_handler
+    normal = sell.create_sell_request({'coins_amount': 100000, 'user_id': 'u1'})['request_id']
+    sell.create_sell_request({'coins_amount': 100000, 'user_id': 'u1', 'transfer_type': 'instant'})
+    cancelled = sell.create_sell_request({'coins_amount': 100000, 'user_id': 'u2'})['request_id']
+    sell.update_request_status(cancelled, 'cancelled')
+
+    result = engine.get_time_series('sell_volume', bucket='day', days=90)
+    assert len(result['labels']) == 90
+    assert result['series']['orders'] == {'normal': [0] * 89 + [2], 'instant': [0] * 89 + [1]}
+    normal_price = sell.get_sell_request(normal)['request']['pricing']['final_price']
+    assert result['series']['volume_egp']['normal'][-1] == normal_price
+    assert result['totals']['orders'] == 3
+
+
+def test_telegram_conversion_rate(engine):
+    """نسبة الربط = مستخدمو التليجرام المربوطون ÷ التسجيلات في نفس الـ bucket"""
+    now = datetime.now()
+    for index in range(4):
+        save_profile(index, now, 'pc')
+    engine_module.telegram_manager.code_store.save_user('tg1', {'linked_at': time.time()})
+
+    result = engine.get_time_series('telegram_conversion', bucket='day', days=7)
+    assert result['series']['signups'][-1] == 4
+    assert result['series']['telegram_links'][-1] == 1
+    assert result['series']['conversion_rate'][-1] == 0.25
+    assert result['totals']['conversion_rate'] == 0.25
+
+
+def test_invalid_metric_and_bucket(engine):
+    assert engine.get_time_series('revenue')['success'] is False
+    assert engine.get_time_series('signups', bucket='minute')['success'] is False
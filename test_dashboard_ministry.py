@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار وزارة لوحة التحكم
+===========================
+اللقطة تُخدم من الذاكرة ولا يُعاد بناؤها إلا عند تغير البيانات
+"""
+
+import json
+import os
+
+import pytest
+
+import dashboard_ministry as dashboard_module
+from dashboard_ministry import DashboardMinistry
+from identity_ministry import IdentityMinistry
+from profile_store import MemoryProfileStore
+from sell_store import MemorySellStore
+from telegram_store import TelegramCodeStore
+
+
+@pytest.fixture
+def ministry(monkeypatch, tmp_path):
+    monkeypatch.setattr(dashboard_module.profile_handler, 'store', MemoryProfileStore())
+    monkeypatch.setattr(dashboard_module.sell_handler, 'store', MemorySellStore())
+    monkeypatch.setattr(dashboard_module.telegram_manager, 'code_store',
+                        TelegramCodeStore(db_path=str(tmp_path / 'telegram.db')))
+    return DashboardMinistry()
+
+
+def test_snapshot_rebuilt_only_when_stores_change(ministry):
+    """الطلبات المتكررة بدون تغيير لا تعيد الحساب - أي كتابة في مخزن تعيده"""
+    profiles = dashboard_module.profile_handler
+    for _ in range(3):
+        assert ministry.get_complete_dashboard_data()['success'] is True
+    assert ministry.get_snapshot_stats()['rebuilds'] == 1
+    assert ministry.get_snapshot_stats()['hits'] == 2
+
+    profiles.store.save({'user_id': 'u1', 'whatsapp_number': '01012345678', 'platform': 'pc'})
+    data = ministry.get_complete_dashboard_data()['dashboard_data']
+    assert data['users_analytics']['analytics']['total_users'] == 1
+    assert ministry.get_snapshot_stats()['rebuilds'] == 2
+
+    dashboard_module.sell_handler.create_sell_request({'coins_amount': 1000, 'user_id': 'u1'})
+    data = ministry.get_complete_dashboard_data()['dashboard_data']
+    assert data['sell_analytics']['sell_analytics']['total_requests'] == 1
+
+    dashboard_module.telegram_manager.code_store.save_code('ABC123', {'used': False})
+    ministry.get_complete_dashboard_data()
+    assert ministry.get_snapshot_stats()['rebuilds'] == 4
+
+    ministry.snapshot_max_age = 0
+    ministry.get_complete_dashboard_data()
+    assert ministry.get_snapshot_stats()['rebuilds'] == 5
+
+
+def test_version_and_delta_since_previous_version(ministry):
+    """رقم النسخة ثابت بدون تغيير، والرد الجزئي يحتوي الأقسام المتغيرة فقط"""
+    first = ministry.get_complete_dashboard_data()
+    assert first['delta'] is False
+    assert ministry.get_dashboard_version() == first['version']
+
+    dashboard_module.sell_handler.create_sell_request({'coins_amount': 1000, 'user_id': 'u1'})
+    assert ministry.get_dashboard_version() != first['version']
+
+    delta = ministry.get_complete_dashboard_data(since=first['version'])
+    sections = set(delta['dashboard_data'])
+    assert delta['delta'] is True
+    assert 'sell_analytics' in sections
+    assert 'system_health' in sections
+    assert 'users_analytics' not in sections
+    assert 'telegram_analytics' not in sections
+    new_seqs = [entry['id'] for entry in delta['dashboard_data']['recent_activity']['activities']]
+    assert new_seqs and min(new_seqs) > int(first['version'].split('.')[-1])
+
+    unchanged = ministry.get_complete_dashboard_data(since=delta['version'])
+    assert set(unchanged['dashboard_data']) == {'ministry_info', 'recent_activity'}
+    assert unchanged['dashboard_data']['recent_activity']['activities'] == []
+
+    # إعادة البناء بانتهاء العمر تغير رقم البناء: الرد يحتوي كل الأقسام وليس ministry_info و recent_activity فقط
+    ministry.snapshot_max_age = 0
+    rebuilt = ministry.get_complete_dashboard_data(since=unchanged['version'])
+    assert rebuilt['version'].split('.')[1] != unchanged['version'].split('.')[1]
+    assert {'users_analytics', 'telegram_analytics', 'sell_analytics', 'system_health'} <= set(rebuilt['dashboard_data'])
+
+
+def test_version_from_another_worker_gets_full_payload(ministry):
+    """عدادات البناء والنشاط محلية لكل worker - نسخة من worker آخر لا تُقبل كأساس للفرق"""
+    first = ministry.get_complete_dashboard_data()
+
+    other_worker = DashboardMinistry()
+    other_worker.instance_pid, other_worker.instance_nonce = os.getpid(), 'otherworker'
+    other = other_worker.get_complete_dashboard_data(since=first['version'])
+
+    assert other['version'] != first['version']
+    assert other['delta'] is False
+    assert {'users_analytics', 'telegram_analytics', 'sell_analytics', 'system_health'} <= set(other['dashboard_data'])
+    assert ministry.get_complete_dashboard_data(since=first['version'])['delta'] is True
+
+
+def test_activity_ring_buffer_pages_and_shared_file(ministry, monkeypatch, tmp_path):
+    """الحلقة تحتفظ بآخر N نشاط بمعرفات متتالية، والملف المشترك يُقرأ على صفحات"""
+    log_path = str(tmp_path / 'activity.ndjson')
+    monkeypatch.setenv('DASHBOARD_ACTIVITY_CAPACITY', '10')
+    monkeypatch.setenv('DASHBOARD_ACTIVITY_LOG_PATH', log_path)
+    workers = [DashboardMinistry(), DashboardMinistry()]
+    for index in range(25):
+        workers[index % 2].log_activity('Test', f'نشاط {index}')
+
+    worker = workers[0]
+    first = worker.get_recent_activity(limit=4)
+    assert [a['id'] for a in first['activities']] == [14, 13, 12, 11]
+    assert first['total_count'] == 10
+    second = worker.get_recent_activity(limit=4, before_id=first['next_before'])
+    assert [a['id'] for a in second['activities']] == [10, 9, 8, 7]
+    assert worker.get_recent_activity(limit=4, since_seq=12)['activities'][-1]['id'] == 13
+
+    # قطع قراءة صغيرة لاختبار الأسطر المقسومة بين قطعتين
+    worker.ACTIVITY_READ_BLOCK = 50
+    texts = []
+    before = None
+    while True:
+        page = worker.get_shared_activity(limit=7, before_offset=before)
+        texts.extend(a['activity'] for a in page['activities'])
+        before = page['next_before']
+        if before is None:
+            break
+
+    # سطر تهيئة لكل worker + 25 نشاط، الأحدث أولاً
+    assert len(texts) == 27
+    assert texts[:25] == [f'نشاط {index}' for index in reversed(range(25))]
+
+
+def test_system_health_reports_live_metrics(ministry, monkeypatch, tmp_path):
+    """صحة النظام تقرأ قياسات حقيقية بدلاً من قيم ثابتة"""
+    store = dashboard_module.telegram_manager.code_store
+    store.save_code('LIVE01', {'used': False})
+
+    identity = IdentityMinistry(str(tmp_path / 'identities.db'))
+    assert identity.initialize()
+    monkeypatch.setattr(dashboard_module.identity_module, 'identity_ministry', identity)
+    identity.process_identity_request('device_live')
+
+    health = ministry.get_system_health()['health']
+    assert 'response_time' not in health['performance']
+    assert health['process']['threads'] >= 1
+    assert health['sqlite']['telegram.db']['writes'] >= 1
+    assert health['sqlite']['telegram.db']['exists'] is True
+    assert health['sqlite']['identities.db']['writes'] >= 1
+    assert health['memory_stores']['activity_log']['capacity'] == ministry.activity_capacity
+
+
+def test_stream_export_has_single_header(ministry):
+    """التصدير المتدفق يبدأ بسجل export_info واحد ثم الملخصات ثم المستخدمين"""
+    for index in range(3):
+        dashboard_module.profile_handler.store.save({'user_id': f'u{index}', 'whatsapp_number': f'0101234567{index}'})
+
+    records = [json.loads(line) for line in ''.join(ministry.stream_export()).splitlines()]
+    types = [record['type'] for record in records]
+    assert types.count('export_info') == 1
+    assert records[0]['type'] == 'export_info'
+    assert records[0]['users_count'] == 3
+    assert types.count('user') == 3
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار عميل HTTP المشترك
+===========================
+التأكد من إعادة استخدام الاتصالات عبر keep-alive
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from http_client import OutboundHTTPClient
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """خادم محلي يدعم HTTP/1.1 keep-alive"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_connections_are_reused_per_host():
+    """عدة طلبات متتالية لنفس الـ host تستخدم اتصالاً واحداً"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = OutboundHTTPClient(pool_maxsize=2)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/getMe"
+        for _ in range(5):
+            assert client.get(url, timeout=2).json() == {'ok': True}
+
+        stats = client.get_stats()
+        assert stats['requests_sent'] == 5
+        assert stats['connections_opened'] == 1
+        assert stats['connections_reused'] == 4
+        host_stats = stats['hosts'][f"127.0.0.1:{server.server_address[1]}"]
+        assert host_stats['requests'] == 5
+        assert host_stats['errors'] == 0
+    finally:
+        client.close()
+        server.shutdown()
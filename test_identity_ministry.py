@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار وزارة الهوية
+======================
+مجمع الاتصالات وقاعدة البيانات
+"""
+
+import gzip
+import json
+import sqlite3
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from identity_ministry import MINISTRY_CONFIG, SCHEMA_MIGRATIONS, IdentityMinistry
+
+app = Flask(__name__)
+
+
+def test_concurrent_requests_share_pooled_wal_connections(tmp_path):
+    """الطلبات المتزامنة تعيد استخدام اتصالات المجمع بدلاً من فتح اتصال لكل استعلام"""
+    ministry = IdentityMinistry(str(tmp_path / 'identities.db'))
+    ministry.db_manager.pool_size = 3
+    assert ministry.initialize()
+
+    results = []
+
+    def worker(index):
+        for n in range(20):
+            results.append(ministry.process_identity_request(f"device_{index}_{n}")['success'])
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    db = ministry.db_manager
+    assert results == [True] * 160
+    assert db.execute_query('SELECT COUNT(*) FROM silent_identities', fetch_one=True)[0] == 160
+    assert db.execute_query('PRAGMA journal_mode', fetch_one=True)[0] == 'wal'
+    assert db.get_pool_stats()['connections_created'] <= 3
+    assert db.get_pool_stats()['checkouts'] > 160
+
+
+def test_events_are_written_in_batches_with_counters(tmp_path):
+    """الأحداث تُكتب على دفعات وتُحدث عدادات الجلسة والهوية"""
+    ministry = IdentityMinistry(str(tmp_path / 'identities.db'))
+    assert ministry.initialize()
+    ministry.event_buffer.batch_size = 200
+    ministry.event_buffer.flush_interval = 60
+
+    identity_id = ministry.process_identity_request('device_events')['identity']['id']
+    with app.test_request_context():
+        session_id = ministry.create_session_for_identity(identity_id)['session']['id']
+
+    for n in range(450):
+        assert ministry.track_user_event(session_id, 'click', {'n': n}) == {'success': True, 'queued': True}
+    ministry.event_buffer.flush()
+
+    db = ministry.db_manager
+    assert db.execute_query('SELECT COUNT(*) FROM session_events', fetch_one=True)[0] == 450
+    assert db.execute_query('SELECT events_count FROM identity_sessions WHERE id = ?',
+                            (session_id,), fetch_one=True)[0] == 450
+    assert db.execute_query('SELECT total_events FROM silent_identities WHERE id = ?',
+                            (identity_id,), fetch_one=True)[0] == 450
+    stats = ministry.event_buffer.get_stats()
+    assert stats['flushed'] == 450
+    assert stats['batches'] < 50
+
+
+def test_full_event_buffer_applies_backpressure(tmp_path, monkeypatch):
+    """عند امتلاء الذاكرة المؤقتة يُرفض الحدث بدلاً من نمو الذاكرة"""
+    monkeypatch.setitem(MINISTRY_CONFIG, 'EVENT_BACKPRESSURE_WAIT', 0.05)
+    ministry = IdentityMinistry(str(tmp_path / 'identities.db'))
+    assert ministry.initialize()
+    ministry.event_buffer.max_buffered = 5
+    identity_id = ministry.process_identity_request('device_backpressure')['identity']['id']
+    with app.test_request_context():
+        session_id = ministry.create_session_for_identity(identity_id)['session']['id']
+
+    # منع التفريغ مؤقتاً لمحاكاة قاعدة بيانات بطيئة
+    with ministry.event_buffer.flush_lock:
+        for n in range(5):
+            assert ministry.track_user_event(session_id, 'click')['success'] is True
+        result = ministry.track_user_event(session_id, 'click')
+
+    assert result['success'] is False
+    assert result['retry_after'] == 1
+    assert ministry.event_buffer.get_stats()['rejected'] == 1
+
+
+def test_poison_event_is_dead_lettered_after_retries(tmp_path, monkeypatch):
+    """الدفعة الفاشلة تُعاد بعدد محدود ثم يُعزل الحدث السيئ وحده وتستمر بقية الأحداث"""
+    monkeypatch.setitem(MINISTRY_CONFIG, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    monkeypatch.setitem(MINISTRY_CONFIG, 'EVENT_BATCH_MAX_RETRIES', 3)
+    ministry = IdentityMinistry(str(tmp_path / 'identities.db'))
+    assert ministry.initialize()
+    buffer = ministry.event_buffer
+    buffer.flush_interval = 60
+
+    identity_id = ministry.process_identity_request('device_poison')['identity']['id']
+    with app.test_request_context():
+        session_id = ministry.create_session_for_identity(identity_id)['session']['id']
+
+    write_batch = buffer._write_batch
+
+    def failing_write(batch):
+        if any(event_type == 'poison' for _, event_type, _, _ in batch):
+            raise ValueError('bad event')
+        write_batch(batch)
+
+    monkeypatch.setattr(buffer, '_write_batch', failing_write)
+    for event_type in ('click', 'poison', 'click'):
+        ministry.track_user_event(session_id, event_type, {})
+
+    assert buffer.flush() == 0
+    assert buffer.flush() == 0
+    assert buffer.get_stats()['buffered'] == 3
+    ministry.track_user_event(session_id, 'click', {})
+    assert buffer.flush() == 3
+
+    stats = buffer.get_stats()
+    assert stats['buffered'] == 0
+    assert stats['dead_lettered'] == 1
+    rows = ministry.db_manager.execute_query(f"SELECT event_type FROM {MINISTRY_CONFIG['TABLE_EVENTS']}", fetch_all=True)
+    assert [row[0] for row in rows] == ['click'] * 3
+    with open(buffer.dead_letter_path, encoding='utf-8') as dead_letter:
+        assert json.loads(dead_letter.read())['event_type'] == 'poison'
+
+
+def test_hot_queries_use_indexes_on_large_tables(tmp_path):
+    """الاستعلامات المتكررة تستخدم الفهارس على جداول بملايين الصفوف"""
+    db = IdentityMinistry(str(tmp_path / 'identities.db')).db_manager
+    assert db.init_database()
+    assert db.execute_query('PRAGMA user_version', fetch_one=True)[0] == SCHEMA_MIGRATIONS[-1][0]
+
+    with db.connection() as conn:
+        conn.execute('PRAGMA synchronous=OFF')
+        with conn:
+            conn.execute('''
+                WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 500000)
+                INSERT INTO silent_identities (id, device_fingerprint, created_at, last_active)
+                SELECT 'id' || i, 'fp' || i, i, i FROM n
+            ''')
+            conn.execute('''
+                WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 2000000)
+                INSERT INTO identity_sessions (id, identity_id, start_time, last_activity)
+                SELECT 's' || i, 'id' || (i % 500000), i, i FROM n
+            ''')
+            conn.execute('''
+                WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 200000)
+                INSERT INTO session_events (session_id, event_type, created_at)
+                SELECT 's' || (i % 2000000), 'click', i FROM n
+            ''')
+        conn.execute('ANALYZE')
+
+    hot_queries = {
+        'idx_sessions_identity_activity': (
+            'SELECT * FROM identity_sessions WHERE identity_id = ? ORDER BY last_activity DESC LIMIT 10', ('id42',)),
+        'idx_sessions_last_activity': (
+            'SELECT id FROM identity_sessions WHERE last_activity < ? LIMIT 500', (1000,)),
+        'idx_identities_last_active': (
+            'SELECT id FROM silent_identities WHERE last_active < ? LIMIT 500', (1000,)),
+        'idx_events_session_created': (
+            'SELECT * FROM session_events WHERE session_id = ? ORDER BY created_at', ('s42',)),
+        'idx_events_created_at': (
+            'SELECT id FROM session_events WHERE created_at < ? LIMIT 500', (1000,)),
+    }
+    for index_name, (query, params) in hot_queries.items():
+        plan = ' | '.join(db.explain_query_plan(query, params))
+        assert f'USING INDEX {index_name}' in plan or f'USING COVERING INDEX {index_name}' in plan, plan
+        assert 'TEMP B-TREE' not in plan, plan
+
+
+def test_returning_device_reuses_identity_without_writes(tmp_path):
+    """نفس البصمة ترجع نفس الهوية - من الذاكرة بدون كتابة ومن قاعدة البيانات بعد إعادة التشغيل"""
+    db_path = str(tmp_path / 'identities.db')
+    ministry = IdentityMinistry(db_path)
+    assert ministry.initialize()
+
+    first = ministry.process_identity_request('device_a', {'screen': '1080p'})
+    checkouts = ministry.db_manager.checkouts
+    second = ministry.process_identity_request('device_a')
+
+    assert first['action'] == 'created'
+    assert second['action'] == 'restored'
+    assert second['identity']['id'] == first['identity']['id']
+    assert ministry.db_manager.checkouts == checkouts
+    assert ministry.get_identity_cache_stats()['hits'] == 1
+
+    # worker آخر بذاكرة فارغة: upsert بدلاً من صف جديد
+    other_worker = IdentityMinistry(db_path)
+    assert other_worker.initialize()
+    third = other_worker.process_identity_request('device_a')
+    assert third['action'] == 'restored'
+    assert third['identity']['id'] == first['identity']['id']
+    assert other_worker.db_manager.execute_query(
+        'SELECT COUNT(*) FROM silent_identities', fetch_one=True)[0] == 1
+
+    assert ministry.process_identity_request('')['success'] is False
+
+
+def test_locked_database_is_retried_with_backoff_not_dead_lettered(tmp_path, monkeypatch):
+    """"database is locked" لا يُحسب من المحاولات - الدفعة تنتظر وتُكتب كاملة بعد زوال القفل"""
+    monkeypatch.setitem(MINISTRY_CONFIG, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    monkeypatch.setitem(MINISTRY_CONFIG, 'EVENT_BATCH_MAX_RETRIES', 2)
+    monkeypatch.setitem(MINISTRY_CONFIG, 'EVENT_LOCK_BACKOFF', 0.01)
+    ministry = IdentityMinistry(str(tmp_path / 'identities.db'))
+    assert ministry.initialize()
+    buffer = ministry.event_buffer
+    buffer.flush_interval = 60
+
+    identity_id = ministry.process_identity_request('device_locked')['identity']['id']
+    with app.test_request_context():
+        session_id = ministry.create_session_for_identity(identity_id)['session']['id']
+
+    write_batch = buffer._write_batch
+    locked = {'failures': 5}
+
+    def locked_write(batch):
+        if locked['failures']:
+            locked['failures'] -= 1
+            raise sqlite3.OperationalError('database is locked')
+        write_batch(batch)
+
+    monkeypatch.setattr(buffer, '_write_batch', locked_write)
+    for n in range(3):
+        ministry.track_user_event(session_id, 'click', {'n': n})
+
+    assert buffer.flush() == 0
+    assert buffer.retry_attempts == 0
+    while locked['failures']:
+        time.sleep(0.05)
+        buffer.flush()
+    time.sleep(0.5)
+    assert buffer.flush() == 3
+    stats = buffer.get_stats()
+    assert stats['lock_retries'] == 5
+    assert stats['dead_lettered'] == 0
+    assert stats['failed_batches'] == 0
+
+
+def test_events_for_unknown_sessions_are_rejected(tmp_path):
+    """الحدث لجلسة غير موجودة يُرفض قبل دخول الذاكرة المؤقتة"""
+    ministry = IdentityMinistry(str(tmp_path / 'identities.db'))
+    assert ministry.initialize()
+
+    result = ministry.track_user_event('no-such-session', 'click', {})
+    assert result['success'] is False
+    assert result['error_code'] == 'unknown_session'
+    assert ministry.event_buffer.get_stats()['accepted'] == 0
+
+    # جلسة موجودة في قاعدة البيانات (من worker آخر) تُقبل وتُحفظ في الذاكرة
+    identity_id = ministry.process_identity_request('device_known')['identity']['id']
+    with app.test_request_context():
+        session_id = IdentityMinistry(ministry.db_manager.db_path).create_session_for_identity(identity_id)['session']['id']
+    assert ministry.track_user_event(session_id, 'click', {})['success'] is True
+    assert session_id in ministry.known_sessions
+
+
+def test_cleanup_expires_caps_and_archives_sessions(tmp_path):
+    """التنظيف يحذف الجلسات المنتهية والزائدة على دفعات ويؤرشفها في ملف مضغوط"""
+    ministry = IdentityMinistry(str(tmp_path / 'identities.db'))
+    assert ministry.initialize()
+    scheduler = ministry.cleanup_scheduler
+    scheduler.archive_dir = str(tmp_path / 'archive')
+    scheduler.batch_size = 7
+
+    now = int(time.time())
+    timeout = MINISTRY_CONFIG['SESSION_TIMEOUT']
+    cap = MINISTRY_CONFIG['MAX_SESSIONS_PER_IDENTITY']
+    db = ministry.db_manager
+    with db.connection() as conn:
+        with conn:
+            conn.execute("INSERT INTO silent_identities (id, created_at, last_active) VALUES ('busy', 0, ?)", (now,))
+            conn.execute("INSERT INTO silent_identities (id, created_at, last_active) VALUES ('gone', 0, 0)")
+            conn.executemany(
+                'INSERT INTO identity_sessions (id, identity_id, start_time, last_activity) VALUES (?, ?, ?, ?)',
+                [(f'old{n}', 'busy', 0, now - timeout - 10) for n in range(20)] +
+                [(f'new{n}', 'busy', 0, now - n) for n in range(cap + 5)]
+            )
+            conn.execute("INSERT INTO session_events (session_id, event_type, created_at) VALUES ('old1', 'click', 0)")
+
+    assert scheduler.claim_run() is True
+    assert scheduler.claim_run() is False
+    result = scheduler.run_cleanup(now)
+
+    assert result['sessions_expired'] == 20
+    assert result['sessions_over_cap'] == 5
+    assert result['identities_removed'] == 1
+    assert result['events_removed'] == 1
+    assert result['rows_reclaimed'] == 27
+    remaining = [row[0] for row in db.execute_query(
+        'SELECT id FROM identity_sessions ORDER BY last_activity DESC', fetch_all=True)]
+    assert remaining == [f'new{n}' for n in range(cap)]
+
+    with gzip.open(result['archive_file'], 'rt', encoding='utf-8') as archive:
+        tables = [json.loads(line)['table'] for line in archive]
+    assert tables.count('identity_sessions') == 25
+    assert tables.count('session_events') == 1
+    assert tables.count('silent_identities') == 1
+
+
+def test_cleanup_archives_after_commit_and_skips_pending_events(tmp_path, monkeypatch):
+    """الأرشفة بعد نجاح الحذف فقط، والجلسة التي لها أحداث لم تُكتب لا تُحذف قبلها"""
+    ministry = IdentityMinistry(str(tmp_path / 'identities.db'))
+    assert ministry.initialize()
+    scheduler = ministry.cleanup_scheduler
+    scheduler.archive_dir = str(tmp_path / 'archive')
+    buffer = ministry.event_buffer
+    buffer.flush_interval = 60
+    buffer.batch_size = 1
+
+    now = int(time.time())
+    expired = now - MINISTRY_CONFIG['SESSION_TIMEOUT'] - 10
+    db = ministry.db_manager
+    with db.connection() as conn:
+        with conn:
+            conn.execute("INSERT INTO silent_identities (id, created_at, last_active) VALUES ('busy', 0, ?)", (now,))
+            conn.executemany(
+                'INSERT INTO identity_sessions (id, identity_id, start_time, last_activity) VALUES (?, ?, 0, ?)',
+                [('flushed', 'busy', expired), ('stuck', 'busy', expired)]
+            )
+            conn.execute("""CREATE TRIGGER block_delete BEFORE DELETE ON identity_sessions
+                            BEGIN SELECT RAISE(ABORT, 'locked'); END""")
+
+    # حذف فاشل = لا ملف أرشيف
+    with pytest.raises(Exception):
+        scheduler.run_cleanup(now)
+    assert list((tmp_path / 'archive').iterdir()) == []
+    db.execute_query('DROP TRIGGER block_delete')
+
+    # أحداث 'flushed' تُكتب قبل الحذف (وتُحذف معها)، و'stuck' تبقى حتى تُكتب أحداثها
+    write_batch = buffer._write_batch
+
+    def failing_write(batch):
+        if any(session_id == 'stuck' for session_id, _, _, _ in batch):
+            raise ValueError('busy')
+        write_batch(batch)
+
+    monkeypatch.setattr(buffer, '_write_batch', failing_write)
+    ministry.track_user_event('flushed', 'click', {})
+    ministry.track_user_event('stuck', 'click', {})
+    result = scheduler.run_cleanup(now + MINISTRY_CONFIG['SESSION_TIMEOUT'] + 60)
+
+    assert result['sessions_expired'] == 1
+    assert result['events_removed'] == 1
+    assert result['sessions_skipped_pending'] == 1
+    assert [row[0] for row in db.execute_query('SELECT id FROM identity_sessions', fetch_all=True)] == ['stuck']
+    with gzip.open(result['archive_file'], 'rt', encoding='utf-8') as archive:
+        rows = [json.loads(line) for line in archive]
+    assert [row['row']['id'] for row in rows if row['table'] == 'identity_sessions'] == ['flushed']
+
+
+def test_existing_database_is_converted_to_incremental_vacuum(tmp_path):
+    """ملف قديم بدون auto_vacuum يُحول مرة واحدة حتى تعيد الصيانة الصفحات للنظام"""
+    db_path = str(tmp_path / 'identities.db')
+    legacy = sqlite3.connect(db_path)
+    legacy.execute('CREATE TABLE legacy (id INTEGER PRIMARY KEY)')
+    legacy.close()
+
+    ministry = IdentityMinistry(db_path)
+    assert ministry.initialize()
+    db = ministry.db_manager
+    assert db.execute_query('PRAGMA auto_vacuum', fetch_one=True)[0] == 2
+
+    with db.connection() as conn:
+        assert db.enable_incremental_vacuum(conn) is False
+
+
+def test_identity_summary_reads_rollups(tmp_path):
+    """الملخص يأتي من جداول التجميع التي تُحدث مع الجلسات ودفعات الأحداث"""
+    ministry = IdentityMinistry(str(tmp_path / 'identities.db'))
+    assert ministry.initialize()
+
+    identity_id = ministry.process_identity_request('device_summary')['identity']['id']
+    with app.test_request_context():
+        sessions = [ministry.create_session_for_identity(identity_id)['session']['id'] for _ in range(2)]
+
+    for session_id in sessions:
+        ministry.track_user_event(session_id, 'page_view')
+        ministry.track_user_event(session_id, 'click')
+    ministry.track_user_event(sessions[0], 'click')
+    ministry.event_buffer.flush()
+
+    analytics = ministry.get_identity_summary(identity_id)['analytics']
+    assert analytics['sessions']['total'] == 2
+    assert analytics['page_views'] == 2
+    assert analytics['events'] == {'total': 5, 'by_type': {'click': 3, 'page_view': 2}}
+    assert analytics['first_seen'] <= analytics['last_seen']
+
+    assert ministry.get_identity_summary('missing')['not_found'] is True
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار مخزن الملفات الشخصية
+==============================
+نفس السلوك في مخزن الذاكرة و SQLite
+"""
+
+import pytest
+
+from profile_handler import ProfileHandler
+from profile_store import DuplicateWhatsAppError, MemoryProfileStore, SQLiteProfileStore
+
+FORM = {
+    'platform': 'playstation',
+    'whatsapp_number': '01012345678',
+    'payment_method': 'vodafone_cash',
+    'payment_details': '010-1234-5678',
+    'telegram_username': 'player',
+    'email_addresses': '["Player@Example.com"]'
+}
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryProfileStore()
+    return SQLiteProfileStore(str(tmp_path / 'profiles.db'))
+
+
+def test_profile_lookup_by_id_and_normalized_whatsapp(store):
+    """البحث بالرقم يتجاهل اختلاف الصيغة ونفس الرقم لا يُنشئ ملفاً مكرراً"""
+    handler = ProfileHandler(store)
+    created = handler.create_user_profile(FORM, '127.0.0.1', 'pytest')
+    user_id = created['user_id']
+
+    assert handler.get_user_profile(user_id)['user_data']['payment_details'] == '01012345678'
+    assert handler.search_user_by_whatsapp('+20 101 234 5678')['user_id'] == user_id
+
+    handler.link_telegram_account(user_id, {'chat_id': 42})
+
+    # رقم مسجل من جلسة أخرى: رفض بدون تعديل الملف أو إرجاع بياناته
+    takeover = handler.create_user_profile({**FORM, 'payment_details': '011-0000-0000'}, '6.6.6.6', 'other')
+    assert takeover['success'] is False
+    assert takeover['error'] == 'whatsapp_registered'
+    assert 'user_data' not in takeover
+    assert handler.get_user_profile(user_id)['user_data']['payment_details'] == '01012345678'
+
+    # صاحب الملف يحدثه بدلاً من إنشاء ملف مكرر، والرد يحتوي ما أرسله فقط
+    again = handler.create_user_profile({**FORM, 'platform': 'xbox'}, '127.0.0.1', 'pytest', owner_user_id=user_id)
+    assert again['user_id'] == user_id
+    assert 'telegram_chat_id' not in again['user_data']
+    assert handler.get_users_count() == 1
+    stored = handler.get_user_profile(user_id)['user_data']
+    assert stored['platform'] == 'xbox'
+    assert stored['telegram_chat_id'] == 42
+
+    with pytest.raises(DuplicateWhatsAppError):
+        store.save({'user_id': 'other', 'whatsapp_number': '00201012345678'})
+
+
+def test_sqlite_profiles_survive_restart_and_are_shared(tmp_path):
+    """ملف أنشأه worker يظهر في worker آخر وبعد إعادة التشغيل"""
+    db_path = str(tmp_path / 'profiles.db')
+    user_id = ProfileHandler(SQLiteProfileStore(db_path)).create_user_profile(FORM, '1.1.1.1', 'ua')['user_id']
+
+    other_worker = ProfileHandler(SQLiteProfileStore(db_path))
+    assert other_worker.link_telegram_account(user_id, {'chat_id': 42})['success'] is True
+    assert other_worker.search_user_by_whatsapp('01012345678')['user_data']['telegram_chat_id'] == 42
+
+
+def test_streaming_export_reads_bounded_pages(store):
+    """التصدير المتدفق يقرأ صفحات محدودة وينتج NDJSON / JSON / gzip صالحة"""
+    import gzip
+    import json
+
+    for index in range(25):
+        store.save({'user_id': f'user_{index:03d}', 'whatsapp_number': f'010000000{index:02d}'})
+    handler = ProfileHandler(store)
+
+    pages = []
+    original_iter_pages = store.iter_pages
+
+    def counting_iter_pages(page_size=500):
+        for page in original_iter_pages(page_size):
+            pages.append(len(page))
+            yield page
+
+    store.iter_pages = counting_iter_pages
+
+    ndjson = ''.join(handler.stream_export(page_size=10))
+    records = [json.loads(line) for line in ndjson.splitlines()]
+    assert records[0] == {**records[0], 'type': 'export_info', 'users_count': 25}
+    assert [r['user_id'] for r in records if r['type'] == 'user'] == [f'user_{i:03d}' for i in range(25)]
+    assert max(pages) == 10
+
+    array = json.loads(''.join(handler.stream_export('json', page_size=10)))
+    assert len([r for r in array if r['type'] == 'user']) == 25
+
+    compressed = b''.join(handler.stream_export(compress=True, page_size=10))
+    unpacked = [json.loads(line) for line in gzip.decompress(compressed).decode('utf-8').splitlines()]
+    assert unpacked[1:] == records[1:]
+
+
+def test_bulk_import_validates_and_deduplicates_by_whatsapp(store, tmp_path):
+    """الاستيراد الجماعي ينظف السجلات ويدمج الأرقام المكررة في ملف واحد"""
+    handler = ProfileHandler(store)
+    existing = handler.create_user_profile(FORM, '127.0.0.1', 'pytest')['user_id']
+
+    source = ProfileHandler(MemoryProfileStore())
+    for index in range(30):
+        source.store.save({
+            'user_id': f'user_{index:03d}',
+            'whatsapp_number': f'+20 10 000 000 {index:02d}',
+            'payment_method': 'vodafone_cash',
+            'payment_details': '010-0000-0000',
+            'email_addresses': ['A@Example.com', 'bad-email'],
+            'platform': '<b>pc</b>'
+        })
+    source.store.save({'user_id': 'restored', 'whatsapp_number': '00201012345678', 'platform': 'xbox'})
+    source.store.save({'user_id': 'broken', 'whatsapp_number': '123'})
+
+    path = tmp_path / 'export.ndjson.gz'
+    path.write_bytes(b''.join(source.stream_export(compress=True)))
+
+    result = handler.import_file(str(path), batch_size=7)
+    stats = result['stats']
+
+    assert result['success'] is True
+    assert stats['read'] == 32
+    assert stats['invalid'] == 1
+    assert stats['merged'] == 1
+    assert store.count() == 31
+
+    imported = handler.get_user_profile('user_005')['user_data']
+    assert imported['platform'] == 'pc'
+    assert imported['payment_details'] == '01000000000'
+    assert imported['email_addresses'] == ['a@example.com']
+    assert handler.search_user_by_whatsapp('01012345678')['user_id'] == existing
+    assert handler.get_user_profile(existing)['user_data']['platform'] == 'xbox'
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار وزارة بيع الكوينز
+===========================
+نفس السلوك في مخزن الذاكرة و SQLite
+"""
+
+import threading
+
+import pytest
+
+from sell_handler import SellCoinsHandler
+from sell_store import MemorySellStore, SQLiteSellStore
+
+ORDER = {
+    'coins_amount': 50000,
+    'transfer_type': 'normal',
+    'user_id': 'player_1',
+    'ea_account': {'email': 'player@example.com', 'password': 'secret123', 'recoveryCodes': ['12345678']}
+}
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemorySellStore()
+    return SQLiteSellStore(str(tmp_path / 'orders.db'))
+
+
+def test_user_requests_keyset_pagination(store):
+    """طلبات المستخدم من الأحدث للأقدم على صفحات بدون تكرار أو فقد"""
+    handler = SellCoinsHandler(store)
+    created = [handler.create_sell_request(ORDER)['request_id'] for _ in range(7)]
+    handler.create_sell_request({**ORDER, 'user_id': 'player_2'})
+
+    seen = []
+    cursor = None
+    while True:
+        page = handler.get_user_requests('player_1', limit=3, cursor=cursor)
+        seen.extend(r['request_id'] for r in page['requests'])
+        assert page['count'] <= 3
+        if not page['has_more']:
+            break
+        cursor = page['next_cursor']
+
+    assert sorted(seen) == sorted(created)
+    created_at = [handler.get_sell_request(rid)['request']['created_at'] for rid in seen]
+    assert created_at == sorted(created_at, reverse=True)
+
+
+def test_concurrent_status_updates_only_one_wins(store):
+    """مشرفان يكملان ويلغيان نفس الطلب المعلق في نفس اللحظة - واحد فقط ينجح"""
+    handler = SellCoinsHandler(store)
+    request_id = handler.create_sell_request(ORDER)['request_id']
+
+    barrier = threading.Barrier(2)
+    results = {}
+
+    def admin(new_status):
+        barrier.wait()
+        results[new_status] = handler.update_request_status(request_id, new_status, expected_status='pending')
+
+    threads = [threading.Thread(target=admin, args=(status,)) for status in ('completed', 'cancelled')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [status for status, result in results.items() if result['success']]
+    assert len(winners) == 1
+    assert handler.get_sell_request(request_id)['request']['status'] == winners[0]
+
+    stale = handler.update_request_status(request_id, 'processing', expected_status='pending')
+    assert stale['success'] is False
+    assert stale['current_status'] == winners[0]
+
+
+def test_status_updates_are_permissive_without_expected_status(store):
+    """بدون expected_status يمكن للمشرف نقل الطلب لأي حالة - حتى من مكتمل أو لنفس الحالة"""
+    handler = SellCoinsHandler(store)
+    request_id = handler.create_sell_request(ORDER)['request_id']
+
+    for status in ('completed', 'pending', 'cancelled', 'cancelled', 'processing'):
+        result = handler.update_request_status(request_id, status)
+        assert result['success'] is True
+    assert result['previous_status'] == 'cancelled'
+    assert handler.update_request_status(request_id, 'shipped')['success'] is False
+
+    counters = store.get_counters()
+    assert counters['status:processing'] == 1
+    assert counters.get('status:cancelled', 0) == 0
+
+
+def test_orders_survive_restart(tmp_path):
+    """الطلبات محفوظة في SQLite وتظهر لأي عملية أخرى"""
+    db_path = str(tmp_path / 'orders.db')
+    request_id = SellCoinsHandler(SQLiteSellStore(db_path)).create_sell_request(ORDER)['request_id']
+
+    restarted = SellCoinsHandler(SQLiteSellStore(db_path))
+    assert restarted.get_sell_request(request_id)['request']['coins_amount'] == 50000
+    assert restarted.get_statistics()['total_requests'] == 1
+
+
+def test_statistics_follow_transitions_and_reconcile(store):
+    """العدادات تتبع الإنشاء وتغيير الحالة، والمطابقة تصحح أي انحراف"""
+    handler = SellCoinsHandler(store)
+    first = handler.create_sell_request(ORDER)['request_id']
+    handler.create_sell_request({**ORDER, 'transfer_type': 'instant', 'ea_account': {}})
+    handler.update_request_status(first, 'completed')
+
+    # العدادات محدثة قبل أي مطابقة
+    counters = store.get_counters()
+    assert counters['status:pending'] == 1
+    assert counters['status:completed'] == 1
+
+    stats = handler.get_statistics()
+    assert stats['total_requests'] == 2
+    assert stats['total_coins'] == 100000
+    assert stats['total_value'] == 9250.0
+    assert stats['status_counts'] == {'pending': 1, 'processing': 0, 'completed': 1, 'cancelled': 0}
+    assert stats['transfer_type_counts'] == {'instant': 1, 'normal': 1}
+    assert stats['ea_accounts_count'] == 1
+
+    handler.update_request_status(first, 'cancelled')
+    assert handler.get_statistics()['status_counts']['completed'] == 0
+    assert handler.get_statistics()['status_counts']['cancelled'] == 1
+
+    if isinstance(store, MemorySellStore):
+        store.counters['total_requests'] = 99
+    else:
+        store._connect().execute("UPDATE sell_stats SET value = 99 WHERE name = 'total_requests'")
+    assert handler.reconcile_statistics()['drift'] == {'total_requests': -97}
+    assert handler.get_statistics()['total_requests'] == 2
+
+
+def test_reconcile_skips_when_orders_change_during_aggregate(tmp_path, monkeypatch):
+    """التجميع خارج قفل الكتابة: كتابة أثناءه تلغي الاستبدال بدلاً من كتابة عدادات قديمة"""
+    import sell_store
+
+    db_path = str(tmp_path / 'orders.db')
+    handler = SellCoinsHandler(SQLiteSellStore(db_path))
+    handler.create_sell_request(ORDER)
+    handler.store._connect().execute("UPDATE sell_stats SET value = 99 WHERE name = 'total_requests'")
+
+    # الطلب لا يشغل المطابقة بنفسه
+    monkeypatch.setattr(handler.store, 'reconcile_counters', lambda: pytest.fail('reconciled inline'))
+    assert handler.get_statistics()['total_requests'] == 99
+    monkeypatch.undo()
+
+    other_worker = SellCoinsHandler(SQLiteSellStore(db_path))
+    original_drift = sell_store.counters_drift
+
+    def drift_with_concurrent_write(current, actual):
+        other_worker.create_sell_request(ORDER)
+        return original_drift(current, actual)
+
+    monkeypatch.setattr(sell_store, 'counters_drift', drift_with_concurrent_write)
+    assert handler.reconcile_statistics()['success'] is False
+    assert handler.store.get_counters()['total_requests'] == 100
+
+    monkeypatch.undo()
+    assert handler.reconcile_statistics()['drift'] == {'total_requests': -98}
+    assert handler.get_statistics()['total_requests'] == 2
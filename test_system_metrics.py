@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار مقاييس النظام
+=======================
+histograms بحدود ثابتة وقياس الطلبات وكتابات SQLite
+"""
+
+import pytest
+from flask import Flask
+
+from system_metrics import LatencyHistogram, get_sqlite_stats, install_request_timing, metrics, timed_write
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_histogram_percentiles_from_buckets():
+    """النسب المئوية تُقدر من حدود الـ buckets ولا تتجاوز أكبر قيمة"""
+    histogram = LatencyHistogram()
+    for _ in range(90):
+        histogram.observe(3)
+    for _ in range(9):
+        histogram.observe(40)
+    histogram.observe(700, error=True)
+
+    stats = histogram.get_stats()
+    assert stats['count'] == 100
+    assert stats['p50_ms'] == 5.0
+    assert stats['p95_ms'] == 50.0
+    assert stats['p99_ms'] == 50.0
+    assert stats['max_ms'] == 700
+    assert stats['error_rate'] == 0.01
+    assert LatencyHistogram().get_stats()['p95_ms'] == 0.0
+
+
+def test_sqlite_writes_recorded_even_on_failure(tmp_path):
+    """زمن الكتابة يُسجل باسم الملف، والفشل يُحسب خطأ"""
+    db_path = str(tmp_path / 'orders.db')
+    with timed_write(db_path):
+        open(db_path, 'w').write('x' * 2048)
+    with pytest.raises(ValueError):
+        with timed_write(db_path):
+            raise ValueError('locked')
+
+    writes = metrics.get_group('sqlite_writes')['orders.db']
+    assert writes['count'] == 2
+    assert writes['errors'] == 1
+
+    files = get_sqlite_stats([db_path, db_path, None])
+    assert list(files) == ['orders.db']
+    assert files['orders.db']['size_kb'] == 2.0
+    assert files['orders.db']['writes'] == 2
+
+
+def test_request_timing_grouped_by_route_template():
+    """الطلبات تُجمع حسب قالب المسار وليس الرابط الفعلي"""
+    app = Flask(__name__)
+    install_request_timing(app)
+
+    @app.route('/users/<user_id>')
+    def user(user_id):
+        return user_id
+
+    @app.route('/boom')
+    def boom():
+        return 'error', 500
+
+    client = app.test_client()
+    client.get('/users/1')
+    client.get('/users/2')
+    client.get('/boom')
+    client.get('/missing')
+
+    requests = metrics.get_group('requests')
+    assert requests['GET /users/<user_id>']['count'] == 2
+    assert requests['GET /boom']['errors'] == 1
+    assert requests['GET unmatched']['count'] == 1
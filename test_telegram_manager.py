@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار وزارة التليجرام
+=========================
+تشغيل الوزارة بدون اتصالات شبكة
+"""
+
+import json
+import time
+
+import pytest
+
+from telegram_manager import TelegramManager
+
+
+def test_startup_uses_cached_bot_info_without_network(tmp_path, monkeypatch):
+    """اسم البوت يُقرأ من الملف المؤقت والتحديث يتم في الخلفية فقط بعد انتهاء الصلاحية"""
+    bot_info_path = tmp_path / 'bot.json'
+    bot_info_path.write_text(json.dumps({
+        'bot_id': '123',
+        'bot_info': {'username': 'cached_bot'},
+        'fetched_at': time.time()
+    }))
+    monkeypatch.setenv('TELEGRAM_BOT_TOKEN', '123:secret')
+    monkeypatch.setenv('TELEGRAM_BOT_INFO_PATH', str(bot_info_path))
+
+    fetched = []
+    monkeypatch.setattr(TelegramManager, 'fetch_bot_info',
+                        lambda self: fetched.append(1) or {'username': 'fresh_bot'})
+
+    started = time.monotonic()
+    manager = TelegramManager()
+    assert time.monotonic() - started < 0.5
+    assert manager.bot_username == 'cached_bot'
+    assert manager.get_cached_bot_info()['username'] == 'cached_bot'
+    assert fetched == []
+
+    manager.bot_info_fetched_at = 0
+    manager.get_cached_bot_info()
+    deadline = time.monotonic() + 2
+    while manager.bot_username != 'fresh_bot' and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert manager.bot_username == 'fresh_bot'
+    assert json.loads(bot_info_path.read_text())['bot_info']['username'] == 'fresh_bot'
+
+
+def test_direct_send_goes_through_rate_limited_outbox(tmp_path, monkeypatch):
+    """الإرسال المباشر يمر بالطابور (وحدود المعدل) ولا يستدعي API التليجرام من الطلب"""
+    monkeypatch.setenv('TELEGRAM_BOT_TOKEN', '123:secret')
+    monkeypatch.setenv('TELEGRAM_BOT_INFO_PATH', str(tmp_path / 'bot.json'))
+    monkeypatch.setenv('TELEGRAM_STORE_PATH', str(tmp_path / 'telegram.db'))
+    monkeypatch.setattr(TelegramManager, 'refresh_bot_info_async', lambda self: None)
+    manager = TelegramManager()
+
+    queued = []
+    monkeypatch.setattr(manager.outbox, 'enqueue', lambda chat_id, text, kind='message': queued.append(chat_id))
+    monkeypatch.setattr(manager, 'deliver_message', lambda *args: pytest.fail('sent without scheduler'))
+
+    assert manager.send_telegram_message(42, 'hi') is True
+    assert queued == [42]
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار صندوق صادر التليجرام
+==============================
+التوصيل في الخلفية مع إعادة المحاولة
+"""
+
+import time
+
+from telegram_manager import TelegramSendScheduler
+from telegram_outbox import RetryAfter, TelegramOutbox
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_enqueue_returns_immediately_and_retries_in_background(tmp_path):
+    """الإضافة للطابور لا تنتظر الإرسال، والفشل يُعاد بعد backoff"""
+    calls = []
+
+    def flaky_send(chat_id, text):
+        calls.append((chat_id, text))
+        time.sleep(0.2)
+        return len(calls) > 1
+
+    outbox = TelegramOutbox(flaky_send, db_path=str(tmp_path / 'outbox.db'),
+                            workers=1, base_delay=0.05, poll_interval=0.05)
+    try:
+        # إنشاء ملف الطابور والـ workers قبل القياس - المقاس هو زمن الإضافة فقط
+        outbox.start()
+        outbox.get_stats()
+
+        started = time.monotonic()
+        outbox.enqueue(123, 'مرحبا')
+        assert time.monotonic() - started < 0.1
+
+        assert wait_for(lambda: outbox.get_stats()['delivered'] == 1)
+        stats = outbox.get_stats()
+        assert stats['retries'] == 1
+        assert stats['queue_depth'] == 0
+        assert stats['avg_delivery_latency_ms'] > 0
+        assert calls == [('123', 'مرحبا'), ('123', 'مرحبا')]
+    finally:
+        outbox.stop()
+
+
+def test_message_marked_failed_after_max_attempts(tmp_path):
+    """الرسالة تتوقف بعد الحد الأقصى من المحاولات"""
+    outbox = TelegramOutbox(lambda chat_id, text: False, db_path=str(tmp_path / 'outbox.db'),
+                            workers=1, max_attempts=2, base_delay=0.01, poll_interval=0.02)
+    try:
+        outbox.enqueue(1, 'x')
+        assert wait_for(lambda: outbox.get_stats()['failed'] == 1)
+        assert outbox.get_stats()['status_counts']['failed'] == 1
+    finally:
+        outbox.stop()
+
+
+def test_scheduler_enforces_per_chat_rate(tmp_path):
+    """الرسالة الثانية لنفس المحادثة تنتظر، ومحادثة أخرى لا تتأثر"""
+    scheduler = TelegramSendScheduler(global_rate=30, chat_rate=1, chat_burst=1,
+                                      db_path=str(tmp_path / 'outbox.db'))
+
+    assert scheduler.reserve(1) == 0
+    assert 0 < scheduler.reserve(1) <= 1
+    assert scheduler.reserve(2) == 0
+
+    scheduler.pause(2, 5)
+    assert scheduler.reserve(2) > 4
+
+
+def test_rate_limits_shared_between_worker_processes(tmp_path):
+    """كل worker له scheduler خاص لكن الحد العام وحد المحادثة واحد للجميع"""
+    db_path = str(tmp_path / 'outbox.db')
+    first = TelegramSendScheduler(global_rate=2, chat_rate=1, chat_burst=1, db_path=db_path)
+    second = TelegramSendScheduler(global_rate=2, chat_rate=1, chat_burst=1, db_path=db_path)
+
+    assert first.reserve('a') == 0
+    assert second.reserve('a') > 0
+    assert second.reserve('b') == 0
+    # رمزا الحد العام استُهلكا من العمليتين
+    assert first.reserve('c') > 0
+
+    first.pause('d', 5)
+    assert second.reserve('d') > 4
+    assert second.get_stats()['tracked_chats'] == 3
+
+
+def test_admin_notifications_coalesce_into_digest(tmp_path):
+    """إشعارات الإدارة المتراكمة أثناء امتلاء الدلو تُرسل كملخص واحد"""
+    sent = []
+
+    def send(chat_id, text):
+        sent.append(text)
+        return True
+
+    scheduler = TelegramSendScheduler(global_rate=30, chat_rate=2, chat_burst=1)
+    outbox = TelegramOutbox(send, db_path=str(tmp_path / 'outbox.db'), workers=1,
+                            poll_interval=0.05, scheduler=scheduler)
+    try:
+        for index in range(4):
+            outbox.enqueue('admin', f"طلب بيع #{index}", kind='admin')
+
+        assert wait_for(lambda: outbox.get_stats()['delivered'] == 4)
+        assert len(sent) < 4
+        assert 'طلب بيع #3' in sent[-1]
+        assert sent[-1].startswith('📬')
+        assert outbox.get_stats()['coalesced'] >= 2
+    finally:
+        outbox.stop()
+
+
+def test_retry_after_defers_without_counting_attempt(tmp_path):
+    """رد 429 يؤجل الرسالة دون احتسابها محاولة فاشلة"""
+    calls = []
+
+    def send(chat_id, text):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RetryAfter(0.2)
+        return True
+
+    outbox = TelegramOutbox(send, db_path=str(tmp_path / 'outbox.db'), workers=1,
+                            max_attempts=1, poll_interval=0.05)
+    try:
+        outbox.enqueue(7, 'hi')
+        assert wait_for(lambda: outbox.get_stats()['delivered'] == 1)
+        assert calls[1] - calls[0] >= 0.2
+        assert outbox.get_stats()['failed'] == 0
+    finally:
+        outbox.stop()
+
+
+def test_failed_messages_purged_after_retention_or_requeued(tmp_path):
+    """الرسائل الفاشلة لا تبقى للأبد: تُحذف بعد مدة الاحتفاظ أو تُعاد للطابور"""
+    results = [False, False]
+    outbox = TelegramOutbox(lambda chat_id, text: results.pop(0) if results else True,
+                            db_path=str(tmp_path / 'outbox.db'), workers=1, max_attempts=1,
+                            base_delay=0.01, poll_interval=0.02)
+    try:
+        first = outbox.enqueue(1, 'a')
+        outbox.enqueue(2, 'b')
+        assert wait_for(lambda: outbox.get_stats()['status_counts']['failed'] == 2)
+
+        assert outbox.purge_failed() == 0
+        assert outbox.requeue_failed([first]) == 1
+        assert wait_for(lambda: outbox.get_stats()['delivered'] == 1)
+
+        assert outbox.purge_failed(older_than=0) == 1
+        stats = outbox.get_stats()
+        assert stats['status_counts']['failed'] == 0
+        assert stats['purged_failed'] == 1
+    finally:
+        outbox.stop()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار مخزن أكواد التليجرام
+==============================
+الصلاحية، الربط الذري، والمشاركة بين العمليات
+"""
+
+import threading
+import time
+
+from telegram_store import TelegramCodeStore
+
+
+def test_code_visible_from_another_store_instance(tmp_path):
+    """كود أنشأه worker يظهر في worker آخر"""
+    db_path = str(tmp_path / 'telegram.db')
+    TelegramCodeStore(db_path).save_code('ABC123', {'code': 'ABC123', 'used': False})
+
+    assert TelegramCodeStore(db_path).get_code('ABC123') == {'code': 'ABC123', 'used': False}
+
+
+def test_claim_code_only_succeeds_once(tmp_path):
+    """لا يمكن ربط نفس الكود مرتين"""
+    store = TelegramCodeStore(str(tmp_path / 'telegram.db'))
+    store.save_code('ABC123', {'code': 'ABC123', 'used': False})
+
+    first = store.claim_code('ABC123', {'telegram_chat_id': 1})
+    second = store.claim_code('ABC123', {'telegram_chat_id': 2})
+
+    assert first['linked'] is True
+    assert first['telegram_chat_id'] == 1
+    assert second is None
+    assert store.get_code('ABC123')['used'] is True
+
+
+def test_expired_codes_are_hidden_and_swept(tmp_path):
+    """الأكواد المنتهية لا تظهر ويحذفها التنظيف"""
+    store = TelegramCodeStore(str(tmp_path / 'telegram.db'), code_ttl=60)
+    store.save_code('OLD', {'code': 'OLD'})
+    store.save_code('NEW', {'code': 'NEW'})
+    store._connect().execute("UPDATE telegram_codes SET created_at = created_at - 120 WHERE code = 'OLD'")
+
+    assert store.get_code('OLD') is None
+    assert store.count_codes() == 1
+    assert store.sweep_expired() == 1
+    assert store.get_code('NEW') == {'code': 'NEW'}
+
+
+def test_wait_for_link_wakes_when_another_worker_links(tmp_path):
+    """المنتظر يستيقظ فور ربط الكود من worker آخر بدلاً من انتظار المهلة كاملة"""
+    db_path = str(tmp_path / 'telegram.db')
+    waiting_store = TelegramCodeStore(db_path)
+    waiting_store.watch_interval = 0.05
+    waiting_store.save_code('ABC123', {'code': 'ABC123', 'used': False})
+
+    linker = threading.Timer(0.2, lambda: TelegramCodeStore(db_path).claim_code('ABC123', {}))
+    linker.start()
+
+    started = time.monotonic()
+    data = waiting_store.wait_for_link('ABC123', timeout=5)
+
+    assert data['linked'] is True
+    assert time.monotonic() - started < 2
+
+
+def test_retried_update_is_detected_across_workers(tmp_path):
+    """إعادة إرسال نفس update_id تُتجاهل حتى لو وصلت لـ worker آخر"""
+    from telegram_manager import UpdateDeduplicator
+
+    db_path = str(tmp_path / 'telegram.db')
+    first_worker = UpdateDeduplicator(TelegramCodeStore(db_path), window_size=2)
+    second_worker = UpdateDeduplicator(TelegramCodeStore(db_path), window_size=2)
+
+    assert first_worker.is_new(1001) is True
+    first_worker.complete(1001)
+    assert first_worker.is_new(1001) is False
+    assert second_worker.is_new(1001) is False
+
+    # بعد خروجه من الحلقة في الذاكرة يبقى المخزن المشترك هو المرجع
+    for update_id in (1002, 1003):
+        first_worker.is_new(update_id)
+        first_worker.complete(update_id)
+    assert 1001 not in first_worker.recent_ids
+    assert first_worker.is_new(1001) is False
+    assert first_worker.get_stats()['duplicates'] == 2
+
+
+def test_failed_or_abandoned_update_is_accepted_on_retry(tmp_path):
+    """تحديث فشلت معالجته أو مات الـ worker أثناءه لا يضيع - إعادة الإرسال تُقبل"""
+    from telegram_manager import UpdateDeduplicator
+
+    store = TelegramCodeStore(str(tmp_path / 'telegram.db'))
+    first_worker = UpdateDeduplicator(store)
+    second_worker = UpdateDeduplicator(TelegramCodeStore(store.db_path))
+
+    # فشل المعالجة: الحجز يُحرر فوراً
+    assert first_worker.is_new(2001) is True
+    first_worker.forget(2001)
+    assert first_worker.is_new(2001) is True
+    first_worker.complete(2001)
+    assert second_worker.is_new(2001) is False
+
+    # worker توقف أثناء المعالجة: الحجز يُقبل بعد انتهاء مدته فقط
+    assert first_worker.is_new(2002) is True
+    assert second_worker.is_new(2002) is False
+    store._connect().execute('UPDATE telegram_updates SET received_at = received_at - 120')
+    assert second_worker.is_new(2002) is True
+    assert first_worker.get_stats()['released_after_error'] == 1
+
+
+def test_retry_rejected_while_claimed_elsewhere_is_accepted_after_release(tmp_path):
+    """worker رفض إعادة إرسال لأن غيره يحجزها لا يتذكرها - تُقبل بعد تحرير الحجز"""
+    from telegram_manager import UpdateDeduplicator
+
+    db_path = str(tmp_path / 'telegram.db')
+    holder = UpdateDeduplicator(TelegramCodeStore(db_path))
+    other = UpdateDeduplicator(TelegramCodeStore(db_path))
+
+    assert holder.is_new(3001) is True
+    assert other.is_new(3001) is False
+    assert 3001 not in other.recent_ids
+
+    holder.forget(3001)
+    assert other.is_new(3001) is True
+    other.complete(3001)
+    assert holder.is_new(3001) is False
+    assert other.is_new(3001) is False
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+🧪 اختبار وزارة التحقق
+======================
+اختبار فحوصات الواتساب مقابل خادم HTTP محلي يحل محل خوادم الواتساب
+"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from validation_cache import MemoryCacheBackend, SQLiteCacheBackend, ValidationResultCache
+from validators import WhatsAppValidator
+
+PROBE_DELAY = 0.4
+
+
+class WhatsAppStubHandler(BaseHTTPRequestHandler):
+    """خادم وهمي يحاكي wa.me و api/web.whatsapp.com"""
+
+    def _respond(self, with_body):
+        time.sleep(PROBE_DELAY)
+        body = b'<html><body><a href="whatsapp://send">Continue to Chat</a></body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TrickleStubHandler(BaseHTTPRequestHandler):
+    """خادم يرسل الصفحة بايتاً كل فترة قصيرة - كل قراءة أقل من مهلة socket"""
+
+    def do_GET(self):
+        body = b'<html><body>Continue to Chat</body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for byte in body:
+            self.wfile.write(bytes([byte]))
+            self.wfile.flush()
+            time.sleep(PROBE_DELAY / 4)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(handler=WhatsAppStubHandler):
+    """تشغيل الخادم الوهمي على منفذ عشوائي"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    return server, {'wa_me': base_url, 'api': base_url, 'web': base_url}
+
+
+def test_probes_run_concurrently():
+    """زمن الفحص يساوي أبطأ فحص وليس مجموع الفحوصات"""
+    server, hosts = start_stub_server()
+    try:
+        validator = WhatsAppValidator(probe_hosts=hosts, probe_deadline=5)
+
+        started = time.monotonic()
+        result = validator.check_whatsapp_ultimate_method('+201012345678')
+        elapsed = time.monotonic() - started
+
+        assert result['exists'] is True
+        methods = {r['method']: r for r in result['details']}
+        assert methods['advanced_scraping']['result'] is True
+        assert methods['multiple_endpoints']['confidence'] == 1.0
+        # 4 فحوصات متتالية كانت ستستغرق 4 × PROBE_DELAY
+        assert elapsed < PROBE_DELAY * 2.5
+    finally:
+        server.shutdown()
+
+
+def test_deadline_bounds_total_latency():
+    """الميزانية الزمنية تحد من زمن الفحص حتى مع خوادم بطيئة"""
+    server, hosts = start_stub_server()
+    try:
+        validator = WhatsAppValidator(probe_hosts=hosts, probe_deadline=PROBE_DELAY / 4)
+
+        started = time.monotonic()
+        result = validator.check_whatsapp_ultimate_method('+201012345678')
+        elapsed = time.monotonic() - started
+
+        methods = {r['method']: r for r in result['details']}
+        assert methods['advanced_scraping']['result'] is None
+        assert methods['multiple_endpoints']['confidence'] == 0
+        assert elapsed < PROBE_DELAY
+    finally:
+        server.shutdown()
+
+
+def test_abandoned_probe_ends_with_deadline():
+    """الفحص المتأخر لا يحجز خيطاً بعد الموعد النهائي - مهلته هي الوقت المتبقي"""
+    server, hosts = start_stub_server()
+    try:
+        validator = WhatsAppValidator(probe_hosts=hosts, probe_deadline=5)
+
+        with pytest.raises(TimeoutError):
+            validator._probe_endpoint(hosts['api'], time.monotonic() - 1)
+
+        started = time.monotonic()
+        with pytest.raises(Exception):
+            validator._probe_endpoint(hosts['api'], time.monotonic() + PROBE_DELAY / 4)
+        assert time.monotonic() - started < PROBE_DELAY
+    finally:
+        server.shutdown()
+
+
+def test_slow_body_is_cut_at_deadline():
+    """خادم يرسل الجسم ببطء لا يمدد فحص wa.me بعد الموعد النهائي"""
+    server, hosts = start_stub_server(TrickleStubHandler)
+    try:
+        validator = WhatsAppValidator(probe_hosts=hosts, probe_deadline=5)
+
+        started = time.monotonic()
+        with pytest.raises(TimeoutError):
+            validator._scrape_wa_me('201012345678', time.monotonic() + PROBE_DELAY * 2)
+        assert time.monotonic() - started < PROBE_DELAY * 3
+    finally:
+        server.shutdown()
+
+
+def test_cached_result_skips_network_probes():
+    """التحقق الثاني لنفس الرقم يُخدم من الذاكرة المؤقتة"""
+    server, hosts = start_stub_server()
+    try:
+        cache = ValidationResultCache(MemoryCacheBackend(max_entries=10))
+        validator = WhatsAppValidator(probe_hosts=hosts, probe_deadline=5, result_cache=cache)
+
+        first = validator.validate_whatsapp_ultimate('010 1234 5678')
+        started = time.monotonic()
+        second = validator.validate_whatsapp_ultimate('01012345678')
+        elapsed = time.monotonic() - started
+
+        assert first['whatsapp_exists'] is True
+        assert second['from_cache'] is True
+        assert second['formatted'] == first['formatted']
+        assert elapsed < PROBE_DELAY
+        assert cache.get_stats()['hits'] == 1
+        assert cache.get_stats()['misses'] == 1
+    finally:
+        server.shutdown()
+
+
+def test_memory_backend_ttl_and_lru_eviction():
+    """انتهاء الصلاحية وإخراج الأقدم استخداماً"""
+    backend = MemoryCacheBackend(max_entries=2)
+    backend.set('a', {'v': 1}, ttl=60)
+    backend.set('b', {'v': 2}, ttl=60)
+    backend.get('a')
+    backend.set('c', {'v': 3}, ttl=60)
+
+    assert backend.get('b') is None
+    assert backend.get('a') == {'v': 1}
+
+    backend.set('d', {'v': 4}, ttl=-1)
+    assert backend.get('d') is None
+    assert backend.evictions == 3
+
+
+def test_sqlite_backend_touches_last_access_lazily(tmp_path):
+    """القراءة لا تكتب last_access إلا بعد TOUCH_INTERVAL - وترتيب LRU يبقى صحيحاً"""
+    backend = SQLiteCacheBackend(str(tmp_path / 'cache.db'), max_entries=2)
+
+    def last_access(key):
+        return backend.conn.execute(
+            'SELECT last_access FROM validation_cache WHERE cache_key = ?', (key,)
+        ).fetchone()[0]
+
+    backend.set('old', {'v': 1}, ttl=60)
+    backend.set('new', {'v': 2}, ttl=60)
+    written = last_access('old')
+    assert backend.get('old') == {'v': 1}
+    assert last_access('old') == written
+
+    backend.TOUCH_INTERVAL = 0
+    assert backend.get('old') == {'v': 1}
+    assert last_access('old') > written
+
+    backend.set('third', {'v': 3}, ttl=60)
+    backend._prune(time.time())
+    assert backend.get('new') is None
+    assert backend.get('old') == {'v': 1}
+
+
+def test_sqlite_backend_shared_between_instances(tmp_path):
+    """ملف SQLite واحد يشارك النتائج بين أكثر من عملية"""
+    db_path = str(tmp_path / 'cache.db')
+    writer = ValidationResultCache(SQLiteCacheBackend(db_path))
+    reader = ValidationResultCache(SQLiteCacheBackend(db_path))
+
+    writer.set('+201012345678', {'is_valid': True, 'whatsapp_exists': None})
+
+    assert reader.get('+201012345678') == {'is_valid': True, 'whatsapp_exists': None}
+    assert reader.get_stats()['size'] == 1
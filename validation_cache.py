@@ -0,0 +1,243 @@
+# validation_cache.py - ذاكرة مؤقتة لنتائج التحقق من الواتساب
+"""
+⚡ ذاكرة نتائج التحقق - FC 26 Profile System
+============================================
+تخزين مؤقت لنتائج validate_whatsapp_ultimate حسب الرقم المنسق
+- LRU محدود الحجم مع صلاحية (TTL) لكل مدخل
+- صلاحية مختلفة للنتائج الإيجابية / السلبية / غير المؤكدة
+- عدادات hit / miss / eviction
+- backend قابل للاستبدال: ذاكرة العملية أو ملف SQLite مشترك بين الـ workers
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from system_metrics import timed_write
+
+
+class MemoryCacheBackend:
+    """Backend في ذاكرة العملية - OrderedDict بترتيب LRU"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        """إرجاع القيمة إذا كانت موجودة وصالحة، وإلا None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                self.evictions += 1
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        """حفظ قيمة مع صلاحية بالثواني"""
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def size(self):
+        return len(self.entries)
+
+
+class SQLiteCacheBackend:
+    """Backend في ملف SQLite - مشترك بين جميع gunicorn workers"""
+
+    # تنظيف المدخلات الزائدة كل عدد معين من عمليات الكتابة بدلاً من كل عملية
+    PRUNE_EVERY = 100
+    # تحديث last_access (ترتيب LRU) فقط إذا مر عليه أكثر من هذا - معظم القراءات بدون كتابة
+    TOUCH_INTERVAL = 300
+
+    def __init__(self, db_path='fc26_validation_cache.db', max_entries=10000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.writes_since_prune = 0
+
+        self.conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS validation_cache (
+                cache_key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        ''')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_validation_cache_last_access '
+            'ON validation_cache (last_access)'
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        """إرجاع القيمة إذا كانت موجودة وصالحة، وإلا None"""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value, expires_at, last_access FROM validation_cache WHERE cache_key = ?',
+                (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            if row[1] <= now:
+                with timed_write(self.db_path):
+                    self.conn.execute('DELETE FROM validation_cache WHERE cache_key = ?', (key,))
+                    self.conn.commit()
+                self.evictions += 1
+                return None
+
+            if now - row[2] >= self.TOUCH_INTERVAL:
+                with timed_write(self.db_path):
+                    self.conn.execute(
+                        'UPDATE validation_cache SET last_access = ? WHERE cache_key = ?',
+                        (now, key)
+                    )
+                    self.conn.commit()
+            return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        """حفظ قيمة مع صلاحية بالثواني"""
+        now = time.time()
+        with self.lock, timed_write(self.db_path):
+            self.conn.execute(
+                'INSERT OR REPLACE INTO validation_cache (cache_key, value, expires_at, last_access) '
+                'VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), now + ttl, now)
+            )
+            self.writes_since_prune += 1
+            if self.writes_since_prune >= self.PRUNE_EVERY:
+                self._prune(now)
+            self.conn.commit()
+
+    def _prune(self, now):
+        """حذف المدخلات المنتهية ثم الأقدم استخداماً فوق الحد الأقصى"""
+        self.writes_since_prune = 0
+        expired = self.conn.execute(
+            'DELETE FROM validation_cache WHERE expires_at <= ?', (now,)
+        ).rowcount
+        overflow = self.conn.execute(
+            'DELETE FROM validation_cache WHERE cache_key IN ('
+            'SELECT cache_key FROM validation_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        ).rowcount
+        self.evictions += expired + overflow
+
+    def delete(self, key):
+        with self.lock, timed_write(self.db_path):
+            self.conn.execute('DELETE FROM validation_cache WHERE cache_key = ?', (key,))
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock, timed_write(self.db_path):
+            self.conn.execute('DELETE FROM validation_cache')
+            self.conn.commit()
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM validation_cache').fetchone()[0]
+
+
+class ValidationResultCache:
+    """ذاكرة نتائج التحقق مع صلاحية حسب نوع النتيجة"""
+
+    def __init__(self, backend=None, ttl_positive=None, ttl_negative=None, ttl_unknown=None):
+        self.backend = backend or create_cache_backend()
+
+        # ⏱️ صلاحية النتائج بالثواني
+        self.ttls = {
+            'positive': int(ttl_positive if ttl_positive is not None
+                            else os.environ.get('WHATSAPP_CACHE_TTL_POSITIVE', 24 * 60 * 60)),
+            'negative': int(ttl_negative if ttl_negative is not None
+                            else os.environ.get('WHATSAPP_CACHE_TTL_NEGATIVE', 60 * 60)),
+            'unknown': int(ttl_unknown if ttl_unknown is not None
+                           else os.environ.get('WHATSAPP_CACHE_TTL_UNKNOWN', 5 * 60)),
+        }
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def classify_result(result):
+        """تصنيف النتيجة: positive / negative / unknown"""
+        exists = result.get('whatsapp_exists')
+        if exists is True:
+            return 'positive'
+        if exists is False:
+            return 'negative'
+        return 'unknown'
+
+    def get(self, formatted_number):
+        """البحث عن نتيجة محفوظة للرقم المنسق"""
+        value = self.backend.get(formatted_number)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, formatted_number, result):
+        """حفظ نتيجة مع الصلاحية المناسبة لنوعها"""
+        ttl = self.ttls[self.classify_result(result)]
+        if ttl > 0:
+            self.backend.set(formatted_number, result, ttl)
+
+    def invalidate(self, formatted_number):
+        self.backend.delete(formatted_number)
+
+    def clear(self):
+        self.backend.clear()
+
+    def get_stats(self):
+        """إحصائيات الذاكرة المؤقتة"""
+        total = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+            'hit_rate': round(self.hits / total, 3) if total else 0,
+            'size': self.backend.size(),
+            'ttls': dict(self.ttls)
+        }
+
+
+def create_cache_backend():
+    """إنشاء backend حسب متغيرات البيئة (memory افتراضياً)"""
+    backend_name = os.environ.get('WHATSAPP_CACHE_BACKEND', 'memory').lower()
+    max_entries = int(os.environ.get('WHATSAPP_CACHE_MAX_ENTRIES', '10000'))
+
+    if backend_name == 'sqlite':
+        db_path = os.environ.get('WHATSAPP_CACHE_PATH', 'fc26_validation_cache.db')
+        return SQLiteCacheBackend(db_path, max_entries)
+
+    return MemoryCacheBackend(max_entries)
@@ -9,14 +9,18 @@
 - تنظيف وتطبيع البيانات
 """
 
+import os
 import re
 import time
-import random
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from bs4 import BeautifulSoup
 import numpy as np
 from urllib.parse import urlparse
 
+from http_client import http_client
+from validation_cache import ValidationResultCache
+
 
 class DataValidator:
     """الكلاس الأساسي لجميع عمليات التحقق"""
@@ -40,6 +44,36 @@ class DataValidator:
 class WhatsAppValidator(DataValidator):
     """وحدة التحقق من أرقام الواتساب"""
     
+    # 🌐 عناوين خوادم الواتساب (يمكن استبدالها بخادم محلي في الاختبارات)
+    DEFAULT_PROBE_HOSTS = {
+        'wa_me': 'https://wa.me',
+        'api': 'https://api.whatsapp.com',
+        'web': 'https://web.whatsapp.com'
+    }
+    
+    # ⏱️ المهلة القصوى لكل فحص على حدة
+    SCRAPE_TIMEOUT = 8
+    SCRAPE_CHUNK_SIZE = 8192
+    ENDPOINT_TIMEOUT = 3
+    
+    # مجمع خيوط مشترك بين جميع الـ instances
+    _probe_executor = None
+    _executor_lock = threading.Lock()
+    
+    def __init__(self, probe_hosts=None, probe_deadline=None, result_cache=None):
+        super().__init__()
+        self.probe_hosts = {**self.DEFAULT_PROBE_HOSTS, **(probe_hosts or {})}
+        
+        # ميزانية زمنية واحدة لكل فحوصات الشبكة مجتمعة (بالثواني)
+        self.probe_deadline = float(
+            probe_deadline if probe_deadline is not None
+            else os.environ.get('WHATSAPP_PROBE_DEADLINE', self.SCRAPE_TIMEOUT)
+        )
+        self.probe_workers = int(os.environ.get('WHATSAPP_PROBE_WORKERS', '16'))
+        
+        # ⚡ ذاكرة مؤقتة للنتائج حسب الرقم المنسق
+        self.result_cache = result_cache or ValidationResultCache()
+    
     def validate_egyptian_mobile_instant(self, phone_input):
         """🔥 تحقق فوري من الرقم المصري - نظام المحافظ الرقمية (11 رقم فقط)"""
         if not phone_input:
@@ -117,45 +151,110 @@ class WhatsAppValidator(DataValidator):
         else:
             return ""  # رفض تام للأرقام غير الصحيحة
     
+    @staticmethod
+    def _remaining_timeout(deadline, limit):
+        """مهلة الطلب = الوقت المتبقي حتى الموعد النهائي (بحد أقصى limit)
+        
+        الفحص الذي ينتظر في الطابور حتى فات الموعد لا يبدأ أصلاً، والفحص
+        المتأخر ينتهي مع الموعد بدل أن يحجز خيطاً في المجمع لمهلته الكاملة
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('probe deadline passed before start')
+        return min(limit, remaining)
+    
+    def _scrape_wa_me(self, clean_phone, deadline):
+        """فحص صفحة wa.me وتحليل محتواها - يُرجع True/False/None"""
+        timeout = self._remaining_timeout(deadline, self.SCRAPE_TIMEOUT)
+        url = f"{self.probe_hosts['wa_me']}/{clean_phone}?text=Test"
+        
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 16_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'ar,en;q=0.9',
+            'Connection': 'keep-alive'
+        }
+        
+        # مهلة requests لكل عملية socket وليست للطلب كله - الجسم يُقرأ كما يصل
+        # مع فحص الموعد النهائي بين كل جزء حتى لا يمدده خادم يرسل ببطء
+        response = http_client.get(url, headers=headers, timeout=timeout, allow_redirects=True, stream=True)
+        try:
+            body = bytearray()
+            # read1 يرجع ما وصل فعلاً (لا ينتظر امتلاء الجزء مثل iter_content)
+            while True:
+                chunk = response.raw.read1(self.SCRAPE_CHUNK_SIZE, decode_content=True)
+                if not chunk:
+                    break
+                body.extend(chunk)
+                if time.monotonic() >= deadline:
+                    raise TimeoutError('scraping exceeded deadline')
+            page_text = body.decode(response.encoding or 'utf-8', errors='replace')
+        finally:
+            response.close()
+        
+        # تحليل محتوى متقدم
+        soup = BeautifulSoup(page_text, 'html.parser')
+        page_content = page_text.lower()
+        
+        success_indicators = ['continue to chat', 'المتابعة إلى الدردشة', 'open whatsapp', 'whatsapp://send']
+        error_indicators = ['phone number shared via url is invalid', 'رقم الهاتف غير صحيح', 'invalid phone']
+        
+        for indicator in success_indicators:
+            if indicator.lower() in page_content:
+                return True
+        
+        for indicator in error_indicators:
+            if indicator.lower() in page_content:
+                return False
+        
+        return None
+    
+    def _probe_endpoint(self, endpoint, deadline):
+        """فحص endpoint واحد عبر HEAD - يُرجع True إذا كان الرد 200/302"""
+        timeout = self._remaining_timeout(deadline, self.ENDPOINT_TIMEOUT)
+        resp = http_client.head(endpoint, timeout=timeout, allow_redirects=True)
+        return resp.status_code in [200, 302]
+    
+    def _get_probe_executor(self):
+        """الحصول على مجمع الخيوط المشترك لفحوصات الشبكة"""
+        with WhatsAppValidator._executor_lock:
+            if WhatsAppValidator._probe_executor is None:
+                WhatsAppValidator._probe_executor = ThreadPoolExecutor(
+                    max_workers=self.probe_workers,
+                    thread_name_prefix='whatsapp-probe'
+                )
+            return WhatsAppValidator._probe_executor
+    
     def check_whatsapp_ultimate_method(self, phone_number):
         """🔥 الطريقة النهائية المبتكرة - تجمع كل الحلول الذكية"""
         results = []
         clean_phone = phone_number.replace('+', '').replace(' ', '')
         
+        # ⚡ تشغيل الـ scraping وفحص الـ endpoints بالتوازي ضمن ميزانية زمنية واحدة
+        deadline = time.monotonic() + self.probe_deadline
+        executor = self._get_probe_executor()
+        
+        endpoints = [
+            f"{self.probe_hosts['wa_me']}/{clean_phone}",
+            f"{self.probe_hosts['api']}/send?phone={clean_phone}",
+            f"{self.probe_hosts['web']}/send?phone={clean_phone}"
+        ]
+        
+        scrape_future = executor.submit(self._scrape_wa_me, clean_phone, deadline)
+        endpoint_futures = [
+            executor.submit(self._probe_endpoint, endpoint, deadline)
+            for endpoint in endpoints
+        ]
+        
+        wait([scrape_future] + endpoint_futures, timeout=max(0.0, deadline - time.monotonic()))
+        
         # الطريقة 1: Advanced Scraping
         try:
-            time.sleep(random.uniform(0.1, 0.5))  # محاكاة سلوك إنساني
-            
-            url = f"https://wa.me/{clean_phone}?text=Test"
-            session_req = requests.Session()
-            
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 16_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.0 Mobile/15E148 Safari/604.1',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'ar,en;q=0.9',
-                'Connection': 'keep-alive'
-            }
-            
-            response = session_req.get(url, headers=headers, timeout=8, allow_redirects=True)
+            if not scrape_future.done():
+                scrape_future.cancel()
+                raise TimeoutError('scraping exceeded deadline')
             
-            # تحليل محتوى متقدم
-            soup = BeautifulSoup(response.text, 'html.parser')
-            page_content = response.text.lower()
-            
-            success_indicators = ['continue to chat', 'المتابعة إلى الدردشة', 'open whatsapp', 'whatsapp://send']
-            error_indicators = ['phone number shared via url is invalid', 'رقم الهاتف غير صحيح', 'invalid phone']
-            
-            scraping_result = None
-            for indicator in success_indicators:
-                if indicator.lower() in page_content:
-                    scraping_result = True
-                    break
-                    
-            if scraping_result is None:
-                for indicator in error_indicators:
-                    if indicator.lower() in page_content:
-                        scraping_result = False
-                        break
+            scraping_result = scrape_future.result()
             
             results.append({
                 'method': 'advanced_scraping',
@@ -172,23 +271,20 @@ class WhatsAppValidator(DataValidator):
         
         # الطريقة 2: Multiple Endpoints
         try:
-            endpoints = [
-                f"https://wa.me/{clean_phone}",
-                f"https://api.whatsapp.com/send?phone={clean_phone}",
-                f"https://web.whatsapp.com/send?phone={clean_phone}"
-            ]
-            
             success_count = 0
             total_count = 0
             
-            for endpoint in endpoints:
+            # أي فحص لم ينتهِ قبل الموعد النهائي يُحسب كفحص فاشل
+            for future in endpoint_futures:
+                total_count += 1
+                if not future.done():
+                    future.cancel()
+                    continue
                 try:
-                    resp = requests.head(endpoint, timeout=3, allow_redirects=True)
-                    total_count += 1
-                    if resp.status_code in [200, 302]:
+                    if future.result():
                         success_count += 1
                 except:
-                    total_count += 1
+                    pass
             
             endpoint_result = success_count > (total_count / 2) if total_count > 0 else None
             endpoint_confidence = (success_count / total_count) if total_count > 0 else 0.1
@@ -324,6 +420,18 @@ class WhatsAppValidator(DataValidator):
         # 📱 طباعة إشعار التحقق السريع
         print(f"⚡ تم التحقق الفوري من الرقم: {mobile_data['display_number']} ({mobile_data['carrier_name']})")
         
+        # ⚡ نتيجة محفوظة لنفس الرقم؟ إرجاعها فوراً بدون فحوصات الشبكة
+        cached_result = self.result_cache.get(normalized_phone)
+        if cached_result is not None:
+            return {**cached_result, 'from_cache': True}
+        
+        result = self._build_whatsapp_result(mobile_data, normalized_phone)
+        self.result_cache.set(normalized_phone, result)
+        return result
+    
+    def _build_whatsapp_result(self, mobile_data, normalized_phone):
+        """تشغيل فحوصات الواتساب وتحضير النتيجة النهائية"""
+        
         # 🔍 التحقق من الواتساب بالطرق المتقدمة
         whatsapp_check = self.check_whatsapp_ultimate_method(normalized_phone)
         
@@ -552,3 +660,10 @@ def sanitize_input(text):
 
 def normalize_phone_number(phone):
     return whatsapp_validator.normalize_phone_number(phone)
+
+def get_validation_cache_stats():
+    return whatsapp_validator.result_cache.get_stats()
+
+def get_validation_cache_path():
+    """مسار ملف SQLite لذاكرة التحقق (None مع backend الذاكرة)"""
+    return getattr(whatsapp_validator.result_cache.backend, 'db_path', None)